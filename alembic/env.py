@@ -30,6 +30,8 @@ if config.config_file_name is not None:
 # from myapp import mymodel
 # target_metadata = mymodel.Base.metadata
 from sqlalchemy import MetaData
+import sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
 import src.db_models
 target_metadata = src.db_models.Base.metadata
 #target_metadata = None
@@ -0,0 +1,37 @@
+"""add current user settings table
+
+Revision ID: a9c3e6f1b4d8
+Revises: f7d4e1a8b2c6
+Create Date: 2026-10-18 17:02:19.640175
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import JSONB
+
+# revision identifiers, used by Alembic.
+revision = 'a9c3e6f1b4d8'
+down_revision = 'f7d4e1a8b2c6'
+branch_labels = None
+depends_on = None
+
+# Latest settings per user, written together with each user_settings row; user_settings keeps the full history.
+def upgrade():
+    op.create_table(
+        'current_user_settings',
+        sa.Column('user_id', sa.String(255), primary_key=True),
+        sa.Column('settings', JSONB, nullable=False),
+        sa.Column('version', sa.Integer, nullable=False),
+        sa.Column('user_settings_id', sa.Integer, sa.ForeignKey('user_settings.id'), nullable=False),
+        sa.Column('updatedAt', sa.DateTime(timezone=True), nullable=False),
+    )
+
+    op.execute('''
+        INSERT INTO current_user_settings (user_id, settings, version, user_settings_id, "updatedAt")
+        SELECT DISTINCT ON (user_id) user_id, settings, version, id, "updatedAt"
+        FROM user_settings
+        ORDER BY user_id, "createdAt" DESC, id DESC
+    ''')
+
+def downgrade():
+    op.drop_table('current_user_settings')
@@ -0,0 +1,22 @@
+"""add processed messages updated_at index
+
+Revision ID: b6e2d8f4c1a7
+Revises: a9c3e6f1b4d8
+Create Date: 2026-10-18 18:21:07.318254
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'b6e2d8f4c1a7'
+down_revision = 'a9c3e6f1b4d8'
+branch_labels = None
+depends_on = None
+
+# Used by the periodic purge of old records (services.idempotency.purge_processed_messages).
+def upgrade():
+    op.create_index('ix_processed_messages_updated_at', 'processed_messages', ['updated_at'])
+
+def downgrade():
+    op.drop_index('ix_processed_messages_updated_at', table_name='processed_messages')
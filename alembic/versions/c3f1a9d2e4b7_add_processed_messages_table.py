@@ -0,0 +1,34 @@
+"""add processed messages table
+
+Revision ID: c3f1a9d2e4b7
+Revises: 8a6746b2ce16
+Create Date: 2026-10-18 10:12:31.204518
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import JSONB
+
+# revision identifiers, used by Alembic.
+revision = 'c3f1a9d2e4b7'
+down_revision = '8a6746b2ce16'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    op.create_table(
+        'processed_messages',
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('source', sa.String(255), nullable=False),
+        sa.Column('chat_id', sa.String(255), nullable=False),
+        sa.Column('message_id', sa.String(255), nullable=False),
+        sa.Column('state', sa.String(32), nullable=False),
+        sa.Column('reply', JSONB),
+        sa.Column('created_at', sa.DateTime(timezone=True), nullable=False),
+        sa.Column('updated_at', sa.DateTime(timezone=True), nullable=False),
+    )
+    op.create_index('ix_processed_messages_source_chat_id_message_id', 'processed_messages', ['source', 'chat_id', 'message_id'], unique=True)
+
+def downgrade():
+    op.drop_index('ix_processed_messages_source_chat_id_message_id', table_name='processed_messages')
+    op.drop_table('processed_messages')
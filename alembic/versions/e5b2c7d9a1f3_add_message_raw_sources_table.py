@@ -0,0 +1,29 @@
+"""add message raw sources table
+
+Revision ID: e5b2c7d9a1f3
+Revises: c3f1a9d2e4b7
+Create Date: 2026-10-18 16:14:02.518730
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'e5b2c7d9a1f3'
+down_revision = 'c3f1a9d2e4b7'
+branch_labels = None
+depends_on = None
+
+# Existing payloads stay in Messages."rawSource" until moved by tools/backfill_raw_sources.py.
+def upgrade():
+    op.create_table(
+        'message_raw_sources',
+        sa.Column('message_id', sa.Integer, sa.ForeignKey('Messages.id', ondelete='CASCADE'), primary_key=True),
+        sa.Column('data', sa.LargeBinary, nullable=False),
+        sa.Column('created_at', sa.DateTime(timezone=True), nullable=False),
+    )
+    op.create_index('ix_message_raw_sources_created_at', 'message_raw_sources', ['created_at'])
+
+def downgrade():
+    op.drop_index('ix_message_raw_sources_created_at', table_name='message_raw_sources')
+    op.drop_table('message_raw_sources')
@@ -0,0 +1,22 @@
+"""add Messages.tokenCount
+
+Revision ID: f7d4e1a8b2c6
+Revises: e5b2c7d9a1f3
+Create Date: 2026-10-18 16:31:45.107263
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'f7d4e1a8b2c6'
+down_revision = 'e5b2c7d9a1f3'
+branch_labels = None
+depends_on = None
+
+# Existing rows are filled by tools/backfill_token_counts.py; until then, their tokens are counted when needed.
+def upgrade():
+    op.add_column('Messages', sa.Column('tokenCount', sa.Integer))
+
+def downgrade():
+    op.drop_column('Messages', 'tokenCount')
@@ -1,13 +1,17 @@
 # coding: utf-8
 import os
+import threading
 
 import sqlalchemy
 from sqlalchemy import create_engine, func
-from sqlalchemy import Boolean, Column, DateTime, Index, Integer, JSON, String, Text, text, TypeDecorator
+from sqlalchemy import Boolean, Column, DateTime, ForeignKey, Index, Integer, JSON, LargeBinary, String, Text, text, TypeDecorator
 from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy.engine.url import URL
+from sqlalchemy.engine.url import URL, make_url
+
+from infra.db_pool import InstrumentedAsyncQueuePool, InstrumentedQueuePool
+from infra.env import env_bool, env_float, env_int
 
 # JSONB is not supported by SQLite, but is supported by PostgreSQL.
 # DialectAdapter selects the right one is used per database type.
@@ -43,10 +47,19 @@ class Message(Base):
     replyToMessageId = Column(String(255))
     kind = Column(String(255))
     body = Column(Text)
-    rawSource = Column(JSON)
+    tokenCount = Column(Integer)    # tiktoken (cl100k_base) tokens in body
+    rawSource = Column(JSON)        # legacy; payloads are stored in message_raw_sources
     createdAt = Column(DateTime(True), nullable=False)
     updatedAt = Column(DateTime(True), nullable=False)
 
+# Webhook payloads of messages, zlib-compressed JSON; kept apart from the hot Messages table.
+class MessageRawSource(Base):
+    __tablename__ = 'message_raw_sources'
+
+    message_id = Column(Integer, ForeignKey('Messages.id', ondelete='CASCADE'), primary_key=True)
+    data = Column(LargeBinary, nullable=False)
+    created_at = Column(DateTime(timezone=True), nullable=False, index=True)
+
 
 class SequelizeMeta(Base):
     __tablename__ = 'SequelizeMeta'
@@ -64,6 +77,17 @@ class UserSettings(Base):
     createdAt = Column(DateTime(True), nullable=False, index=True)
     updatedAt = Column(DateTime(True), nullable=False)
 
+# Latest user_settings row per user, kept in the same transaction as each settings change (see tools/user_settings.py);
+# user_settings itself is append-only, for audit.
+class CurrentUserSettings(Base):
+    __tablename__ = 'current_user_settings'
+
+    user_id = Column(String(255), primary_key=True)
+    settings = Column(DialectAdapter, nullable=False)
+    version = Column(Integer, nullable=False)
+    user_settings_id = Column(Integer, ForeignKey('user_settings.id'), nullable=False)
+    updatedAt = Column(DateTime(True), nullable=False)
+
 class Event(Base):
     __tablename__ = 'events'
 
@@ -89,13 +113,129 @@ class Timer(Base):
     created_at = Column(DateTime)
     updated_at = Column(DateTime)
 
+class ProcessedMessage(Base):
+    __tablename__ = 'processed_messages'
+
+    id = Column(Integer, primary_key=True)
+    source = Column(String(255), nullable=False)
+    chat_id = Column(String(255), nullable=False)
+    message_id = Column(String(255), nullable=False)
+    state = Column(String(32), nullable=False)
+    reply = Column(DialectAdapter)
+    created_at = Column(DateTime(timezone=True), nullable=False)
+    updated_at = Column(DateTime(timezone=True), nullable=False)
+
+    __table_args__ = (
+        sqlalchemy.Index('ix_processed_messages_source_chat_id_message_id', 'source', 'chat_id', 'message_id', unique=True),
+        sqlalchemy.Index('ix_processed_messages_updated_at', 'updated_at'),
+    )
+
 ### End of table definitions ###
 
-# Set up the database connection
-engine = create_engine(os.environ['DB_CONNECTION_STRING'])
+# Connection pool, per process. Each consumer thread may hold two connections at once (history is fetched while the
+# incoming message is stored), and background threads (timers, write-behind, retention) need a few more.
+DB_POOL_SIZE = env_int('DB_POOL_SIZE', 20)
+DB_MAX_OVERFLOW = env_int('DB_MAX_OVERFLOW', 10)
+DB_POOL_TIMEOUT = env_float('DB_POOL_TIMEOUT', 30)
+
+# Connections are checked before use, and replaced after DB_POOL_RECYCLE seconds, so that connections dropped by the
+# server or a proxy while idle don't fail the next query; -1 never replaces them.
+DB_POOL_PRE_PING = env_bool('DB_POOL_PRE_PING', True)
+DB_POOL_RECYCLE = env_int('DB_POOL_RECYCLE', 1800)
+
+def _get_engine_options(connection_string, poolclass=InstrumentedQueuePool):
+    # SQLite (local development) keeps SQLAlchemy's default pool, which depends on the database being a file or in memory.
+    if make_url(connection_string).get_backend_name() == 'sqlite':
+        return {}
+
+    return {
+        'poolclass': poolclass,
+        'pool_size': DB_POOL_SIZE,
+        'max_overflow': DB_MAX_OVERFLOW,
+        'pool_timeout': DB_POOL_TIMEOUT,
+        'pool_pre_ping': DB_POOL_PRE_PING,
+        'pool_recycle': DB_POOL_RECYCLE
+    }
+
+# The engine is created on first use, not on import: importing models (tools, alembic, modules that only reference
+# them) needs neither a reachable database nor a connection. The schema is managed by alembic; DB_CREATE_ALL=1 creates
+# missing tables when the engine is created instead, for SQLite development databases (set by load_env() when no
+# database is configured); it is read when the engine is created, as the environment may be loaded after this import.
+_engine = None
+_session_factory = sessionmaker()
+_engine_lock = threading.Lock()
+
+def get_engine():
+    global _engine
+
+    if _engine is not None:
+        return _engine
+
+    with _engine_lock:
+        if _engine is None:
+            connection_string = os.environ['DB_CONNECTION_STRING']
+            engine = create_engine(connection_string, **_get_engine_options(connection_string))
+
+            if env_bool('DB_CREATE_ALL'):
+                Base.metadata.create_all(engine)
+
+            _session_factory.configure(bind=engine)
+            _engine = engine
+
+        return _engine
+
+def Session(**kwargs):
+    # Same use as a sessionmaker: `with db_models.Session() as session: ...`.
+    get_engine()
+
+    return _session_factory(**kwargs)
+
+# Async counterparts, for code running on an event loop (see the *_async functions of message_db, timers and
+# user_settings). The engine uses asyncpg or aiosqlite, and is only created when first used, so that processes not
+# using it don't need those drivers. Its connections belong to the event loop that opened them: use it from one loop.
+_async_engine = None
+_async_session_factory = None
+_async_engine_lock = threading.Lock()
+
+def get_async_connection_string(connection_string):
+    url = make_url(connection_string)
+    backend_name = url.get_backend_name()
+
+    if backend_name == 'postgresql':
+        query = dict(url.query)
+
+        # asyncpg takes 'ssl' rather than libpq's 'sslmode'; it accepts the same values.
+        if 'sslmode' in query:
+            query['ssl'] = query.pop('sslmode')
+
+        return url.set(drivername='postgresql+asyncpg', query=query)
+
+    if backend_name == 'sqlite':
+        return url.set(drivername='sqlite+aiosqlite')
+
+    raise ValueError(f'No async driver configured for {backend_name} databases')
+
+def get_async_engine():
+    global _async_engine, _async_session_factory
+
+    # Imported here, as only event-loop code uses it.
+    from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+    with _async_engine_lock:
+        if _async_engine is None:
+            connection_string = os.environ['DB_CONNECTION_STRING']
+
+            # Tables are created through the sync engine, when enabled.
+            get_engine()
+
+            _async_engine = create_async_engine(get_async_connection_string(connection_string),
+                                                **_get_engine_options(connection_string, InstrumentedAsyncQueuePool))
+            _async_session_factory = async_sessionmaker(bind=_async_engine, expire_on_commit=False)
+
+        return _async_engine
 
-# Create a session factory
-Session = sessionmaker(bind=engine)
+def async_session():
+    # Objects are never expired on commit: reloading expired attributes would need implicit (blocking) I/O.
+    get_async_engine()
 
-# Register models
-Base.metadata.create_all(engine)
+    return _async_session_factory()
@@ -0,0 +1,83 @@
+import threading
+import time
+import traceback
+
+from infra import logger, metrics
+
+# SQS deletes at most 10 messages per call.
+MAX_DELETE_BATCH = 10
+
+# Acknowledges (deletes) processed queue messages as they complete.
+#
+# Completed messages are collected and deleted together, once MAX_DELETE_BATCH of them are pending or after
+# flush_interval seconds, so a slow message never holds back the acknowledgement of others received with it.
+# Messages stay tracked by the heartbeat until they are deleted, so they can't become visible in between.
+class QueueAcker:
+    def __init__(self, queue, heartbeat, flush_interval: float = 0.2):
+        self.queue = queue
+        self.heartbeat = heartbeat
+        self.flush_interval = flush_interval
+
+        self._cond = threading.Condition()
+        self._pending = []
+        self._oldest = None     # time the oldest pending message completed
+
+        self._delete_failures = metrics.counter('sqs_delete_failures')
+        self._delete_batch_size = metrics.histogram('sqs_delete_batch_size', buckets=(1, 2, 4, 6, 8, 10))
+
+        self._thread = threading.Thread(target=self._run, name='sqs-acker', daemon=True)
+        self._thread.start()
+
+    def ack(self, message) -> None:
+        with self._cond:
+            if len(self._pending) == 0:
+                self._oldest = time.time()
+
+            self._pending.append(message)
+
+            # Wakes the flush thread, which starts the flush timer or deletes a full batch.
+            if len(self._pending) == 1 or len(self._pending) >= MAX_DELETE_BATCH:
+                self._cond.notify()
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+
+            try:
+                self._delete(batch)
+            except Exception as e:
+                # Undeleted messages become visible again, and are skipped as duplicates once redelivered.
+                logger.logger.error(f'Exception occurred; {e}; stack trace: ', traceback.format_exc())
+
+    def _next_batch(self):
+        with self._cond:
+            while True:
+                if len(self._pending) >= MAX_DELETE_BATCH:
+                    break
+
+                if len(self._pending) > 0:
+                    remaining = self._oldest + self.flush_interval - time.time()
+                    if remaining <= 0:
+                        break
+
+                    self._cond.wait(remaining)
+                else:
+                    self._cond.wait()
+
+            batch = self._pending[:MAX_DELETE_BATCH]
+            self._pending = self._pending[MAX_DELETE_BATCH:]
+            self._oldest = time.time() if self._pending else None
+
+            return batch
+
+    def _delete(self, batch):
+        # Extensions stop right before the delete call: an extension racing a delete would fail, and count the message
+        # as lost. Each extension leaves at least 2/3 of the visibility timeout, plenty for the delete to complete.
+        for message in batch:
+            self.heartbeat.untrack(message)
+
+        self._delete_batch_size.observe(len(batch))
+
+        for receipt_handle in self.queue.delete_messages([message['ReceiptHandle'] for message in batch]):
+            self._delete_failures.inc()
+            logger.logger.error(f'Failed deleting message; receipt handle={receipt_handle}')
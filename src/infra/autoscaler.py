@@ -0,0 +1,122 @@
+import math
+import threading
+import time
+import traceback
+
+from infra import logger, metrics
+
+# Tracks consumer load as seen by this process: how old messages are when received, how many are in flight,
+# and how long each takes to process.
+class ConsumerLoad:
+    # Weight of the newest sample in exponentially-weighted moving averages.
+    EWMA_ALPHA = 0.2
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+        self.in_flight = 0
+        self.queue_age = 0.0            # seconds between send and receive
+        self.processing_time = 0.0      # seconds per message
+        self.received = 0               # messages received since last reset
+
+        self._in_flight_gauge = metrics.gauge('consumer_in_flight')
+        self._queue_lag = metrics.histogram('queue_lag_seconds')
+
+    def observe_received(self, message):
+        sent_timestamp = message.get('Attributes', {}).get('SentTimestamp')
+        age = max(time.time() - int(sent_timestamp) / 1000, 0) if sent_timestamp else 0
+
+        if sent_timestamp:
+            self._queue_lag.observe(age)
+
+        with self._lock:
+            self.received += 1
+            self.queue_age += self.EWMA_ALPHA * (age - self.queue_age)
+
+    def observe_empty_receive(self):
+        # An empty long poll means there is no backlog.
+        with self._lock:
+            self.queue_age *= (1 - self.EWMA_ALPHA)
+
+    def observe_start(self):
+        with self._lock:
+            self.in_flight += 1
+            self._in_flight_gauge.set(self.in_flight)
+
+    def observe_done(self, duration):
+        with self._lock:
+            self.in_flight -= 1
+            self._in_flight_gauge.set(self.in_flight)
+
+            self.processing_time += self.EWMA_ALPHA * (duration - self.processing_time)
+
+    def sample(self):
+        # Returns current values, and resets the receive counter.
+        with self._lock:
+            received = self.received
+            self.received = 0
+
+            return received, self.in_flight, self.queue_age, self.processing_time
+
+# Periodically resizes a consumer pool between min_capacity and max_capacity.
+#
+# Desired capacity follows Little's law (arrival rate x processing time), with headroom for bursts.
+# When messages wait in the queue longer than target_queue_age while all consumers are busy, capacity is
+# increased regardless of the estimate.
+class Autoscaler:
+    UTILIZATION_TARGET = 0.75
+
+    def __init__(self, load: ConsumerLoad, scale_fn, capacity: int, min_capacity: int, max_capacity: int, target_queue_age: float = 5, interval: float = 10, cooldown: float = 60):
+        self.load = load
+        self.scale_fn = scale_fn
+        self.capacity = capacity
+        self.min_capacity = min_capacity
+        self.max_capacity = max_capacity
+        self.target_queue_age = target_queue_age
+        self.interval = interval
+        self.cooldown = cooldown
+
+        self._last_scale_down = 0
+
+        self._capacity_gauge = metrics.gauge('consumer_capacity')
+        self._capacity_gauge.set(capacity)
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+
+            try:
+                self.step()
+            except Exception as e:
+                logger.logger.error(f'Exception occurred; {e}; stack trace: ', traceback.format_exc())
+
+    def step(self):
+        received, in_flight, queue_age, processing_time = self.load.sample()
+        arrival_rate = received / self.interval
+
+        desired = math.ceil(arrival_rate * processing_time / self.UTILIZATION_TARGET)
+
+        is_backlogged = queue_age > self.target_queue_age and in_flight >= self.capacity
+        if is_backlogged:
+            desired = max(desired, self.capacity + max(1, self.capacity // 4))
+
+        desired = min(max(desired, self.min_capacity), self.max_capacity)
+
+        if desired == self.capacity:
+            return
+
+        now = time.time()
+
+        # Scale up immediately, but scale down gradually, to avoid flapping on bursty traffic.
+        if desired < self.capacity:
+            if now - self._last_scale_down < self.cooldown or queue_age > self.target_queue_age:
+                return
+
+            desired = max(desired, self.capacity - max(1, self.capacity // 4))
+            self._last_scale_down = now
+
+        logger.logger.info(f'[autoscaler] scaling consumers {self.capacity} -> {desired}; arrival_rate={arrival_rate:.2f}/s, in_flight={in_flight}, queue_age={queue_age:.1f}s, processing_time={processing_time:.1f}s')
+
+        self.scale_fn(desired)
+        self.capacity = desired
+        self._capacity_gauge.set(desired)
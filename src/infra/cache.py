@@ -0,0 +1,60 @@
+import collections
+import threading
+import time
+from typing import Any, Hashable, Optional, Tuple
+
+from infra import metrics
+
+# Bounded, thread-safe LRU cache with per-entry expiry.
+class TTLCache:
+    def __init__(self, name: str, max_entries: int, ttl: float):
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()   # key -> (expires_at, value)
+
+        self._hits = metrics.counter('cache_hits', cache=name)
+        self._misses = metrics.counter('cache_misses', cache=name)
+        self._size = metrics.gauge('cache_entries', cache=name)
+
+    def get(self, key: Hashable) -> Tuple[bool, Any]:
+        now = time.time()
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                self._hits.inc()
+                return True, entry[1]
+
+            if entry is not None:
+                del self._entries[key]
+                self._size.set(len(self._entries))
+
+        self._misses.inc()
+        return False, None
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        expires_at = time.time() + (self.ttl if ttl is None else ttl)
+
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+            self._size.set(len(self._entries))
+
+    def invalidate(self, key: Hashable) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+            self._size.set(len(self._entries))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._size.set(0)
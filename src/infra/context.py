@@ -1,5 +1,8 @@
+import contextlib
+import json
 import threading
-from typing import Any, Dict, Union
+import time
+from typing import Any, Callable, Dict, List, Tuple, Union
 from infra import logger
 
 
@@ -22,13 +25,54 @@ class Context(object):
         self.user_channel = None    # type: str
         self.user_settings = {}     # type: Dict[str, Any]
 
+        # Raw events of later messages from the same chat that were received but not yet processed, when known.
+        self.queued_in_chat = lambda: []   # type: Callable[[], List[str]]
+
         self.msg_count = counter.get_and_increment()
         self.logger = logger.create_logging_context(self.msg_count)
 
         self.stats = {}
+
+        # Timed stages of message handling, as (name, start offset ms, duration ms); see span().
+        self.start_time = time.time()
+        self.spans = []             # type: List[Tuple[str, int, int]]
+        self._spans_lock = threading.Lock()
     
     def log(self, message:Any, *args:Any) -> None:
         self.logger.log(message, args)
         
     def set_stat(self, key: str, value: Union[int, bool, float, str]):
         self.stats[key] = value
+
+    @contextlib.contextmanager
+    def span(self, name: str):
+        start = time.time()
+
+        try:
+            yield
+        finally:
+            end = time.time()
+
+            with self._spans_lock:
+                self.spans.append((name, int((start - self.start_time) * 1000), int((end - start) * 1000)))
+
+    def traced(self, name: str, fn, *args, **kwargs):
+        with self.span(name):
+            return fn(*args, **kwargs)
+
+    def span_properties(self) -> Dict[str, int]:
+        # Flattened for analytics; repeated stages (e.g. several sends) are summed.
+        properties = {}
+
+        with self._spans_lock:
+            for name, offset_ms, duration_ms in self.spans:
+                key = f'span:{name}_ms'
+                properties[key] = properties.get(key, 0) + duration_ms
+
+        return properties
+
+    def log_spans(self) -> None:
+        with self._spans_lock:
+            spans = [{ 'name' : name, 'offset_ms' : offset_ms, 'duration_ms' : duration_ms } for name, offset_ms, duration_ms in self.spans]
+
+        self.log('spans: ' + json.dumps({ 'total_ms' : int((time.time() - self.start_time) * 1000), 'spans' : spans }))
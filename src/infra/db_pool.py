@@ -0,0 +1,51 @@
+import time
+
+from sqlalchemy.exc import TimeoutError
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+from infra import metrics
+
+# QueuePool reporting how it is used: connections checked out, overflow connections in use, and how long
+# checkouts wait for a free connection (including connecting, for new ones). Long waits mean the pool is too small for
+# the number of concurrent DB steps.
+#
+# QueuePool.recreate() (used by engine.dispose()) keeps the class, so the instrumentation survives it.
+class InstrumentedQueuePool(QueuePool):
+    engine_label = 'sync'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self._checked_out_gauge = metrics.gauge('db_pool_checked_out', engine=self.engine_label)
+        self._overflow_gauge = metrics.gauge('db_pool_overflow', engine=self.engine_label)
+        self._wait_histogram = metrics.histogram('db_pool_wait_seconds', engine=self.engine_label)
+        self._timeouts = metrics.counter('db_pool_timeouts', engine=self.engine_label)
+
+        metrics.gauge('db_pool_size', engine=self.engine_label).set(self.size())
+
+    def _do_get(self):
+        start = time.time()
+
+        try:
+            connection = super()._do_get()
+        except TimeoutError:
+            self._timeouts.inc()
+            raise
+        finally:
+            self._wait_histogram.observe(time.time() - start)
+
+        self._update_gauges()
+
+        return connection
+
+    def _do_return_conn(self, record):
+        super()._do_return_conn(record)
+        self._update_gauges()
+
+    def _update_gauges(self):
+        self._checked_out_gauge.set(self.checkedout())
+        self._overflow_gauge.set(max(self.overflow(), 0))
+
+# Same, for async engines.
+class InstrumentedAsyncQueuePool(InstrumentedQueuePool, AsyncAdaptedQueuePool):
+    engine_label = 'async'
@@ -0,0 +1,135 @@
+import collections
+import queue
+import threading
+from concurrent.futures import Future
+from typing import List, Tuple
+
+from infra import logger, metrics
+
+SHARD_DEPTH_BUCKETS = (1, 2, 3, 5, 10, 20, 50)
+
+# Runs submitted work on a pool of worker threads, sharded by key. Workers are spawned on demand, up to num_workers.
+#
+# Work items sharing a key (typically '<source>:<chatId>') execute one at a time, in submission order.
+# Work items with different keys run in parallel, up to the number of workers.
+#
+# This mirrors SQS FIFO message group semantics: a message group maps to a shard, so a FIFO queue and
+# this dispatcher agree on what must be serialized.
+class ChatDispatcher:
+    def __init__(self, num_workers: int, name: str = 'dispatcher'):
+        self.name = name
+        self.num_workers = num_workers
+
+        self._lock = threading.Lock()
+        self._shards = {}               # key -> deque of (future, fn, args); head is running or scheduled
+        self._ready = queue.Queue()     # keys whose head item may run now
+
+        self._pending = metrics.gauge('dispatcher_pending', dispatcher=name)
+        self._active_shards = metrics.gauge('dispatcher_active_shards', dispatcher=name)
+
+        # Depth of a shard as each item joins it (1 = runs right away). Keys are chat ids, so shards are only reported
+        # in aggregate: a label per key would expose them, and grow without bound.
+        self._shard_depth = metrics.histogram('dispatcher_shard_depth', buckets=SHARD_DEPTH_BUCKETS, dispatcher=name)
+
+        self._workers = []
+        self._idle_workers = 0
+
+    def submit(self, key: str, fn, *args) -> Future:
+        future = Future()
+
+        with self._lock:
+            shard = self._shards.get(key)
+            is_new_shard = shard is None
+
+            if is_new_shard:
+                shard = collections.deque()
+                self._shards[key] = shard
+
+            shard.append((future, fn, args))
+            self._shard_depth.observe(len(shard))
+            self._update_shard_metrics()
+
+        if is_new_shard:
+            self._ready.put(key)
+            self._maybe_spawn_worker()
+
+        return future
+
+    def queued_behind(self, key: str) -> int:
+        # Number of items for this key that have not started yet, excluding the head.
+        with self._lock:
+            shard = self._shards.get(key)
+            return max(len(shard) - 1, 0) if shard else 0
+
+    def queued_args(self, key: str) -> List[Tuple]:
+        # Arguments of the items for this key that have not started yet, excluding the head, in submission order.
+        with self._lock:
+            shard = self._shards.get(key)
+            return [args for future, fn, args in list(shard)[1:]] if shard else []
+
+    def shard_depths(self):
+        with self._lock:
+            return {key: len(shard) for key, shard in self._shards.items()}
+
+    def set_num_workers(self, num_workers: int) -> None:
+        # Surplus workers exit once idle; missing workers are spawned as work arrives.
+        with self._lock:
+            self.num_workers = num_workers
+
+        for i in range(min(self._ready.qsize(), num_workers)):
+            self._maybe_spawn_worker()
+
+    def _maybe_spawn_worker(self):
+        with self._lock:
+            if self._idle_workers >= self._ready.qsize() or len(self._workers) >= self.num_workers:
+                return
+
+            thread = threading.Thread(target=self._worker, name=f'{self.name}-{len(self._workers)}', daemon=True)
+            self._workers.append(thread)
+            self._idle_workers += 1
+
+        thread.start()
+
+    def _worker(self):
+        while True:
+            with self._lock:
+                if len(self._workers) > self.num_workers:
+                    self._workers.remove(threading.current_thread())
+                    self._idle_workers -= 1
+                    return
+
+            try:
+                key = self._ready.get(timeout=5)
+            except queue.Empty:
+                continue
+
+            with self._lock:
+                self._idle_workers -= 1
+                future, fn, args = self._shards[key][0]
+
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(fn(*args))
+                except BaseException as e:
+                    logger.logger.error(f'[{self.name}] work item for shard {key} failed; {e}')
+                    future.set_exception(e)
+
+            with self._lock:
+                shard = self._shards[key]
+                shard.popleft()
+
+                if len(shard) == 0:
+                    del self._shards[key]
+
+                self._update_shard_metrics()
+
+                self._idle_workers += 1
+
+            if len(shard) > 0:
+                # Re-queue at the tail, so a busy chat does not starve others.
+                self._ready.put(key)
+
+    def _update_shard_metrics(self):
+        # Called with self._lock held.
+        self._pending.set(sum(len(s) for s in self._shards.values()))
+        self._active_shards.set(len(self._shards))
@@ -0,0 +1,24 @@
+import os
+from typing import Optional
+
+# Typed access to optional settings. Empty values count as unset: .env.example lists every optional key as `KEY=`,
+# and copies of it (see SETUP.md) set all of them to ''.
+
+def env_str(name: str, default: Optional[str] = None) -> Optional[str]:
+    value = os.environ.get(name, '')
+    return value if value != '' else default
+
+def env_int(name: str, default: Optional[int] = None) -> Optional[int]:
+    value = env_str(name)
+    return int(value) if value is not None else default
+
+def env_float(name: str, default: Optional[float] = None) -> Optional[float]:
+    value = env_str(name)
+    return float(value) if value is not None else default
+
+def env_bool(name: str, default: bool = False) -> bool:
+    value = env_str(name)
+    if value is None:
+        return default
+
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
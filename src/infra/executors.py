@@ -0,0 +1,22 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from infra.env import env_int
+
+# CPU-bound work (tiktoken encoding, pydub/ffmpeg conversions) is funneled through a small dedicated pool.
+# This keeps the number of concurrent CPU-heavy steps bounded, regardless of how many messages are in flight.
+CPU_WORKERS = env_int('CPU_WORKERS', os.cpu_count() or 1)
+
+cpu_executor = ThreadPoolExecutor(max_workers=CPU_WORKERS, thread_name_prefix='r1x-cpu')
+
+# Short blocking I/O steps (HTTP calls, DB queries) that can overlap within the handling of a single message.
+IO_WORKERS = env_int('IO_WORKERS', 32)
+
+io_executor = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix='r1x-io')
+
+def run_cpu_bound(fn, *args, **kwargs):
+    return cpu_executor.submit(fn, *args, **kwargs).result()
+
+async def run_cpu_bound_async(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(cpu_executor, fn, *args)
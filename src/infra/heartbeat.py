@@ -0,0 +1,87 @@
+import threading
+import time
+import traceback
+
+from infra import logger, metrics
+
+# Keeps received queue messages invisible while they are queued or being processed.
+#
+# A single background thread periodically extends the visibility timeout of every tracked message,
+# so long-running pipelines (e.g. transcription followed by several completions) are not redelivered
+# to another consumer half-way through.
+class VisibilityHeartbeat:
+    def __init__(self, queue, visibility_timeout: int):
+        self.queue = queue
+        self.visibility_timeout = visibility_timeout
+
+        # Extend well before expiry, leaving room for a slow or failed call.
+        self.interval = max(visibility_timeout / 3, 1)
+
+        self._lock = threading.Lock()
+        self._tracked = {}      # receipt handle -> time of last extension
+        self._lost = set()      # receipt handles that could not be extended
+
+        self._extensions = metrics.counter('sqs_visibility_extensions')
+        self._extension_failures = metrics.counter('sqs_visibility_extension_failures')
+        self._duplicated_work = metrics.counter('sqs_duplicated_work')
+        self._redeliveries = metrics.counter('sqs_redeliveries')
+
+        self._thread = threading.Thread(target=self._run, name='sqs-heartbeat', daemon=True)
+        self._thread.start()
+
+    def track(self, message) -> None:
+        if int(message.get('Attributes', {}).get('ApproximateReceiveCount', 1)) > 1:
+            self._redeliveries.inc()
+
+        with self._lock:
+            self._tracked[message['ReceiptHandle']] = time.time()
+
+    def untrack(self, message) -> bool:
+        # Returns False if visibility was lost while the message was held, meaning it may have been processed twice.
+        receipt_handle = message['ReceiptHandle']
+
+        with self._lock:
+            self._tracked.pop(receipt_handle, None)
+            lost = receipt_handle in self._lost
+            self._lost.discard(receipt_handle)
+
+        if lost:
+            self._duplicated_work.inc()
+            logger.logger.info(f'Message {message["MessageId"]} lost visibility while being processed; work was likely duplicated.')
+
+        return not lost
+
+    def _run(self):
+        while True:
+            time.sleep(1)
+
+            try:
+                self._extend_due()
+            except Exception as e:
+                logger.logger.error(f'Exception occurred; {e}; stack trace: ', traceback.format_exc())
+
+    def _extend_due(self):
+        now = time.time()
+
+        with self._lock:
+            due = [handle for handle, last in self._tracked.items() if now - last >= self.interval]
+
+        if len(due) == 0:
+            return
+
+        failed = set(self.queue.change_visibility(due, self.visibility_timeout))
+
+        with self._lock:
+            for handle in due:
+                # Message may have completed while the call was in flight.
+                if handle not in self._tracked:
+                    continue
+
+                if handle in failed:
+                    # Typically an expired receipt handle; retrying will not help.
+                    self._tracked.pop(handle)
+                    self._lost.add(handle)
+                    self._extension_failures.inc()
+                else:
+                    self._tracked[handle] = now
+                    self._extensions.inc()
@@ -0,0 +1,198 @@
+import bisect
+import threading
+import traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Tuple
+
+from infra import logger
+
+# Process-local metrics; each metric is identified by its name and an optional set of labels.
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self):
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    @property
+    def value(self):
+        return self._value
+
+class Gauge:
+    kind = 'gauge'
+
+    def __init__(self):
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def set(self, value):
+        with self._lock:
+            self._value = value
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount=1):
+        with self._lock:
+            self._value -= amount
+
+    @property
+    def value(self):
+        return self._value
+
+# Latency buckets, in seconds; covers everything from DB queries to multi-step GPT-4 tool flows.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80)
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)    # last slot is +Inf
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    @property
+    def value(self):
+        # (buckets, per-bucket counts, sum); counts are not cumulative.
+        with self._lock:
+            return (self.buckets, tuple(self._counts), self._sum)
+
+_lock = threading.Lock()
+_metrics = {}   # type: Dict[Tuple[str, Tuple], object]
+
+def _key(name, labels):
+    return (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+
+def _get_or_create(cls, name, labels, *args):
+    key = _key(name, labels)
+
+    with _lock:
+        metric = _metrics.get(key)
+        if metric is None:
+            metric = cls(*args)
+            _metrics[key] = metric
+
+    return metric
+
+def counter(name: str, **labels) -> Counter:
+    return _get_or_create(Counter, name, labels)
+
+def gauge(name: str, **labels) -> Gauge:
+    return _get_or_create(Gauge, name, labels)
+
+def histogram(name: str, buckets=DEFAULT_BUCKETS, **labels) -> Histogram:
+    return _get_or_create(Histogram, name, labels, buckets)
+
+def remove(name: str, **labels) -> None:
+    with _lock:
+        _metrics.pop(_key(name, labels), None)
+
+def snapshot() -> Dict[Tuple[str, Tuple], Tuple[str, object]]:
+    # Plain, picklable values: (kind, value) per metric key.
+    with _lock:
+        items = list(_metrics.items())
+
+    return {key: (metric.kind, metric.value) for key, metric in items}
+
+def merge_snapshots(snapshots) -> Dict[Tuple[str, Tuple], Tuple[str, object]]:
+    # Sums metrics across processes; for gauges such as in-flight counts, that is the overall total.
+    merged = {}
+
+    for snap in snapshots:
+        for key, (kind, value) in snap.items():
+            if key not in merged:
+                merged[key] = (kind, value)
+                continue
+
+            if kind == 'histogram':
+                buckets, counts, total = merged[key][1]
+                merged[key] = (kind, (buckets, tuple(a + b for a, b in zip(counts, value[1])), total + value[2]))
+            else:
+                merged[key] = (kind, merged[key][1] + value)
+
+    return merged
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(labels, extra=()) -> str:
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in pairs) + '}'
+
+def render_prometheus(snap=None) -> str:
+    # Prometheus text exposition format, version 0.0.4.
+    snap = snapshot() if snap is None else snap
+
+    lines = []
+    typed = set()
+
+    for (name, labels), (kind, value) in sorted(snap.items(), key=lambda item: item[0]):
+        if name not in typed:
+            lines.append(f'# TYPE {name} {kind}')
+            typed.add(name)
+
+        if kind != 'histogram':
+            lines.append(f'{name}{_format_labels(labels)} {value}')
+            continue
+
+        buckets, counts, total = value
+        cumulative = 0
+
+        for bound, count in zip(list(buckets) + ['+Inf'], counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{_format_labels(labels, [("le", str(bound))])} {cumulative}')
+
+        lines.append(f'{name}_sum{_format_labels(labels)} {total}')
+        lines.append(f'{name}_count{_format_labels(labels)} {cumulative}')
+
+    return '\n'.join(lines) + '\n'
+
+def start_http_server(port: int, snapshot_fn=snapshot):
+    # Serves /metrics on localhost; snapshot_fn lets a prefork supervisor serve metrics merged from all workers.
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+
+            try:
+                body = render_prometheus(snapshot_fn()).encode('utf-8')
+            except Exception as e:
+                logger.logger.error(f'Exception occurred; {e}; stack trace: ', traceback.format_exc())
+                self.send_error(500)
+                return
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), MetricsHandler)
+
+    thread = threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True)
+    thread.start()
+
+    logger.logger.info(f'Serving metrics on http://127.0.0.1:{port}/metrics')
+
+    return server
@@ -0,0 +1,128 @@
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import traceback
+
+from infra import logger, metrics
+
+# How often workers report their metrics to the supervisor, and how often the supervisor logs the aggregate.
+STATS_REPORT_INTERVAL = 10
+STATS_LOG_INTERVAL = 60
+
+# Workers that stay up this long are considered healthy again, and restart backoff is reset.
+HEALTHY_UPTIME = 60
+MAX_RESTART_DELAY = 60
+
+def _report_stats(stats_queue, index):
+    while True:
+        time.sleep(STATS_REPORT_INTERVAL)
+
+        try:
+            stats_queue.put_nowait((index, os.getpid(), metrics.snapshot()))
+        except queue.Full:
+            pass
+
+def _worker_entry(worker_main, stats_queue, index):
+    logger.logger.info(f'[prefork] worker #{index} started, pid={os.getpid()}')
+
+    thread = threading.Thread(target=_report_stats, args=(stats_queue, index), daemon=True)
+    thread.start()
+
+    worker_main()
+
+# Runs worker_main in num_workers separate processes, restarting any that exit, and aggregates their metrics.
+#
+# Processes are started with 'spawn', so that workers never inherit locks held by supervisor threads
+# (e.g. the timer loop) or database connections opened by the supervisor.
+class PreforkSupervisor:
+    def __init__(self, num_workers: int, worker_main):
+        self.num_workers = num_workers
+        self.worker_main = worker_main
+
+        self._mp = multiprocessing.get_context('spawn')
+        self._stats_queue = self._mp.Queue(maxsize=num_workers * 10)
+
+        self._workers = [None] * num_workers        # process per slot
+        self._started_at = [0.0] * num_workers
+        self._restarts = [0] * num_workers
+        self._next_start = [0.0] * num_workers
+
+        self._lock = threading.Lock()
+        self._stats = {}        # slot -> latest metrics snapshot
+
+        self._restart_counter = metrics.counter('prefork_worker_restarts')
+
+    def run(self):
+        logger.logger.info(f'[prefork] starting {self.num_workers} worker processes...')
+
+        threading.Thread(target=self._collect_stats, daemon=True).start()
+        threading.Thread(target=self._log_stats, daemon=True).start()
+
+        try:
+            while True:
+                self._supervise()
+                time.sleep(1)
+        finally:
+            for process in self._workers:
+                if process and process.is_alive():
+                    process.terminate()
+
+    def _supervise(self):
+        now = time.time()
+
+        for index, process in enumerate(self._workers):
+            if process and process.is_alive():
+                if now - self._started_at[index] > HEALTHY_UPTIME:
+                    self._restarts[index] = 0
+                continue
+
+            if process:
+                logger.logger.error(f'[prefork] worker #{index} (pid={process.pid}) exited with code {process.exitcode}')
+
+                self._workers[index] = None
+                self._restarts[index] += 1
+                self._restart_counter.inc()
+                self._next_start[index] = now + min(2 ** self._restarts[index], MAX_RESTART_DELAY)
+
+                with self._lock:
+                    self._stats.pop(index, None)
+
+            if now < self._next_start[index]:
+                continue
+
+            process = self._mp.Process(target=_worker_entry, args=(self.worker_main, self._stats_queue, index), name=f'r1x-worker-{index}')
+            process.start()
+
+            self._workers[index] = process
+            self._started_at[index] = now
+
+    def _collect_stats(self):
+        while True:
+            try:
+                index, pid, snapshot = self._stats_queue.get()
+
+                with self._lock:
+                    self._stats[index] = snapshot
+            except Exception as e:
+                logger.logger.error(f'Exception occurred; {e}; stack trace: ', traceback.format_exc())
+
+    def aggregate(self):
+        with self._lock:
+            snapshots = list(self._stats.values())
+
+        return metrics.merge_snapshots(snapshots + [metrics.snapshot()])
+
+    def _log_stats(self):
+        while True:
+            time.sleep(STATS_LOG_INTERVAL)
+
+            alive = len([p for p in self._workers if p and p.is_alive()])
+            totals = self.aggregate()
+
+            # Histograms are too granular for a log line.
+            summary = ', '.join(f'{name}{dict(labels) if labels else ""}={value}' for (name, labels), (kind, value) in sorted(totals.items())
+                                if kind != 'histogram')
+
+            logger.logger.info(f'[prefork] workers alive={alive}/{self.num_workers}; {summary}')
@@ -6,6 +6,8 @@ from dotenv import load_dotenv
 from pydub import AudioSegment
 
 from infra.context import Context
+from infra.env import env_str
+from infra.executors import run_cpu_bound
 from infra.logger import logger
 
 def download_stream_file(ctx:Context, url, path, headers=None):
@@ -27,9 +29,12 @@ def download_stream_file(ctx:Context, url, path, headers=None):
 
     return is_successful
 
-def convert_audio_to_mp3(ctx:Context, orig_file_path:str, mp3_file_path:str) -> str:
+def _convert_audio_to_mp3_core(orig_file_path:str, mp3_file_path:str) -> None:
     audio = AudioSegment.from_file(orig_file_path)
     audio.export(mp3_file_path, format="mp3")
+
+def convert_audio_to_mp3(ctx:Context, orig_file_path:str, mp3_file_path:str) -> str:
+    run_cpu_bound(_convert_audio_to_mp3_core, orig_file_path, mp3_file_path)
     ctx.log("convertAudioToMp3 succeeded")
 
     return mp3_file_path
@@ -46,6 +51,10 @@ def load_env():
     if os.environ.get('DB_CONNECTION_STRING', '') == '':
         os.environ['DB_CONNECTION_STRING'] = 'sqlite:///file::memory:?cache=shared'
 
+        # Nothing runs migrations on it; tables are created on first use.
+        if env_str('DB_CREATE_ALL') is None:
+            os.environ['DB_CREATE_ALL'] = '1'
+
     local_dev_required_envs = ['OPENAI_API_KEY', 'TELEGRAM_BOT_TOKEN', 'TELEGRAM_BOT_NAME', 'SERPER_API_KEY']
     all_required_envs = local_dev_required_envs + ['AZURE_OPENAI_KEY', 'FACEBOOK_GRAPH_VERSION', 'WHATSAPP_BOT_TOKEN', 'WHATSAPP_PHONE_NUMBER_ID', 'WHATSAPP_PHONE_NUMBER', 'DB_CONNECTION_STRING', 'SQS_QUEUE_URL', 'DREAMSTUDIO_API_KEY', 'POSTHOG_API_KEY']
 
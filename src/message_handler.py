@@ -1,3 +1,4 @@
+import datetime
 import time
 import json
 import os
@@ -5,18 +6,22 @@ import pathlib
 import tempfile
 
 from posthog import Posthog
-from sqlalchemy import desc
-
+from box import Box
 from typing import Any, Dict
 
 from services.messengers import messenger_factory
 from services.messengers.messenger import MessagingService
+from services.messengers.streaming_reply import StreamingReply
 
 from services.open_ai.query_openai import get_chat_completion, get_chat_completion_with_tools, create_transcription
-import db_models
-from services.message_db import insert_message, get_message_history
+from services.message_db import insert_message, get_message_history, get_newer_incoming_messages
+from services import idempotency, write_behind
+from services.user_settings import get_user_settings
 import services.messengers as messengers
+from infra import metrics
 from infra.context import Context
+from infra.env import env_int
+from infra.executors import io_executor
 
 posthog_client = None
 if os.environ.get('POSTHOG_API_KEY', '') != '':
@@ -25,64 +30,110 @@ if os.environ.get('POSTHOG_API_KEY', '') != '':
         host='https://app.posthog.com'
     )
 
+# Messages arriving within this window of each other are answered once, over the merged history.
+# 0 disables coalescing; a per-user 'coalesce_window_ms' setting overrides the default.
+COALESCE_WINDOW_MS = env_int('COALESCE_WINDOW_MS', 0)
+
 def posthog_capture(distinct_id, event, properties):
     if posthog_client == None:
         return
 
     posthog_client.capture(distinct_id=distinct_id, event=event, properties=properties)
 
-def get_user_settings(parsed_message) -> Dict[str, Any]: 
-    user_id = f"{parsed_message.source}:{parsed_message.chatId}"
-    session = db_models.Session()
-
-    settings = session.query(db_models.UserSettings) \
-                .filter(db_models.UserSettings.user_id == user_id) \
-                .order_by(desc(db_models.UserSettings.createdAt)) \
-                .limit(1) \
-                .one_or_none()
-
-    session.close()
-
-    return getattr(settings, 'settings', {})
-
-
 def handle_incoming_message(ctx: Context, event):
     in_flight = {"working": True}
+    start = time.time()
 
     try:
         handle_incoming_message_core(ctx, event, in_flight)
+        metrics.counter('messages_processed', outcome='ok').inc()
     except Exception as error:
+        metrics.counter('messages_processed', outcome='error').inc()
         ctx.log("Message processing failed: ",error)
         raise Exception("Message processing failed.")
     finally:
         in_flight["working"] = False
+        metrics.histogram('message_processing_seconds').observe(time.time() - start)
+        ctx.log_spans()
 
 
 def handle_incoming_message_core(ctx:Context, event, in_flight):
     start = time.time()
-    parsed_event = json.loads(event)
-    ctx.log(parsed_event)
-    messenger = messenger_factory.make_messenger_from_event(parsed_event)
 
-    if messenger is None:
-        return
+    with ctx.span('event-parse'):
+        parsed_event = json.loads(event)
+        ctx.log(parsed_event)
+        messenger = messenger_factory.make_messenger_from_event(parsed_event)
+
+        if messenger is None:
+            return
 
-    parse_message_result = messenger.parse_message(parsed_event["event"])
-    parsed_message, file_info = parse_message_result
+        parse_message_result = messenger.parse_message(parsed_event["event"])
+        parsed_message, file_info = parse_message_result
 
-    messenger.set_status_read(ctx, parsed_message.messageId)
+    # The read receipt never blocks the reply.
+    io_executor.submit(set_status_read_nothrow, ctx, messenger, parsed_message.messageId)
 
-    ctx.user_settings = get_user_settings(parsed_message)
+    ctx.user_settings = ctx.traced('settings-lookup', get_user_settings, parsed_message)
     ctx.user_channel = ctx.user_settings.get('channel', 'stable')
 
     if not ctx.user_settings.get('enabled', False):
-        messenger.send_message(ctx, {
-            "chat_id": parsed_message["chatId"],
-            "kind": "text",
-            "body": "Robot 1-X is no longer accessible for free. If you require access, please send a WhatsApp message to +16692221028.\n\nIf you simply require ChatGPT on your smartphone, you can use https://play.google.com/store/apps/details?id=com.openai.chatgpt (Android) or https://apps.apple.com/us/app/chatgpt/id6448311069 (iPhone)."
-        })
+        send_disabled_message(ctx, messenger, parsed_message)
+        return
+
+    if parsed_message.isSentByMe:
+        handle_parsed_message(ctx, messenger, parsed_event, parsed_message, file_info, in_flight, start)
+        return
+
+    # Redelivered events must not reach any paid API again. Only messages that may reach one are claimed, so that
+    # messages of disabled users leave no record.
+    processing = ctx.traced('idempotency-check', idempotency.begin_processing, ctx, parsed_message)
+
+    if processing and processing.state == idempotency.ProcessingStateE.DONE:
+        ctx.log("message already processed; skipping.")
+        idempotency.count_hit('done')
         return
 
+    if processing and processing.state == idempotency.ProcessingStateE.REPLIED:
+        ctx.log("message already answered, but reply was not confirmed as sent; resending.")
+        idempotency.count_hit('resent')
+        send_and_store(ctx, messenger, processing.reply)
+        idempotency.mark_done(ctx, parsed_message)
+        return
+
+    try:
+        handle_parsed_message(ctx, messenger, parsed_event, parsed_message, file_info, in_flight, start)
+    except Exception:
+        release_claim_nothrow(ctx, parsed_message)
+        raise
+
+    idempotency.mark_done(ctx, parsed_message)
+
+def release_claim_nothrow(ctx:Context, parsed_message):
+    # The processing error is the one worth reporting; a claim left behind only delays the retry.
+    try:
+        idempotency.release(ctx, parsed_message)
+    except Exception as e:
+        ctx.log(f"idempotency release failed: {e}")
+
+def set_status_read_nothrow(ctx:Context, messenger, message_id):
+    try:
+        messenger.set_status_read(ctx, message_id)
+    except Exception as e:
+        ctx.log(f"set_status_read failed: {e}")
+
+def send_disabled_message(ctx:Context, messenger, parsed_message):
+    messenger.send_message(ctx, {
+        "chat_id": parsed_message["chatId"],
+        "kind": "text",
+        "body": "Robot 1-X is no longer accessible for free. If you require access, please send a WhatsApp message to +16692221028.\n\nIf you simply require ChatGPT on your smartphone, you can use https://play.google.com/store/apps/details?id=com.openai.chatgpt (Android) or https://apps.apple.com/us/app/chatgpt/id6448311069 (iPhone)."
+    })
+
+def handle_parsed_message(ctx:Context, messenger, parsed_event, parsed_message, file_info, in_flight, start):
+    # Pre-completion steps run as a small dependency graph, once user settings were looked up:
+    #
+    #   insert message ----+--> history merge
+    #   history prefetch --+
     is_typing = False
 
     if parsed_message.kind == "voice":
@@ -92,7 +143,18 @@ def handle_incoming_message_core(ctx:Context, event, in_flight):
         if parsed_message.isForwarded:
             return
 
-    message = insert_message(ctx, parsed_message)
+    insert_future = io_executor.submit(ctx.traced, 'db-insert', insert_message, ctx, parsed_message)
+
+    # History is fetched in parallel with the insert only when it will certainly be needed and can't go stale:
+    # private chats are always addressed to the bot, and burst coalescing may wait for later messages.
+    history_future = None
+    if parsed_message.chatType == 'private' and parsed_message.body is not None and not is_coalescing_enabled(ctx):
+        history_future = io_executor.submit(ctx.traced, 'history-fetch', get_message_history, ctx, Box({
+            'chatId': parsed_message.chatId,
+            'messageTimestamp': datetime.datetime.fromtimestamp(parsed_message.messageTimestamp, tz=datetime.timezone.utc)
+        }))
+
+    message = insert_future.result()
 
     if message.isSentByMe or message.body is None:
         return
@@ -104,7 +166,23 @@ def handle_incoming_message_core(ctx:Context, event, in_flight):
         messenger.set_typing(in_flight)
         is_typing = True
 
-    message_history = get_message_history(ctx, message)
+    if is_superseded_by_burst(ctx, messenger, message, parsed_message.messageTimestamp):
+        ctx.log("message superseded by a later message in the same chat; not replying.")
+        ctx.set_stat('coalesced', True)
+
+        posthog_capture(
+            distinct_id = f'{parsed_message.source}:{parsed_message.chatId}',
+            event = 'message-coalesced',
+            properties = { 'senderId': parsed_message.senderId, 'channel': ctx.user_channel }
+        )
+
+        return
+
+    if history_future:
+        message_history = merge_into_history(history_future.result(), message)
+    else:
+        message_history = ctx.traced('history-fetch', get_message_history, ctx, message)
+
     ctx.log("message history pulled.")
 
     if len(message_history) <= 1:
@@ -113,19 +191,41 @@ def handle_incoming_message_core(ctx:Context, event, in_flight):
         return
 
     ctx.log("calling get_chat_completion...")
+    ctx.set_stat('time_to_completion_request_ms', int((time.time() - start) * 1000))
+    metrics.histogram('time_to_completion_request_seconds').observe(time.time() - start)
+
+    # Streamed replies are shown while being generated, by editing a first partial message.
+    streaming_reply = None
+    if is_streaming_enabled(ctx) and messenger.supports_edits:
+        streaming_reply = StreamingReply(ctx, messenger, parsed_message.chatId, parsed_message.messageTimestamp)
+        ctx.set_stat('streaming', True)
+
     messenger_name = "WhatsApp" if parsed_event["source"] == "wa" else "Telegram"
-    completion = get_chat_completion_with_tools(ctx, messenger_name, message_history, direct=False)
+    completion = get_chat_completion_with_tools(ctx, messenger_name, message_history, direct=False,
+                                                on_answer=streaming_reply.update if streaming_reply else None)
 
     ctx.log({"completion": completion})
     ctx.log("get_chat_completion done, result is ", completion.response)
 
-    send_and_store(ctx, messenger, {
+    reply_attributes = {
         'chat_id': parsed_message.chatId,
         'kind': "text",
         'body': completion.response
-    })
+    }
+
+    idempotency.record_reply(ctx, parsed_message, reply_attributes)
+
+    if streaming_reply:
+        response = ctx.traced('send', streaming_reply.finish, completion.response)
+        stored_reply = ctx.traced('db-insert-reply', write_behind.store_reply, ctx, response) if response else None
+    else:
+        stored_reply = send_and_store(ctx, messenger, reply_attributes)
 
     response_time_ms = int((time.time() - parsed_message.messageTimestamp) * 1000)
+
+    if 'time_to_first_visible_token_ms' not in ctx.stats:
+        ctx.set_stat('time_to_first_visible_token_ms', response_time_ms)
+        metrics.histogram('time_to_first_visible_token_seconds', streaming='false').observe(response_time_ms / 1000)
     processing_time_ms = int((time.time() - start) * 1000)
     completion_tokens_per_sec = completion.completionTokens / (processing_time_ms / 1000)
 
@@ -137,11 +237,14 @@ def handle_incoming_message_core(ctx:Context, event, in_flight):
     ctx.set_stat('response_time_ms', response_time_ms)
     ctx.set_stat('processing_time_ms', processing_time_ms)
 
+    metrics.histogram('reply_response_seconds', channel=ctx.user_channel).observe(response_time_ms / 1000)
+
     ph_props = {
             'senderId': parsed_message.senderId,
     }
 
     ph_props.update(ctx.stats)
+    ph_props.update(ctx.span_properties())
 
     posthog_capture(
         distinct_id = f'{parsed_message.source}:{parsed_message.chatId}',
@@ -149,6 +252,73 @@ def handle_incoming_message_core(ctx:Context, event, in_flight):
         properties = ph_props
     )
 
+    write_behind.store_event('reply-sent', stored_reply, ph_props)
+
+def merge_into_history(message_history, message, limit=20):
+    # A history fetched concurrently with the insert may or may not include the new message.
+    if any(m.messageId == message.messageId for m in message_history):
+        return message_history
+
+    return (message_history + [message])[-limit:]
+
+def get_coalesce_window_ms(ctx:Context) -> int:
+    return int(ctx.user_settings.get('coalesce_window_ms', COALESCE_WINDOW_MS))
+
+def is_coalescing_enabled(ctx:Context) -> bool:
+    return get_coalesce_window_ms(ctx) > 0
+
+def is_streaming_enabled(ctx:Context) -> bool:
+    # Set with tools/user_settings.py, which stores values as strings.
+    return str(ctx.user_settings.get('streaming', False)).lower() in ('1', 'true', 'yes')
+
+def is_superseded_by_burst(ctx:Context, messenger, message, message_timestamp) -> bool:
+    window_ms = get_coalesce_window_ms(ctx)
+    if window_ms <= 0:
+        return False
+
+    # The window starts when the message was sent, so time spent queued counts towards it.
+    remaining = window_ms / 1000 - (time.time() - message_timestamp)
+    if remaining > 0:
+        time.sleep(remaining)
+
+    # A later message supersedes this one only if it will be answered itself: its handler then answers over a history
+    # that already includes this message. Otherwise, e.g. a sticker, or a group message not addressed to the bot, nobody
+    # would reply.
+    #
+    # Later messages either wait behind this one in our dispatcher, or were already stored.
+    if any(will_be_answered(messenger, queued_message) for queued_message in parse_queued_messages(ctx)):
+        return True
+
+    return any(messenger.is_message_for_me(newer_message) for newer_message in get_newer_incoming_messages(ctx, message))
+
+def parse_queued_messages(ctx:Context):
+    for event in ctx.queued_in_chat():
+        try:
+            parsed_event = json.loads(event)
+            messenger = messenger_factory.make_messenger_from_event(parsed_event)
+            parse_message_result = messenger.parse_message(parsed_event["event"]) if messenger else None
+        except Exception as e:
+            ctx.log(f"failed parsing queued message: {e}")
+            continue
+
+        # Events that aren't messages, e.g. WhatsApp status updates.
+        if parse_message_result is None:
+            continue
+
+        parsed_message, file_info = parse_message_result
+        yield parsed_message
+
+def will_be_answered(messenger, parsed_message) -> bool:
+    # Mirrors the early returns of handle_parsed_message, for a message that wasn't handled yet.
+    if parsed_message.isSentByMe:
+        return False
+
+    # Voice messages are answered once transcribed; forwarded ones only get their transcript.
+    if parsed_message.kind == "voice":
+        return parsed_message.chatType == 'private' and not parsed_message.isForwarded
+
+    return parsed_message.body is not None and messenger.is_message_for_me(parsed_message)
+
 def handle_audio_message(ctx, messenger, parsed_message, file_info, in_flight):
     messenger.set_typing(in_flight)
 
@@ -231,13 +401,17 @@ def get_transcript(ctx:Context, messenger, parsed_message, file_info):
     audio_root.mkdir(exist_ok=True)
 
     with tempfile.TemporaryDirectory(dir=audio_root, ignore_cleanup_errors=True) as workdir:
-        mp3_file_path = messenger.get_voice_mp3_file(ctx, parsed_message, file_info, pathlib.Path(workdir))
-        transcription = create_transcription(ctx, mp3_file_path)
+        with ctx.span('audio-download'):
+            mp3_file_path = messenger.get_voice_mp3_file(ctx, parsed_message, file_info, pathlib.Path(workdir))
+
+        transcription = ctx.traced('transcription', create_transcription, ctx, mp3_file_path)
 
         return transcription
 
 def send_and_store(ctx: Context, messenger: MessagingService, message_attributes):
-    response = messenger.send_message(ctx, message_attributes)
+    response = ctx.traced('send', messenger.send_message, ctx, message_attributes)
+
+    if not response:
+        return None
 
-    if response:
-        insert_message(ctx, response)
+    return ctx.traced('db-insert-reply', write_behind.store_reply, ctx, response)
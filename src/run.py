@@ -1,13 +1,23 @@
 #!/usr/bin/python3
 
+import functools
 import json
 import os
+import time
 
-import boto3
 from services.timers import alert_users
 
-from infra import logger
+from infra import logger, metrics
+from infra.acker import QueueAcker
+from infra.autoscaler import Autoscaler, ConsumerLoad
 from infra.context import Context
+from infra.dispatcher import ChatDispatcher
+from infra.env import env_bool, env_float, env_int, env_str
+from infra.heartbeat import VisibilityHeartbeat
+from infra.prefork import PreforkSupervisor
+from services import history_cache, idempotency, message_db, write_behind
+from services.messengers import messenger_factory
+from services.queues import queue_factory
 
 import message_handler
 
@@ -19,53 +29,287 @@ from telegram.ext import Application, CommandHandler, ContextTypes, MessageHandl
 
 NUM_CONSUMERS = 10
 
-QUEUE_URL = os.environ["SQS_QUEUE_URL"]
+# SQS returns at most 10 messages per receive call.
+MAX_BATCH_SIZE = 10
 
-def process_message(message):
+# Batch size of 1 keeps the original one-message-per-thread consumers.
+SQS_BATCH_SIZE = min(env_int('SQS_BATCH_SIZE', 1), MAX_BATCH_SIZE)
+SQS_NUM_POLLERS = env_int('SQS_NUM_POLLERS', 2)
+
+# Autoscaling adjusts the number of consumer threads (or batched-mode workers) within these bounds.
+AUTOSCALE = env_bool('R1X_AUTOSCALE')
+AUTOSCALE_MIN_CONSUMERS = env_int('AUTOSCALE_MIN_CONSUMERS', 2)
+AUTOSCALE_MAX_CONSUMERS = env_int('AUTOSCALE_MAX_CONSUMERS', 50)
+AUTOSCALE_TARGET_QUEUE_AGE = env_float('AUTOSCALE_TARGET_QUEUE_AGE', 5)
+
+consumer_load = ConsumerLoad()
+
+# Number of consumer processes; 0 runs consumers in this process. Only the supervisor runs the timer loop.
+PREFORK_WORKERS = env_int('R1X_PREFORK_WORKERS', 0)
+
+# Local port serving Prometheus metrics; unset disables the endpoint.
+METRICS_PORT = env_int('METRICS_PORT', 0)
+
+# Visibility timeout applied, and periodically re-applied, to messages held by this process.
+SQS_VISIBILITY_TIMEOUT = env_int('SQS_VISIBILITY_TIMEOUT', 60)
+
+def process_message(message, queued_in_chat=None):
     ctx = Context()
+
+    if queued_in_chat:
+        ctx.queued_in_chat = queued_in_chat
+
     result = message_handler.handle_incoming_message(ctx, message['Body'])
     ctx.log("Finished handling message")
 
-def single_sqs_handler(queue):
-    while True:
+def process_message_with_heartbeat(message, heartbeat, queued_in_chat=None):
+    # Processed messages stay tracked until they are deleted; failed ones are released, and become visible again once
+    # their visibility timeout expires.
+    start = time.time()
+    consumer_load.observe_start()
+
+    try:
+        process_message(message, queued_in_chat)
+    except BaseException:
+        heartbeat.untrack(message)
+        raise
+    finally:
+        consumer_load.observe_done(time.time() - start)
+
+def receive_messages(queue, max_messages):
+    messages = queue.receive_messages(max_messages, 20)
+
+    if len(messages) == 0:
+        consumer_load.observe_empty_receive()
+
+    for message in messages:
+        consumer_load.observe_received(message)
+
+    return messages
+
+def make_heartbeat():
+    return VisibilityHeartbeat(queue_factory.make_queue(), SQS_VISIBILITY_TIMEOUT)
+
+def get_shard_key(message):
+    # Prefer the FIFO message group, so ordering decisions match SQS's own.
+    group_id = message.get('Attributes', {}).get('MessageGroupId')
+    if group_id:
+        return group_id
+
+    try:
+        chat_key = messenger_factory.get_messenger_chat_id_from_event(json.loads(message['Body']))
+    except Exception:
+        chat_key = None
+
+    # Events that don't belong to a chat (e.g. WhatsApp status updates) need no ordering.
+    return chat_key or message['MessageId']
+
+def dispatch(dispatcher, heartbeat, message):
+    key = get_shard_key(message)
+    return dispatcher.submit(key, process_message_with_heartbeat, message, heartbeat, functools.partial(get_queued_events, dispatcher, key))
+
+def get_queued_events(dispatcher, key):
+    # Work items take their queue message as first argument.
+    return [args[0]['Body'] for args in dispatcher.queued_args(key)]
+
+def single_sqs_handler(queue, heartbeat, stop_event):
+    while not stop_event.is_set():
         try:
-            single_sqs_handler_core(queue)
+            single_sqs_handler_core(queue, heartbeat)
         except Exception as e:
             logger.logger.error(f'Exception occurred; {e}; stack trace: ', traceback.format_exc())
 
-def single_sqs_handler_core(queue):
-    response = queue.receive_message(QueueUrl=QUEUE_URL, MaxNumberOfMessages=1, WaitTimeSeconds=20)
+def single_sqs_handler_core(queue, heartbeat):
+    messages = receive_messages(queue, 1)
 
-    if not 'Messages' in response:
+    if len(messages) == 0:
        return
 
     # Single message each time
-    message = response['Messages'][0]
+    message = messages[0]
 
-    process_message(message)
+    heartbeat.track(message)
+    process_message_with_heartbeat(message, heartbeat)
 
-    queue.delete_message(QueueUrl=QUEUE_URL, ReceiptHandle=message['ReceiptHandle'])
+    heartbeat.untrack(message)
+    delete_messages(queue, [message])
 
-def launch_sqs_threads():
-    logger.logger.info(f'Listening on {NUM_CONSUMERS} queues...')
+class ReceiveBudget:
+    # Bounds the number of messages held by this process, from receipt until processed.
+    #
+    # Pollers don't wait for their batch to complete, so without a bound they would keep receiving while workers are
+    # busy, and hold messages (and their visibility) that other consumers could be processing.
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.held = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, max_count):
+        # Blocks until at least one message may be received; returns how many may be.
+        with self._cond:
+            while self.held >= self.capacity:
+                self._cond.wait()
+
+            count = min(max_count, self.capacity - self.held)
+            self.held += count
+
+            return count
+
+    def release(self, count=1):
+        if count <= 0:
+            return
+
+        with self._cond:
+            self.held -= count
+            self._cond.notify_all()
+
+    def set_capacity(self, capacity):
+        # Messages already held beyond a lowered capacity are processed; pollers wait until they drain.
+        with self._cond:
+            self.capacity = capacity
+            self._cond.notify_all()
+
+def batched_sqs_handler(queue, dispatcher, heartbeat, acker, budget):
+    while True:
+        try:
+            batched_sqs_handler_core(queue, dispatcher, heartbeat, acker, budget)
+        except Exception as e:
+            logger.logger.error(f'Exception occurred; {e}; stack trace: ', traceback.format_exc())
+
+def batched_sqs_handler_core(queue, dispatcher, heartbeat, acker, budget):
+    max_messages = budget.acquire(SQS_BATCH_SIZE)
+
+    try:
+        messages = receive_messages(queue, max_messages)
+    except BaseException:
+        budget.release(max_messages)
+        raise
+
+    budget.release(max_messages - len(messages))
+
+    # Messages are tracked from receipt, since they may wait behind earlier messages of the same chat.
+    # Each is acknowledged as soon as it completes; the poller goes straight back to receiving.
+    for message in messages:
+        heartbeat.track(message)
+        future = dispatch(dispatcher, heartbeat, message)
+        future.add_done_callback(functools.partial(on_batched_message_done, acker, budget, message))
+
+def on_batched_message_done(acker, budget, message, future):
+    budget.release()
+
+    error = future.exception()
+    if error is None:
+        acker.ack(message)
+    else:
+        # Failed messages are not acknowledged, and become visible again once their visibility timeout expires.
+        logger.logger.error(f'Message {message["MessageId"]} failed; {error}')
+
+def delete_messages(queue, messages):
+    if len(messages) == 0:
+        return
+
+    for receipt_handle in queue.delete_messages([message['ReceiptHandle'] for message in messages]):
+        logger.logger.error(f'Failed deleting message; receipt handle={receipt_handle}')
+
+def launch_batched_sqs_threads():
+    logger.logger.info(f'Listening with {SQS_NUM_POLLERS} pollers, batch size {SQS_BATCH_SIZE}, {NUM_CONSUMERS} workers...')
+
+    # Workers are shared between pollers, so a slow message does not starve a whole batch of its own.
+    # Messages of the same chat are processed in order; different chats run in parallel.
+    dispatcher = ChatDispatcher(NUM_CONSUMERS, name='sqs')
+    heartbeat = make_heartbeat()
+    acker = QueueAcker(queue_factory.make_queue(), heartbeat)
+
+    # Enough to keep every worker busy, plus one batch received ahead.
+    budget = ReceiveBudget(get_receive_capacity(NUM_CONSUMERS))
 
     threads = []
-  
-    for i in range(NUM_CONSUMERS):
-        queue = boto3.client('sqs', region_name='eu-central-1')
-        thread = threading.Thread(target=single_sqs_handler, args=(queue,))
+
+    for i in range(SQS_NUM_POLLERS):
+        queue = queue_factory.make_queue()
+        thread = threading.Thread(target=batched_sqs_handler, args=(queue, dispatcher, heartbeat, acker, budget))
         thread.start()
         threads.append(thread)
 
+    if AUTOSCALE:
+        # Workers only help if pollers receive enough to keep them busy, so both scale together.
+        def scale(num_workers):
+            dispatcher.set_num_workers(num_workers)
+            budget.set_capacity(get_receive_capacity(num_workers))
+
+        threads.append(launch_autoscaler(scale, NUM_CONSUMERS))
+
+    return threads
+
+def get_receive_capacity(num_workers):
+    return num_workers + SQS_BATCH_SIZE
+
+class ConsumerPool:
+    def __init__(self, heartbeat):
+        self.heartbeat = heartbeat
+        self.consumers = []     # (thread, stop event)
+
+    def set_num_consumers(self, num_consumers):
+        while len(self.consumers) < num_consumers:
+            stop_event = threading.Event()
+            thread = threading.Thread(target=single_sqs_handler, args=(queue_factory.make_queue(), self.heartbeat, stop_event))
+            thread.start()
+            self.consumers.append((thread, stop_event))
+
+        # Stopped consumers finish their current poll and message before exiting.
+        while len(self.consumers) > num_consumers:
+            thread, stop_event = self.consumers.pop()
+            stop_event.set()
+
+def launch_sqs_threads():
+    logger.logger.info(f'Listening on {NUM_CONSUMERS} queues...')
+
+    pool = ConsumerPool(make_heartbeat())
+    pool.set_num_consumers(NUM_CONSUMERS)
+
+    threads = [thread for thread, stop_event in pool.consumers]
+
+    if AUTOSCALE:
+        threads.append(launch_autoscaler(pool.set_num_consumers, NUM_CONSUMERS))
+
     return threads
 
+def launch_autoscaler(scale_fn, capacity):
+    logger.logger.info(f'Autoscaling consumers between {AUTOSCALE_MIN_CONSUMERS} and {AUTOSCALE_MAX_CONSUMERS}...')
+
+    autoscaler = Autoscaler(consumer_load, scale_fn, capacity, AUTOSCALE_MIN_CONSUMERS, AUTOSCALE_MAX_CONSUMERS, AUTOSCALE_TARGET_QUEUE_AGE)
+
+    thread = threading.Thread(target=autoscaler.run)
+    thread.start()
+
+    return thread
+
+def launch_sqs_consumers():
+    logger.logger.info(f'Using {queue_factory.get_queue_backend()} queue backend.')
+
+    if SQS_BATCH_SIZE > 1:
+        return launch_batched_sqs_threads()
+
+    return launch_sqs_threads()
+
+# Local mode hands messages off to worker threads, so the python-telegram-bot event loop never blocks on a reply.
+LOCAL_NUM_WORKERS = env_int('LOCAL_NUM_WORKERS', NUM_CONSUMERS)
+
+local_dispatcher = None
+
 async def handle_local_incoming_telegram_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     message = { 'Body' : json.dumps({ 'source' : 'tg', 'event' : json.loads(update.to_json()) }) }
-    ctx = Context()
 
-    process_message(message)
+    # Same chat key as the SQS consumers use, so per-chat ordering is identical in both modes.
+    key = f'tg:{update.effective_chat.id}'
+
+    # Failures are logged by the dispatcher; there is no queue to return the message to.
+    local_dispatcher.submit(key, process_message, message, functools.partial(get_queued_events, local_dispatcher, key))
 
 def launch_local_telegram_listener():
+    global local_dispatcher
+    local_dispatcher = ChatDispatcher(LOCAL_NUM_WORKERS, name='local')
+
     # Create the Application and pass it your bot's token.
     application = Application.builder().token(os.environ['TELEGRAM_BOT_TOKEN']).build()
 
@@ -79,6 +323,26 @@ def launch_local_telegram_listener():
     # Threads to wait on; never reached
     return []
 
+def prefork_worker_main():
+    # Entry point of each prefork worker process.
+    # Workers share the queue, so any of them may store a chat's next turn; this also leaves write-behind off.
+    history_cache.set_exclusive(False)
+
+    for thread in launch_sqs_consumers():
+        thread.join()
+
+def launch_prefork_supervisor():
+    supervisor = PreforkSupervisor(PREFORK_WORKERS, prefork_worker_main)
+
+    # Workers report to the supervisor, which serves the merged view.
+    if METRICS_PORT:
+        metrics.start_http_server(METRICS_PORT, supervisor.aggregate)
+
+    thread = threading.Thread(target=supervisor.run)
+    thread.start()
+
+    return [thread]
+
 def main():
     threads = []
 
@@ -86,9 +350,34 @@ def main():
     timer_thread.start()
     threads.append(timer_thread)
 
-    if os.environ['R1X_STAGE'] in ['dev', 'prod']:
-        threads = launch_sqs_threads()
+    if message_db.RAW_SOURCE_RETENTION_DAYS:
+        threading.Thread(target=message_db.purge_raw_sources_loop, name='raw-source-retention', daemon=True).start()
+
+    threading.Thread(target=idempotency.purge_processed_messages_loop, name='idempotency-retention', daemon=True).start()
+
+    # An explicit queue backend (e.g. memory/sqlite for offline load tests) runs the production consumers in any stage.
+    # The memory backend is per-process, and cannot be combined with prefork workers.
+    if os.environ['R1X_STAGE'] in ['dev', 'prod'] or env_str('R1X_QUEUE_BACKEND') is not None:
+        if PREFORK_WORKERS > 0:
+            threads = launch_prefork_supervisor()
+        else:
+            if METRICS_PORT:
+                metrics.start_http_server(METRICS_PORT)
+
+            # The in-memory queue is only consumed by this process.
+            if queue_factory.get_queue_backend() == 'memory':
+                history_cache.set_exclusive(True)
+
+            write_behind.start()
+
+            threads = launch_sqs_consumers()
     else:
+        if METRICS_PORT:
+            metrics.start_http_server(METRICS_PORT)
+
+        history_cache.set_exclusive(True)
+        write_behind.start()
+
         threads = launch_local_telegram_listener()
 
     for thread in threads:
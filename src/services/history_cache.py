@@ -0,0 +1,221 @@
+import collections
+import datetime
+import sys
+import threading
+import time
+from typing import List, NamedTuple, Optional
+
+from infra import metrics
+from infra.env import env_bool, env_int
+
+# Recent turns of active chats, kept in-process so that replies don't reload history that this process just wrote.
+#
+# Each chat has a ring buffer of its latest messages; chats are evicted in LRU order, bounded by count and by
+# estimated memory. The cache is only authoritative while this process is the sole writer of a chat's messages:
+# with several consumers (prefork workers, multiple hosts), any of them may store a turn, and history is read
+# from the database instead.
+HISTORY_CACHE_TURNS = env_int('HISTORY_CACHE_TURNS', 20)
+HISTORY_CACHE_MAX_CHATS = env_int('HISTORY_CACHE_MAX_CHATS', 5000)
+HISTORY_CACHE_MAX_BYTES = env_int('HISTORY_CACHE_MAX_BYTES', 64 * 1024 * 1024)
+
+# Chats idle for this long may have been served by another consumer in the meantime (e.g. after a restart).
+HISTORY_CACHE_IDLE_SECONDS = env_int('HISTORY_CACHE_IDLE_SECONDS', 300)
+
+# Set when this process is known to be the only consumer; see set_exclusive().
+HISTORY_CACHE_EXCLUSIVE = env_bool('HISTORY_CACHE_EXCLUSIVE')
+
+# Rough per-message overhead of the tuple, its fields and the ring buffer slot.
+MESSAGE_OVERHEAD_BYTES = 400
+
+# Fields used by the prompt builder and tools (e.g. alerts quote the latest message).
+class HistoryMessage(NamedTuple):
+    id: int
+    source: str
+    chatId: str
+    messageId: str
+    messageTimestamp: datetime.datetime
+    createdAt: datetime.datetime
+    isSentByMe: bool
+    body: Optional[str]
+    tokenCount: Optional[int]
+
+def to_history_message(message) -> HistoryMessage:
+    return HistoryMessage(message.id, message.source, message.chatId, message.messageId, as_utc(message.messageTimestamp),
+                          message.createdAt, message.isSentByMe, message.body, message.tokenCount)
+
+def as_utc(timestamp: datetime.datetime) -> datetime.datetime:
+    # SQLite drops timezone information.
+    return timestamp.replace(tzinfo=datetime.timezone.utc) if timestamp.tzinfo is None else timestamp
+
+def select_history(messages: List[HistoryMessage], before: datetime.datetime, limit: int) -> List[HistoryMessage]:
+    before = as_utc(before)
+    return [m for m in messages if m.messageTimestamp <= before][-limit:]
+
+def _message_size(message: HistoryMessage) -> int:
+    return MESSAGE_OVERHEAD_BYTES + (sys.getsizeof(message.body) if message.body is not None else 0)
+
+class _ChatHistory:
+    def __init__(self, messages: List[HistoryMessage], capacity: int):
+        self.messages = collections.deque(messages, maxlen=capacity)
+        self.size = sum(_message_size(m) for m in self.messages)
+        self.last_used = time.time()
+
+        # True while the buffer holds the chat's entire history, i.e. nothing older exists in the database.
+        self.complete = len(messages) < capacity
+
+class HistoryCache:
+    def __init__(self, name: str, turns: int, max_chats: int, max_bytes: int, idle_seconds: float, exclusive: bool):
+        self.turns = turns
+        self.max_chats = max_chats
+        self.max_bytes = max_bytes
+        self.idle_seconds = idle_seconds
+        self.exclusive = exclusive
+
+        self._lock = threading.Lock()
+        self._chats = collections.OrderedDict()         # chat_id -> _ChatHistory
+        self._bytes = 0
+
+        # Write sequence per chat, so that a history load racing with an insert doesn't cache a stale snapshot.
+        self._sequence = 0
+        self._last_write = collections.OrderedDict()    # chat_id -> sequence of the latest write
+
+        self._hit_count = 0
+        self._miss_count = 0
+
+        self._hits = metrics.counter('cache_hits', cache=name)
+        self._misses = metrics.counter('cache_misses', cache=name)
+        self._hit_rate = metrics.gauge('cache_hit_rate', cache=name)
+        self._size = metrics.gauge('cache_entries', cache=name)
+        self._memory = metrics.gauge('cache_bytes', cache=name)
+
+    def get(self, chat_id: str, before: datetime.datetime, limit: int) -> Optional[List[HistoryMessage]]:
+        # Returns the latest `limit` messages sent up to `before`, or None if the database must be queried.
+        if not self.exclusive:
+            return None
+
+        now = time.time()
+
+        with self._lock:
+            entry = self._chats.get(chat_id)
+
+            if entry is not None and now - entry.last_used > self.idle_seconds:
+                self._drop(chat_id)
+                entry = None
+
+            result = None
+
+            if entry is not None:
+                messages = select_history(entry.messages, before, limit)
+
+                if len(messages) == limit or entry.complete:
+                    entry.last_used = now
+                    self._chats.move_to_end(chat_id)
+                    result = messages
+
+            self._count(result is not None)
+
+        return result
+
+    def begin_load(self) -> int:
+        with self._lock:
+            return self._sequence
+
+    def store(self, chat_id: str, messages: List[HistoryMessage], load_sequence: int) -> None:
+        # Caches history loaded from the database; messages are the chat's latest, in chronological order.
+        if not self.exclusive or len(messages) > self.turns:
+            return
+
+        with self._lock:
+            if self._last_write.get(chat_id, 0) > load_sequence:
+                return
+
+            self._drop(chat_id)
+
+            entry = _ChatHistory(messages, self.turns)
+            self._chats[chat_id] = entry
+            self._bytes += entry.size
+
+            self._evict()
+
+    def append(self, chat_id: str, message: HistoryMessage) -> None:
+        # Write-through of a newly stored message; chats not cached are loaded on their next read.
+        with self._lock:
+            self._record_write(chat_id)
+
+            entry = self._chats.get(chat_id)
+            if entry is None:
+                return
+
+            if len(entry.messages) == entry.messages.maxlen:
+                dropped_size = _message_size(entry.messages[0])
+                entry.size -= dropped_size
+                self._bytes -= dropped_size
+                entry.complete = False
+
+            entry.messages.append(message)
+            entry.size += _message_size(message)
+            self._bytes += _message_size(message)
+
+            # Concurrent inserts (e.g. a reply and the next incoming message) may complete out of order.
+            if len(entry.messages) > 1 and entry.messages[-2].createdAt > message.createdAt:
+                entry.messages = collections.deque(sorted(entry.messages, key=lambda m: (m.createdAt, m.id)), maxlen=self.turns)
+
+            self._evict()
+
+    def invalidate(self, chat_id: str) -> None:
+        # Called when another writer is detected, e.g. a message was already stored by someone else.
+        with self._lock:
+            self._record_write(chat_id)
+            self._drop(chat_id)
+            self._update_gauges()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._chats.clear()
+            self._bytes = 0
+            self._update_gauges()
+
+    def _record_write(self, chat_id: str) -> None:
+        self._sequence += 1
+        self._last_write[chat_id] = self._sequence
+        self._last_write.move_to_end(chat_id)
+
+        while len(self._last_write) > self.max_chats:
+            self._last_write.popitem(last=False)
+
+    def _drop(self, chat_id: str) -> None:
+        entry = self._chats.pop(chat_id, None)
+        if entry is not None:
+            self._bytes -= entry.size
+
+    def _evict(self) -> None:
+        while self._chats and (len(self._chats) > self.max_chats or self._bytes > self.max_bytes):
+            _, entry = self._chats.popitem(last=False)
+            self._bytes -= entry.size
+
+        self._update_gauges()
+
+    def _count(self, hit: bool) -> None:
+        if hit:
+            self._hit_count += 1
+            self._hits.inc()
+        else:
+            self._miss_count += 1
+            self._misses.inc()
+
+        self._hit_rate.set(self._hit_count / (self._hit_count + self._miss_count))
+
+    def _update_gauges(self) -> None:
+        self._size.set(len(self._chats))
+        self._memory.set(self._bytes)
+
+history_cache = HistoryCache('message_history', HISTORY_CACHE_TURNS, HISTORY_CACHE_MAX_CHATS, HISTORY_CACHE_MAX_BYTES,
+                             HISTORY_CACHE_IDLE_SECONDS, HISTORY_CACHE_EXCLUSIVE)
+
+def set_exclusive(exclusive: bool) -> None:
+    # Called at startup by the consumer mode in use; a process sharing its queue with other consumers must not
+    # serve history from memory.
+    history_cache.exclusive = exclusive
+
+    if not exclusive:
+        history_cache.clear()
@@ -0,0 +1,133 @@
+import datetime
+import time
+import traceback
+from typing import Optional
+
+from box import Box
+from sqlalchemy import and_
+from sqlalchemy.exc import IntegrityError
+
+import db_models
+from infra import logger, metrics
+from infra.context import Context
+from infra.env import env_int
+
+# Tracks processing of each incoming message, so that redelivered events (SQS at-least-once delivery,
+# WhatsApp webhook retries) never reach a paid API twice.
+#
+# processing: a consumer picked the message up. An attempt that fails releases its claim; only a crashed consumer
+#             leaves the record behind.
+# replied:    a reply was generated and is about to be sent; the reply is kept for resending.
+# done:       processing completed, including sending any reply.
+
+class ProcessingStateE:
+    PROCESSING = 'processing'
+    REPLIED = 'replied'
+    DONE = 'done'
+
+# A message still marked as processing after this long is assumed to belong to a crashed consumer, and is retried.
+IN_PROGRESS_TIMEOUT_SECONDS = env_int('IDEMPOTENCY_IN_PROGRESS_TIMEOUT', 120)
+
+# Completed records are kept this many days; the default matches SQS's default message retention period, after which
+# an event can no longer be redelivered.
+RETENTION_DAYS = env_int('IDEMPOTENCY_RETENTION_DAYS', 4)
+
+class MessageInProgressError(Exception):
+    pass
+
+def _filter(parsed_message):
+    return and_(db_models.ProcessedMessage.source == parsed_message.source,
+                db_models.ProcessedMessage.chat_id == parsed_message.chatId,
+                db_models.ProcessedMessage.message_id == parsed_message.messageId)
+
+def begin_processing(ctx:Context, parsed_message) -> Optional[Box]:
+    # Returns None if this is the first time the message is seen; otherwise, the existing record.
+    now = datetime.datetime.now(datetime.timezone.utc)
+
+    with db_models.Session() as session:
+        record = db_models.ProcessedMessage(
+            source=parsed_message.source,
+            chat_id=parsed_message.chatId,
+            message_id=parsed_message.messageId,
+            state=ProcessingStateE.PROCESSING,
+            created_at=now,
+            updated_at=now
+        )
+
+        session.add(record)
+
+        try:
+            session.commit()
+            return None
+        except IntegrityError:
+            session.rollback()
+
+        existing = session.query(db_models.ProcessedMessage).filter(_filter(parsed_message)).one()
+
+        if existing.state == ProcessingStateE.PROCESSING:
+            updated_at = existing.updated_at
+
+            # SQLite drops timezone information.
+            if updated_at.tzinfo is None:
+                updated_at = updated_at.replace(tzinfo=datetime.timezone.utc)
+
+            if (now - updated_at).total_seconds() < IN_PROGRESS_TIMEOUT_SECONDS:
+                count_hit('in_progress')
+                raise MessageInProgressError(f'message {parsed_message.messageId} is being processed by another consumer')
+
+            # Previous attempt crashed; take over.
+            existing.updated_at = now
+            session.commit()
+
+        ctx.log(f'begin_processing: message already seen, state={existing.state}')
+
+        return Box({ 'state': existing.state, 'reply': existing.reply })
+
+def _set_state(ctx, parsed_message, state, reply=None):
+    with db_models.Session() as session:
+        values = { 'state': state, 'updated_at': datetime.datetime.now(datetime.timezone.utc) }
+        if reply is not None:
+            values['reply'] = reply
+
+        session.query(db_models.ProcessedMessage).filter(_filter(parsed_message)).update(values)
+        session.commit()
+
+def record_reply(ctx:Context, parsed_message, reply_attributes) -> None:
+    _set_state(ctx, parsed_message, ProcessingStateE.REPLIED, dict(reply_attributes))
+
+def mark_done(ctx:Context, parsed_message) -> None:
+    _set_state(ctx, parsed_message, ProcessingStateE.DONE)
+
+def release(ctx:Context, parsed_message) -> None:
+    # Lets a redelivery retry a failed attempt right away. A recorded reply is kept, so the retry resends it rather than
+    # generating a new one.
+    with db_models.Session() as session:
+        session.query(db_models.ProcessedMessage) \
+               .filter(and_(_filter(parsed_message), db_models.ProcessedMessage.state == ProcessingStateE.PROCESSING)) \
+               .delete(synchronize_session=False)
+        session.commit()
+
+def count_hit(outcome:str) -> None:
+    metrics.counter('idempotency_hits', outcome=outcome).inc()
+
+def purge_processed_messages() -> int:
+    cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=RETENTION_DAYS)
+
+    with db_models.Session() as session:
+        deleted = session.query(db_models.ProcessedMessage) \
+                  .filter(and_(db_models.ProcessedMessage.state == ProcessingStateE.DONE, db_models.ProcessedMessage.updated_at < cutoff)) \
+                  .delete(synchronize_session=False)
+        session.commit()
+
+    return deleted
+
+def purge_processed_messages_loop(interval=3600):
+    while True:
+        try:
+            deleted = purge_processed_messages()
+            if deleted:
+                logger.logger.info(f'[idempotency] purged {deleted} records older than {RETENTION_DAYS} days')
+        except Exception as e:
+            logger.logger.error(f'Exception occurred; {e}; stack trace: ', traceback.format_exc())
+
+        time.sleep(interval)
@@ -1,69 +1,391 @@
-from sqlalchemy import and_, desc
+from sqlalchemy import and_, desc, select
+from sqlalchemy.dialects import postgresql, sqlite
 import db_models
 import datetime
+import json
+import time
+import traceback
+import zlib
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
 
+from infra import logger
 from infra.context import Context
+from infra.env import env_int
+from services.token_prediction import token_predictor
+from services.history_cache import HistoryMessage, history_cache, select_history, to_history_message
+
+# Webhook payloads (rawSource) are kept for this many days; unset keeps them forever, 0 doesn't store them at all.
+RAW_SOURCE_RETENTION_DAYS = env_int('RAW_SOURCE_RETENTION_DAYS')
+
+# Sources of messages accepted for storing but not yet written (see services/write_behind.py); history reads include them.
+_pending_sources = []     # type: List[Callable[[str], List[HistoryMessage]]]
+
+def register_pending_source(pending_fn: Callable[[str], List[HistoryMessage]]) -> None:
+    _pending_sources.append(pending_fn)
 
 def insert_message(ctx:Context, attributes):
-    source = attributes['source']
-    message_timestamp = datetime.datetime.fromtimestamp(attributes['messageTimestamp'], tz=datetime.timezone.utc)
-    chat_type = attributes['chatType']
-    chat_id = attributes['chatId']
-    sender_id = attributes['senderId']
-    is_sent_by_me = attributes['isSentByMe']
-    message_id = attributes['messageId']
-    reply_to_message_id = attributes['replyToMessageId']
-    kind = attributes['kind']
-    body = attributes['body']
-    raw_source = attributes['rawSource']
+    ctx.log('insertMessage attributes:', attributes)
+
+    now = datetime.datetime.now()
+    values, raw_source = _message_values(attributes, now)
+    chat_id = values['chatId']
+    message_id = values['messageId']
+
+    # Returned messages are used after the session is closed; the row is fully loaded by RETURNING, so no refresh is needed.
+    with db_models.Session(expire_on_commit=False) as session:
+        insert = _get_dialect_insert(session)
+
+        if insert is None:
+            message = _insert_message_core(session, values, raw_source)
+            history_cache.append(chat_id, to_history_message(message))
+
+            return message
+
+        # One round trip; on (chatId, messageId) conflict nothing is returned, and the existing row is fetched.
+        message = session.scalars(_upsert_message_statement(insert, values)).one_or_none()
+
+        if message is not None:
+            _add_raw_source(session, message.id, raw_source, now)
+
+        session.commit()
+
+        if message is not None:
+            history_cache.append(chat_id, to_history_message(message))
+            return message
 
+        # Stored by someone else, e.g. a redelivered event handled by another consumer; cached history can't be trusted.
+        history_cache.invalidate(chat_id)
+
+        message = session.query(db_models.Message).filter(_message_filter(chat_id, message_id)).one()
+
+    return message
+
+async def insert_message_async(ctx:Context, attributes):
     ctx.log('insertMessage attributes:', attributes)
 
-    with db_models.Session() as session:
-        existing_message = session.query(db_models.Message).filter(and_(db_models.Message.chatId == chat_id, db_models.Message.messageId == message_id)).one_or_none()
-
-        if existing_message:
-            return existing_message
-
-        now = datetime.datetime.now()
-
-        message = db_models.Message(
-            source=source,
-            messageTimestamp=message_timestamp,
-            chatType=chat_type,
-            chatId=chat_id,
-            senderId=sender_id,
-            isSentByMe=is_sent_by_me,
-            messageId=message_id,
-            replyToMessageId=reply_to_message_id,
-            kind=kind,
-            body=body,
-            rawSource=raw_source,
-            createdAt=now,
-            updatedAt=now
-        )
-
-        session.add(message)
+    # Encoding is CPU-bound, and would block the event loop.
+    body = attributes['body']
+    token_count = await token_predictor.count_text_tokens_async(body) if body is not None else None
+
+    now = datetime.datetime.now()
+    values, raw_source = _message_values(attributes, now, token_count)
+    chat_id = values['chatId']
+    message_id = values['messageId']
+
+    async with db_models.async_session() as session:
+        insert = _get_dialect_insert(session)
+
+        if insert is None:
+            message = await session.run_sync(_insert_message_core, values, raw_source)
+            history_cache.append(chat_id, to_history_message(message))
+
+            return message
+
+        message = (await session.scalars(_upsert_message_statement(insert, values))).one_or_none()
+
+        if message is not None:
+            _add_raw_source(session, message.id, raw_source, now)
+
+        await session.commit()
+
+        if message is not None:
+            history_cache.append(chat_id, to_history_message(message))
+            return message
+
+        history_cache.invalidate(chat_id)
+
+        message = (await session.scalars(select(db_models.Message).where(_message_filter(chat_id, message_id)))).one()
+
+    return message
+
+def _upsert_message_statement(insert, values):
+    return insert(db_models.Message).values(**values) \
+           .on_conflict_do_nothing(index_elements=['chatId', 'messageId']) \
+           .returning(db_models.Message)
+
+def insert_messages(ctx:Context, attributes_list:List[Dict[str, Any]], events:Iterable[Dict[str, Any]] = ()) -> Dict[Tuple[str, str], Any]:
+    # Stores several messages, and events referring to them, with a single multi-row INSERT in one transaction.
+    # Events reference their message by 'ref_id', or by the (chatId, messageId) 'key' of a message in this batch.
+    # Returns the stored messages by (chatId, messageId); messages already stored by someone else are skipped.
+    now = datetime.datetime.now()
+    rows = [_message_values(attributes, now) for attributes in attributes_list]
+
+    with db_models.Session(expire_on_commit=False) as session:
+        insert = _get_dialect_insert(session)
+
+        if insert is None:
+            stored = [insert_message(ctx, attributes) for attributes in attributes_list]
+            stored_by_key = {(message.chatId, message.messageId): message for message in stored}
+        else:
+            statement = insert(db_models.Message).values([values for values, _ in rows]) \
+                        .on_conflict_do_nothing(index_elements=['chatId', 'messageId']) \
+                        .returning(db_models.Message)
+
+            stored_by_key = {(message.chatId, message.messageId): message for message in session.scalars(statement).all()}
+
+            for values, raw_source in rows:
+                message = stored_by_key.get((values['chatId'], values['messageId']))
+                if message is not None:
+                    _add_raw_source(session, message.id, raw_source, now)
+
+        for event in events:
+            ref_id = event.get('ref_id')
+            if ref_id is None and event.get('key') in stored_by_key:
+                ref_id = stored_by_key[event['key']].id
+
+            if ref_id is None:
+                continue
+
+            session.add(db_models.Event(type=event['type'], ref_table='Messages', ref_id=ref_id, body=event['body']))
+
         session.commit()
-        session.refresh(message)
 
-        session.close()
+    if insert is not None:
+        for (chat_id, _), message in stored_by_key.items():
+            history_cache.append(chat_id, to_history_message(message))
+
+    return stored_by_key
+
+def _message_values(attributes, now, token_count=None) -> Tuple[Dict[str, Any], Any]:
+    # token_count may be computed by the caller; otherwise, it is computed here.
+    if token_count is None and attributes['body'] is not None:
+        token_count = token_predictor.count_text_tokens(attributes['body'])
+
+    values = {
+        'source': attributes['source'],
+        'messageTimestamp': datetime.datetime.fromtimestamp(attributes['messageTimestamp'], tz=datetime.timezone.utc),
+        'chatType': attributes['chatType'],
+        'chatId': attributes['chatId'],
+        'senderId': attributes['senderId'],
+        'isSentByMe': attributes['isSentByMe'],
+        'messageId': attributes['messageId'],
+        'replyToMessageId': attributes['replyToMessageId'],
+        'kind': attributes['kind'],
+        'body': attributes['body'],
+        'tokenCount': token_count,
+        # Messages written in the background carry the time they were accepted; see services/write_behind.py.
+        'createdAt': attributes.get('createdAt') or now,
+        'updatedAt': now
+    }
+
+    return values, attributes['rawSource']
+
+def _get_dialect_insert(session):
+    dialect_name = session.get_bind().dialect.name
+
+    if dialect_name == 'postgresql':
+        return postgresql.insert
+
+    if dialect_name == 'sqlite':
+        return sqlite.insert
+
+    return None
+
+def _message_filter(chat_id, message_id):
+    return and_(db_models.Message.chatId == chat_id, db_models.Message.messageId == message_id)
+
+def _insert_message_core(session, values, raw_source):
+    # Databases without INSERT ... ON CONFLICT support.
+    existing_message = session.query(db_models.Message).filter(_message_filter(values['chatId'], values['messageId'])).one_or_none()
+
+    if existing_message:
+        return existing_message
+
+    message = db_models.Message(**values)
+
+    session.add(message)
+    session.flush()
+
+    _add_raw_source(session, message.id, raw_source, values['createdAt'])
+    session.commit()
 
     return message
 
+def _add_raw_source(session, message_id, raw_source, now):
+    if raw_source is None or RAW_SOURCE_RETENTION_DAYS == 0:
+        return
+
+    session.add(db_models.MessageRawSource(message_id=message_id, data=encode_raw_source(raw_source), created_at=now))
+
+def encode_raw_source(raw_source) -> bytes:
+    return zlib.compress(json.dumps(raw_source, separators=(',', ':')).encode('utf-8'))
+
+def decode_raw_source(data: bytes) -> Dict[str, Any]:
+    return json.loads(zlib.decompress(data).decode('utf-8'))
+
+def get_raw_source(message) -> Optional[Dict[str, Any]]:
+    # Payloads are only needed in rare cases, and are loaded on demand; messages stored before the side table
+    # was introduced (and not yet backfilled) still carry them inline.
+    if getattr(message, 'rawSource', None) is not None:
+        return message.rawSource
+
+    with db_models.Session() as session:
+        data = session.query(db_models.MessageRawSource.data) \
+               .filter(db_models.MessageRawSource.message_id == message.id) \
+               .scalar()
+
+    return decode_raw_source(data) if data is not None else None
+
+def is_my_message(chat_id, message_id) -> bool:
+    # Whether a message of this chat was sent by the bot, e.g. the one a reply refers to; replies pending a write count.
+    message_id = str(message_id)
+
+    if any(m.messageId == message_id and m.isSentByMe for m in _get_pending_history(chat_id)):
+        return True
+
+    with db_models.Session() as session:
+        my_message_id = session.query(db_models.Message.id) \
+                        .filter(and_(_message_filter(chat_id, message_id), db_models.Message.isSentByMe == True)) \
+                        .limit(1) \
+                        .scalar()
+
+    return my_message_id is not None
+
+def purge_raw_sources() -> int:
+    if not RAW_SOURCE_RETENTION_DAYS:
+        return 0
+
+    cutoff = datetime.datetime.now() - datetime.timedelta(days=RAW_SOURCE_RETENTION_DAYS)
+
+    with db_models.Session() as session:
+        deleted = session.query(db_models.MessageRawSource) \
+                  .filter(db_models.MessageRawSource.created_at < cutoff) \
+                  .delete(synchronize_session=False)
+        session.commit()
+
+    return deleted
+
+def purge_raw_sources_loop(interval=3600):
+    while True:
+        try:
+            deleted = purge_raw_sources()
+            if deleted:
+                logger.logger.info(f'[raw-sources] purged {deleted} payloads older than {RAW_SOURCE_RETENTION_DAYS} days')
+        except Exception as e:
+            logger.logger.error(f'Exception occurred; {e}; stack trace: ', traceback.format_exc())
+
+        time.sleep(interval)
+
 def get_message_history(ctx:Context, message, options=None):
-    if options is None:
-        options = {}
+    limit = (options or {}).get('limit', 20)
+
+    # Pending messages are read first: one written in the meantime is then found in the stored history instead.
+    pending_messages = _get_pending_history(message.chatId)
+
+    messages = _get_stored_history(ctx, message.chatId, message.messageTimestamp, limit)
+
+    return _merge_pending_history(messages, pending_messages, message.messageTimestamp, limit)
 
-    limit = options.get('limit', 20)
-    chat_id = message.chatId
-    message_timestamp = message.messageTimestamp
+async def get_message_history_async(ctx:Context, message, options=None):
+    limit = (options or {}).get('limit', 20)
 
+    pending_messages = _get_pending_history(message.chatId)
+
+    messages = await _get_stored_history_async(ctx, message.chatId, message.messageTimestamp, limit)
+
+    return _merge_pending_history(messages, pending_messages, message.messageTimestamp, limit)
+
+def _get_pending_history(chat_id) -> List[HistoryMessage]:
+    return [m for pending_fn in _pending_sources for m in pending_fn(chat_id)]
+
+def _merge_pending_history(messages, pending_messages, message_timestamp, limit) -> List[HistoryMessage]:
+    if not pending_messages:
+        return messages
+
+    stored_message_ids = set(m.messageId for m in messages)
+    pending_messages = [m for m in pending_messages if m.messageId not in stored_message_ids]
+
+    # Pending replies may be older than stored messages, e.g. a user message stored while its predecessor's reply waits.
+    merged = sorted(messages + select_history(pending_messages, message_timestamp, limit), key=_history_order)
+
+    return merged[-limit:]
+
+def _history_order(message: HistoryMessage):
+    # createdAt is naive local time for SQLite and pending messages, and timezone-aware otherwise.
+    return (message.messageTimestamp, message.createdAt.timestamp())
+
+def _get_stored_history(ctx, chat_id, message_timestamp, limit) -> List[HistoryMessage]:
+    cached_messages = history_cache.get(chat_id, message_timestamp, limit)
+    if cached_messages is not None:
+        return cached_messages
+
+    if history_cache.exclusive and limit <= history_cache.turns:
+        # Load the chat's latest turns regardless of timestamp, so that the cached copy stays usable for later messages.
+        load_sequence = history_cache.begin_load()
+        latest_messages = _query_history(ctx, _latest_history_condition(chat_id), history_cache.turns)
+        history_cache.store(chat_id, latest_messages, load_sequence)
+
+        messages = select_history(latest_messages, message_timestamp, limit)
+        if len(messages) == limit or len(latest_messages) < history_cache.turns:
+            return messages
+
+    return _query_history(ctx, _history_condition(chat_id, message_timestamp), limit)
+
+async def _get_stored_history_async(ctx, chat_id, message_timestamp, limit) -> List[HistoryMessage]:
+    cached_messages = history_cache.get(chat_id, message_timestamp, limit)
+    if cached_messages is not None:
+        return cached_messages
+
+    if history_cache.exclusive and limit <= history_cache.turns:
+        load_sequence = history_cache.begin_load()
+        latest_messages = await _query_history_async(_latest_history_condition(chat_id), history_cache.turns)
+        history_cache.store(chat_id, latest_messages, load_sequence)
+
+        messages = select_history(latest_messages, message_timestamp, limit)
+        if len(messages) == limit or len(latest_messages) < history_cache.turns:
+            return messages
+
+    return await _query_history_async(_history_condition(chat_id, message_timestamp), limit)
+
+def _latest_history_condition(chat_id):
+    return db_models.Message.chatId == chat_id
+
+def _history_condition(chat_id, message_timestamp):
+    return and_(db_models.Message.chatId == chat_id, db_models.Message.messageTimestamp <= message_timestamp)
+
+# History only needs these columns; rawSource in particular holds the entire webhook payload.
+HISTORY_COLUMNS = (
+    db_models.Message.id,
+    db_models.Message.source,
+    db_models.Message.chatId,
+    db_models.Message.messageId,
+    db_models.Message.messageTimestamp,
+    db_models.Message.createdAt,
+    db_models.Message.isSentByMe,
+    db_models.Message.body,
+    db_models.Message.tokenCount
+)
+
+def _history_statement(condition, limit):
+    return select(*HISTORY_COLUMNS) \
+           .where(condition) \
+           .order_by(desc(db_models.Message.createdAt), desc(db_models.Message.id)).limit(limit)
+
+def _query_history(ctx, condition, limit) -> List[HistoryMessage]:
     with db_models.Session() as session:
-        messages = session.query(db_models.Message) \
-                   .filter(and_(db_models.Message.chatId == chat_id, db_models.Message.messageTimestamp <= message_timestamp)) \
-                   .order_by(desc(db_models.Message.createdAt)).limit(limit).all()
+        rows = session.execute(_history_statement(condition, limit)).all()
+
+    return [to_history_message(row) for row in reversed(rows)]
+
+async def _query_history_async(condition, limit) -> List[HistoryMessage]:
+    async with db_models.async_session() as session:
+        rows = (await session.execute(_history_statement(condition, limit))).all()
 
-        session.close()
+    return [to_history_message(row) for row in reversed(rows)]
+
+def _newer_incoming_messages_statement(message, limit):
+    # Messages without a body are never answered.
+    return select(db_models.Message) \
+           .where(and_(db_models.Message.chatId == message.chatId, db_models.Message.id > message.id,
+                       db_models.Message.isSentByMe == False, db_models.Message.body != None)) \
+           .order_by(db_models.Message.id) \
+           .limit(limit)
+
+def get_newer_incoming_messages(ctx:Context, message, limit=10) -> List[Any]:
+    # Incoming messages of the same chat stored after this one, oldest first.
+    with db_models.Session() as session:
+        return session.scalars(_newer_incoming_messages_statement(message, limit)).all()
 
-    return list(reversed(messages))
+async def get_newer_incoming_messages_async(ctx:Context, message, limit=10) -> List[Any]:
+    async with db_models.async_session() as session:
+        return (await session.scalars(_newer_incoming_messages_statement(message, limit))).all()
@@ -1,5 +1,5 @@
 from abc import ABC, abstractmethod
-from typing import Tuple
+from typing import List, Optional, Tuple
 
 from box import Box
 
@@ -12,7 +12,33 @@ class MessageKindE:
     AUDIO = 'audio'
 
 
+def split_text(text: str, max_length: int) -> List[str]:
+    # Splits text into parts of at most max_length characters, at a line break or space when there is one in the
+    # second half of a part.
+    parts = []
+
+    while len(text) > max_length:
+        cut = text.rfind('\n', max_length // 2, max_length + 1)
+        if cut < 0:
+            cut = text.rfind(' ', max_length // 2, max_length + 1)
+
+        if cut < 0:
+            parts.append(text[:max_length])
+            text = text[max_length:]
+        else:
+            parts.append(text[:cut])
+            text = text[cut + 1:]
+
+    return parts + [text]
+
+
 class MessagingService(ABC):
+    # Messengers that can edit sent messages support progressively streamed replies.
+    supports_edits = False
+
+    # Longest text a single message may carry; None if unlimited.
+    max_message_length = None      # type: Optional[int]
+
     def __init__(self, chat_id: str):
         super().__init__()
         self.chat_id = chat_id
@@ -25,6 +51,11 @@ class MessagingService(ABC):
     def send_message(self, ctx:Context, attributes) -> Box:
         pass
     
+    def edit_message(self, ctx:Context, message_id, body:str) -> bool:
+        # Replaces the text of a sent message; returns False if it wasn't replaced.
+        # Only messengers with supports_edits implement it.
+        return False
+
     @abstractmethod
     def send_contact(self, ctx:Context, name:str, handle:str):
         pass
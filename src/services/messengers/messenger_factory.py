@@ -35,3 +35,12 @@ messenger_factory_by_type: Dict[str, Callable] = {'tg': _make_tg_messenger_from_
 def make_messenger_from_event(event: Dict) -> Optional[MessagingService]:
     messenger = messenger_factory_by_type[event['source']](event)
     return messenger
+
+
+def get_messenger_chat_id_from_event(event: Dict) -> Optional[str]:
+    # Returns '<source>:<chatId>', the same format make_messenger() accepts.
+    messenger = make_messenger_from_event(event)
+    if messenger is None:
+        return None
+
+    return f"{event['source']}:{messenger.chat_id}"
@@ -0,0 +1,103 @@
+import time
+from typing import Optional
+
+from box import Box
+
+from infra import metrics
+from infra.context import Context
+from infra.env import env_int
+from services.messengers.messenger import MessagingService, split_text
+
+# Minimal interval between edits of a streamed reply; Telegram throttles frequent edits of the same message.
+STREAMING_EDIT_INTERVAL_MS = env_int('STREAMING_EDIT_INTERVAL_MS', 1000)
+
+# Appended to partial replies, so that users know more text is coming.
+IN_PROGRESS_MARKER = ' \N{HORIZONTAL ELLIPSIS}'
+
+# Shows a reply while it is being generated: the first text is sent as a new message, which is then
+# edited as more text arrives. Only the final text is returned for storing.
+#
+# A reply too long for one message stops being updated once it no longer fits; when finished, the first message is
+# edited to show as much of it as fits, and the rest is sent as follow-up messages.
+class StreamingReply:
+    def __init__(self, ctx:Context, messenger:MessagingService, chat_id, message_timestamp:float):
+        self.ctx = ctx
+        self.messenger = messenger
+        self.chat_id = chat_id
+        self.message_timestamp = message_timestamp
+
+        self._message = None            # type: Optional[Box]
+        self._shown = None              # type: Optional[str]
+        self._last_edit = 0.0
+        self._failed = False
+
+    def update(self, text:str) -> None:
+        # Called with the full reply text generated so far.
+        if self._failed or not text.strip() or not self._fits(text + IN_PROGRESS_MARKER):
+            return
+
+        if self._message is None:
+            self._send_first(text)
+            return
+
+        now = time.time()
+        if (now - self._last_edit) * 1000 < STREAMING_EDIT_INTERVAL_MS:
+            return
+
+        self._edit(text + IN_PROGRESS_MARKER)
+        self._last_edit = now
+
+    def finish(self, text:str) -> Optional[Box]:
+        parts = split_text(text, self.messenger.max_message_length) if not self._fits(text) else [text]
+
+        if self._message is None:
+            message = self._send(parts[0])
+        elif self._shown != parts[0] and not self._edit(parts[0]):
+            self.ctx.log("streaming reply: final edit failed; sending the full reply as a new message.")
+            message = self._send(parts[0])
+        else:
+            message = self._message
+
+        if message is None:
+            return None
+
+        for part in parts[1:]:
+            self._send(part)
+
+        # The sent message carries the first (partial) text; store the final, complete one.
+        message.body = text
+
+        return message
+
+    def _fits(self, body:str) -> bool:
+        return self.messenger.max_message_length is None or len(body) <= self.messenger.max_message_length
+
+    def _send(self, body:str) -> Optional[Box]:
+        return self.messenger.send_message(self.ctx, {'chat_id': self.chat_id, 'kind': 'text', 'body': body})
+
+    def _send_first(self, text:str) -> None:
+        body = text + IN_PROGRESS_MARKER
+        self._message = self._send(body)
+
+        if self._message is None:
+            # Don't retry on every token; finish() sends the complete reply instead.
+            self._failed = True
+            return
+
+        self._shown = body
+        self._last_edit = time.time()
+
+        time_to_first_visible_token = self._last_edit - self.message_timestamp
+        self.ctx.set_stat('time_to_first_visible_token_ms', int(time_to_first_visible_token * 1000))
+        metrics.histogram('time_to_first_visible_token_seconds', streaming='true').observe(time_to_first_visible_token)
+
+    def _edit(self, body:str) -> bool:
+        if body == self._shown:
+            return True
+
+        if not self.messenger.edit_message(self.ctx, self._message.messageId, body):
+            return False
+
+        self._shown = body
+
+        return True
@@ -3,18 +3,27 @@ import random
 import tempfile
 from typing import Optional
 import requests
+import time
 
 from infra.context import Context
+from services import message_db
 from services.messengers.messenger import MessageKindE, MessagingService
-from infra import utils
+from infra import metrics, utils
 from box import Box
 
 import threading
 
 TELEGRAM_SENDER_ID = os.environ['TELEGRAM_BOT_TOKEN'].split(':')[0]
 
+TELEGRAM_MAX_MESSAGE_LENGTH = 4096
+
+# Typing indications are refreshed by timer threads, one chain per message being processed.
+typing_timers_in_flight = metrics.gauge('telegram_typing_timers_in_flight')
+
 class TelegramMessenger(MessagingService):
-    
+    supports_edits = True
+    max_message_length = TELEGRAM_MAX_MESSAGE_LENGTH
+
     def _get_message_kind(self, message) -> Optional[str]:
         if 'text' in message:
             return MessageKindE.TEXT
@@ -75,12 +84,15 @@ class TelegramMessenger(MessagingService):
             args['reply_to_message_id'] = quote_id
             args['allow_sending_without_reply'] = True
 
+        start = time.time()
         response = requests.post(
             f'https://api.telegram.org/bot{os.environ["TELEGRAM_BOT_TOKEN"]}/sendMessage',
             json=args
         ).json()
+        metrics.histogram('messenger_send_seconds', messenger='tg').observe(time.time() - start)
 
         if not response['ok']:
+            metrics.counter('messenger_send_failures', messenger='tg').inc()
             return None
         
         message = {'message': response['result']}
@@ -88,6 +100,28 @@ class TelegramMessenger(MessagingService):
 
         return parsed_message
     
+    def edit_message(self, ctx:Context, message_id, body:str) -> bool:
+        # Telegram rejects longer texts; the caller keeps the overflow for follow-up messages.
+        if len(body) > TELEGRAM_MAX_MESSAGE_LENGTH:
+            ctx.log(f"edit_message: text of {len(body)} characters doesn't fit in a message.")
+            return False
+
+        args = {'chat_id': self.chat_id, 'message_id': message_id, 'text': body}
+
+        start = time.time()
+        response = requests.post(
+            f'https://api.telegram.org/bot{os.environ["TELEGRAM_BOT_TOKEN"]}/editMessageText',
+            json=args
+        ).json()
+        metrics.histogram('messenger_edit_seconds', messenger='tg').observe(time.time() - start)
+
+        if not response['ok']:
+            ctx.log(f"edit_message failed. response={response}")
+            metrics.counter('messenger_edit_failures', messenger='tg').inc()
+            return False
+
+        return True
+
     def send_contact(self, ctx: Context, name:str, handle:str):
         args = {'chat_id': self.chat_id, 'text': f'https://t.me/{handle}'}
         response = requests.post(
@@ -105,7 +139,16 @@ class TelegramMessenger(MessagingService):
         if msg.body.startswith(f'@{os.environ["TELEGRAM_BOT_NAME"]}'):
             return True
 
-        if 'reply_to_message' in msg.rawSource and msg.rawSource['reply_to_message']['from']['id'] == int(TELEGRAM_SENDER_ID):
+        if msg.replyToMessageId is None:
+            return False
+
+        # Replies are recognized by the stored message they refer to, which works whether or not payloads are kept.
+        if message_db.is_my_message(msg.chatId, msg.replyToMessageId):
+            return True
+
+        # Bot messages that were never stored (e.g. transcripts) are only recognized from the reply's payload.
+        raw_source = message_db.get_raw_source(msg) or {}
+        if 'reply_to_message' in raw_source and raw_source['reply_to_message']['from']['id'] == int(TELEGRAM_SENDER_ID):
             return True
 
         return False
@@ -160,8 +203,13 @@ class TelegramMessenger(MessagingService):
         extra_timeout = random.randint(0, 1500)
         timeout = base_timeout + (extra_timeout / 1000)
 
-        timer = threading.Timer(timeout, self.set_typing, args=(in_flight,))
+        timer = threading.Timer(timeout, self._on_typing_timer, args=(in_flight,))
+        typing_timers_in_flight.inc()
         timer.start()
+
+    def _on_typing_timer(self, in_flight):
+        typing_timers_in_flight.dec()
+        self.set_typing(in_flight)
     
     def set_status_read(self, ctx: Context, message_id) -> None:
         return
@@ -2,7 +2,7 @@ import os
 from typing import Dict
 import requests
 from services.messengers.messenger import MessageKindE, MessagingService
-from infra import utils
+from infra import metrics, utils
 from box import Box
 import time
 
@@ -147,6 +147,8 @@ class WhatsappMessenger(MessagingService):
         return parsed_message
 
     def _post_message_request(self, ctx:Context, headers:Dict[str,str], args):
+        start = time.time()
+
         try:
             response = requests.post(
                 f"https://graph.facebook.com/{os.environ['FACEBOOK_GRAPH_VERSION']}/{os.environ['WHATSAPP_PHONE_NUMBER_ID']}/messages",
@@ -155,8 +157,12 @@ class WhatsappMessenger(MessagingService):
             )
             response.raise_for_status()
         except requests.exceptions.RequestException as error:
+            metrics.counter('messenger_send_failures', messenger='wa').inc()
             ctx.log(f"post_message_request: exception. error={error}")
             raise error
+        finally:
+            metrics.histogram('messenger_send_seconds', messenger='wa').observe(time.time() - start)
+
         return response
     
     def send_contact(self, ctx: Context, name:str, handle:str):
@@ -6,13 +6,14 @@ import time
 import re
 import requests
 import traceback
-from typing import Dict
+from typing import Callable, Dict, Optional
 
 from box import Box
 from services.timers import invoke_alert_tool
 
 
 from services.token_prediction import token_predictor
+from infra import metrics
 from infra.context import Context
 from langchain.utilities import google_serper
 
@@ -60,13 +61,19 @@ def db_messages2messages(messages):
     return parsed_messages
 
 
-def get_limited_message_history(ctx, messages, prompt_template):
+def db_messages2token_counts(messages):
+    # Aligned with db_messages2messages().
+    return [getattr(message, 'tokenCount', None) for message in messages if message.body is not None]
+
+
+def get_limited_message_history(ctx, messages, prompt_template, content_tokens=None):
     soft_token_limit = 2048
     hard_token_limit = 4000
 
-    messages_upto_max_tokens = token_predictor.get_messages_upto_max_tokens(
-        ctx, prompt_template, messages, soft_token_limit, hard_token_limit
-    )
+    with ctx.span('token-trimming'):
+        messages_upto_max_tokens = token_predictor.get_messages_upto_max_tokens(
+            ctx, prompt_template, messages, soft_token_limit, hard_token_limit, content_tokens
+        )
 
     if len(messages_upto_max_tokens) == 0:
         return []
@@ -91,18 +98,19 @@ def get_limited_message_history(ctx, messages, prompt_template):
     return merged_messages
 
 
-def get_chat_completion(ctx:Context, messenger_name, messages, direct):
+def get_chat_completion(ctx:Context, messenger_name, messages, direct, on_answer=None):
     parsed_messages = deep_clone(messages) if direct else db_messages2messages(messages)
+    content_tokens = None if direct else db_messages2token_counts(messages)
 
     system_message = get_system_message(ctx, messenger_name)
     messages_upto_max_tokens = get_limited_message_history(
-        ctx, parsed_messages, system_message
+        ctx, parsed_messages, system_message, content_tokens
     )
 
-    return get_chat_completion_core(ctx, messenger_name, messages_upto_max_tokens)
+    return get_chat_completion_core(ctx, messenger_name, messages_upto_max_tokens, on_text=on_answer)
 
 @backoff.on_exception(backoff.expo, openai.error.RateLimitError, max_tries=3)
-def get_chat_completion_core(ctx, messenger_name, messages, model=None):
+def get_chat_completion_core(ctx, messenger_name, messages, model=None, on_text=None):
     if not model:
         model = "gpt-4" if ctx.user_channel == "canary" else "gpt-3.5-turbo"
 
@@ -110,7 +118,10 @@ def get_chat_completion_core(ctx, messenger_name, messages, model=None):
         ctx.log("Messages: ", messages);
         ctx.log("invoking completion request.")
 
-        completion = chat_completion_create_wrap(ctx, model, messages)
+        if on_text and is_streaming_supported(model):
+            completion = chat_completion_stream_create(ctx, model, messages, on_text)
+        else:
+            completion = chat_completion_create_wrap(ctx, model, messages)
 
         ctx.log("getChatCompletionCore response: ", completion['choices'][0]['message']['content'])
 
@@ -217,18 +228,20 @@ prep_reply_message = {"role": "assistant", "content": "Understood. Please provid
 
 import datetime
 
-def get_chat_completion_with_tools(ctx:Context, messenger_name, messages, direct):
+# on_answer, if provided, is called with the user-visible answer generated so far, as it is being streamed.
+def get_chat_completion_with_tools(ctx:Context, messenger_name, messages, direct, on_answer=None):
     try:
         ctx.log("Starting getChatCompletionWithTools.")
 
         parsed_messages = deep_clone(messages) if direct else db_messages2messages(messages)
+        content_tokens = None if direct else db_messages2token_counts(messages)
         ctx.log({"messages": parsed_messages})
 
         prev_responses = []
 
         #system_message = get_system_message(ctx, messenger_name)
         system_message = None
-        history = get_limited_message_history(ctx, parsed_messages, system_message)
+        history = get_limited_message_history(ctx, parsed_messages, system_message, content_tokens)
 
         prompt_tokens_total = 0
         completion_tokens_total = 0
@@ -245,7 +258,13 @@ def get_chat_completion_with_tools(ctx:Context, messenger_name, messages, direct
 
             is_final = (i == (max_iterations - 1))
 
-            result = completion_iterative_step(ctx, messenger_name, deep_clone(history), prev_responses, is_final)
+            on_text = None
+            if on_answer:
+                prefix = "\N{LEFT-POINTING MAGNIFYING GLASS}: " if successful_iterations > 0 else ""
+                on_text = make_answer_stream_handler(on_answer, prefix, is_final)
+
+            with ctx.span(f'tools-flow:iteration-{i}'):
+                result = completion_iterative_step(ctx, messenger_name, deep_clone(history), prev_responses, is_final, on_text)
             answer = result['answer']
             tool = result['tool']
             input_ = result['input']
@@ -279,7 +298,8 @@ def get_chat_completion_with_tools(ctx:Context, messenger_name, messages, direct
                 ctx.set_stat('tools-flow:tool-invocations', successful_iterations)
 
                 ctx.log(f"Invoking TOOL {tool} with INPUT {input_}")
-                response, brk = invoke_tool(ctx, tool, input_, message=messages[-1])
+                with ctx.span(f'tool:{tool.strip().lower()[:32]}'):
+                    response, brk = invoke_tool(ctx, tool, input_, message=messages[-1])
                 if brk:
                     return Box({
                     "response": response,
@@ -296,9 +316,80 @@ def get_chat_completion_with_tools(ctx:Context, messenger_name, messages, direct
 
     ctx.set_stat('tools-flows:success', False)
 
-    return get_chat_completion(ctx, messenger_name, messages, direct)
+    with ctx.span('completion-fallback'):
+        return get_chat_completion(ctx, messenger_name, messages, direct, on_answer)
+
+def make_answer_stream_handler(on_answer, prefix, is_final : bool):
+    # Final-step replies are the answer itself; earlier steps wrap it in a JSON reply, which may also be a tool invocation.
+    if is_final:
+        return lambda text: on_answer(prefix + text)
+
+    extractor = PartialAnswerExtractor()
+
+    def on_text(text):
+        answer = extractor.feed(text)
+        if answer:
+            on_answer(prefix + answer)
+
+    return on_text
+
+# Extracts the ANSWER string from a partially received <yair1xigoresponse>{ "ANSWER" : "..." }</yair1xigoresponse> reply.
+class PartialAnswerExtractor:
+    ANSWER_START = re.compile(r'<yair1xigoresponse>\s*\{\s*["\']ANSWER["\']\s*:\s*(["\'])')
+    ESCAPES = {'n': '\n', 't': '\t', 'r': '\r', 'b': '\b', 'f': '\f'}
+
+    def __init__(self):
+        self._quote = None
+        self._pos = 0
+        self._chars = []
+        self._done = False
+
+    def feed(self, text:str) -> Optional[str]:
+        # Called with the full reply received so far; returns the answer decoded so far, if any.
+        if self._quote is None:
+            match = self.ANSWER_START.search(text)
+            if not match:
+                return None
+
+            self._quote = match.group(1)
+            self._pos = match.end()
+
+        while not self._done and self._pos < len(text):
+            c = text[self._pos]
+
+            if c == self._quote:
+                self._done = True
+                break
+
+            if c != '\\':
+                self._chars.append(c)
+                self._pos += 1
+                continue
+
+            # Wait for the rest of an escape sequence.
+            if self._pos + 1 >= len(text):
+                break
+
+            escaped = text[self._pos + 1]
+
+            if escaped == 'u':
+                if self._pos + 6 > len(text):
+                    break
 
-def completion_iterative_step(ctx, messenger_name, history, prev_responses, is_final : bool):
+                try:
+                    self._chars.append(chr(int(text[self._pos + 2:self._pos + 6], 16)))
+                except ValueError:
+                    pass
+
+                self._pos += 6
+                continue
+
+            self._chars.append(self.ESCAPES.get(escaped, escaped))
+            self._pos += 2
+
+        return ''.join(self._chars)
+
+def completion_iterative_step(ctx, messenger_name, history, prev_responses, is_final : bool, on_text=None):
     result = {'answer': None, 'tool': None, 'input': None, 'prompt_tokens': None, 'completion_tokens': None}
 
     messages = []
@@ -322,7 +413,7 @@ def completion_iterative_step(ctx, messenger_name, history, prev_responses, is_f
 
     messages.append(new_request)
 
-    reply = get_chat_completion_core(ctx, messenger_name, messages)
+    reply = get_chat_completion_core(ctx, messenger_name, messages, on_text=on_text)
     result['prompt_tokens'] = reply.promptTokens
     result['completion_tokens'] = reply.completionTokens
 
@@ -350,16 +441,71 @@ def completion_iterative_step(ctx, messenger_name, history, prev_responses, is_f
 
     return result
 
+# Completion throughput varies from a few tokens/s (GPT-4 under load) to well over 100 (GPT-3.5 on Azure).
+TOKENS_PER_SECOND_BUCKETS = (1, 2, 5, 10, 15, 20, 30, 40, 60, 80, 100, 150, 200)
+
+def observe_completion(model, backend, start, response):
+    duration = time.time() - start
+
+    metrics.histogram('openai_request_seconds', model=model, backend=backend).observe(duration)
+
+    usage = response.get('usage') if response else None
+    if not usage:
+        metrics.counter('openai_request_failures', model=model, backend=backend).inc()
+        return
+
+    metrics.counter('openai_tokens', model=model, kind='prompt').inc(usage['prompt_tokens'])
+    metrics.counter('openai_tokens', model=model, kind='completion').inc(usage['completion_tokens'])
+
+    if duration > 0:
+        metrics.histogram('openai_completion_tokens_per_second', TOKENS_PER_SECOND_BUCKETS, model=model).observe(usage['completion_tokens'] / duration)
+
+def openai_completion_create(model, messages):
+    start = time.time()
+    response = openai.ChatCompletion().create(model=model, messages=messages, temperature=0.2)
+    observe_completion(model, 'openai', start, response)
+
+    return response
+
+def is_streaming_supported(model) -> bool:
+    # Azure replies may be rejected by its content filter and retried with OpenAI, so only OpenAI replies are streamed.
+    return model == 'gpt-4' or os.environ['AZURE_OPENAI_KEY'] == ''
+
+def chat_completion_stream_create(ctx: Context, model, messages, on_text: Callable[[str], None]):
+    start = time.time()
+    text = ''
+
+    for chunk in openai.ChatCompletion().create(model=model, messages=messages, temperature=0.2, stream=True):
+        delta = chunk['choices'][0].get('delta', {}).get('content')
+        if not delta:
+            continue
+
+        text += delta
+        on_text(text)
+
+    # Streamed responses carry no usage; count tokens the same way history trimming does.
+    response = {
+        'choices': [{'message': {'role': 'assistant', 'content': text}}],
+        'usage': {
+            'prompt_tokens': token_predictor.count_message_tokens(messages),
+            'completion_tokens': token_predictor.count_text_tokens(text)
+        }
+    }
+
+    observe_completion(model, 'openai', start, response)
+
+    return response
+
 def chat_completion_create_wrap(ctx: Context, model, messages):
     if model == 'gpt-4':
-        response = openai.ChatCompletion().create(model=model, messages=messages, temperature=0.2)
+        response = openai_completion_create(model, messages)
 
         return response
 
     if model == 'gpt-3.5-turbo':
         # TODO: cleanup per issue #55
         if os.environ['AZURE_OPENAI_KEY'] == '':
-            return openai.ChatCompletion().create(model=model, messages=messages, temperature=0.2)
+            return openai_completion_create(model, messages)
 
         url = "https://r1x.openai.azure.com/openai/deployments/gpt-35-turbo/chat/completions?api-version=2023-05-15"
 
@@ -373,7 +519,9 @@ def chat_completion_create_wrap(ctx: Context, model, messages):
             "temperature": 0.2
         }
 
+        start = time.time()
         response = requests.post(url, headers=headers, data=json.dumps(data)).json()
+        observe_completion(model, 'azure', start, response)
 
         ctx.log('Azure GPT 3.5 response:', response)
 
@@ -383,7 +531,7 @@ def chat_completion_create_wrap(ctx: Context, model, messages):
         if content_filter_active:
             ctx.log('Content filtering applied; falling back to OpenAI API.')
             ctx.set_stat('completion:content-filter', True)
-            response = openai.ChatCompletion().create(model=model, messages=messages, temperature=0.2)
+            response = openai_completion_create(model, messages)
 
         return response
 
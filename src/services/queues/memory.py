@@ -0,0 +1,111 @@
+import threading
+import time
+import uuid
+from typing import Dict
+
+from services.queues.queue import MessageQueue
+
+# In-process queue with SQS-like visibility semantics.
+# Useful for tests and for load-testing the consumer path without any external service.
+class InMemoryQueue(MessageQueue):
+    def __init__(self, visibility_timeout:int=30):
+        super().__init__()
+        self.visibility_timeout = visibility_timeout
+
+        self._cond = threading.Condition()
+        self._messages = {}         # message id -> message record, in send order
+        self._receipts = {}         # receipt handle -> message id
+
+    def receive_messages(self, max_messages, wait_time_seconds):
+        deadline = time.time() + wait_time_seconds
+
+        with self._cond:
+            while True:
+                now = time.time()
+                visible = [m for m in self._messages.values() if m['visible_at'] <= now][:max_messages]
+
+                if visible or now >= deadline:
+                    break
+
+                self._cond.wait(min(deadline - now, 1))
+
+            return [self._deliver(m, now) for m in visible]
+
+    def delete_messages(self, receipt_handles):
+        failed = []
+
+        with self._cond:
+            for handle in receipt_handles:
+                message_id = self._receipts.pop(handle, None)
+                record = self._messages.get(message_id)
+
+                # Only the latest receipt handle of a message is valid, as with SQS.
+                if record is None or record['receipt_handle'] != handle:
+                    failed.append(handle)
+                    continue
+
+                del self._messages[message_id]
+
+        return failed
+
+    def change_visibility(self, receipt_handles, visibility_timeout):
+        failed = []
+
+        with self._cond:
+            for handle in receipt_handles:
+                record = self._messages.get(self._receipts.get(handle))
+
+                if record is None or record['receipt_handle'] != handle:
+                    failed.append(handle)
+                    continue
+
+                record['visible_at'] = time.time() + visibility_timeout
+
+            self._cond.notify_all()
+
+        return failed
+
+    def send_message(self, body, group_id=None):
+        message_id = str(uuid.uuid4())
+
+        with self._cond:
+            self._messages[message_id] = {
+                'id': message_id,
+                'body': body,
+                'group_id': group_id,
+                'sent_at': time.time(),
+                'visible_at': 0,
+                'receive_count': 0,
+                'receipt_handle': None
+            }
+
+            self._cond.notify_all()
+
+        return message_id
+
+    def get_approximate_depth(self):
+        now = time.time()
+
+        with self._cond:
+            return len([m for m in self._messages.values() if m['visible_at'] <= now])
+
+    def _deliver(self, record, now) -> Dict:
+        # Called with self._cond held.
+        handle = str(uuid.uuid4())
+
+        self._receipts.pop(record['receipt_handle'], None)
+        self._receipts[handle] = record['id']
+
+        record['receipt_handle'] = handle
+        record['visible_at'] = now + self.visibility_timeout
+        record['receive_count'] += 1
+
+        attributes = {
+            'SentTimestamp': str(int(record['sent_at'] * 1000)),
+            'ApproximateReceiveCount': str(record['receive_count'])
+        }
+
+        if record['group_id']:
+            attributes['MessageGroupId'] = record['group_id']
+
+        return { 'MessageId' : record['id'], 'ReceiptHandle' : handle, 'Body' : record['body'], 'Attributes' : attributes }
@@ -0,0 +1,36 @@
+from abc import ABC, abstractmethod
+from typing import Dict, List, Optional
+
+# Messages are returned in the shape boto3's SQS receive_message uses:
+#
+# {
+#   'MessageId': str,
+#   'ReceiptHandle': str,
+#   'Body': str,
+#   'Attributes': { 'SentTimestamp': str (ms), 'ApproximateReceiveCount': str, 'MessageGroupId': str (optional) }
+# }
+#
+# so consumers behave the same regardless of the backend they run against.
+
+class MessageQueue(ABC):
+    @abstractmethod
+    def receive_messages(self, max_messages:int, wait_time_seconds:int) -> List[Dict]:
+        pass
+
+    @abstractmethod
+    def delete_messages(self, receipt_handles:List[str]) -> List[str]:
+        # Returns the receipt handles that could not be deleted.
+        pass
+
+    @abstractmethod
+    def change_visibility(self, receipt_handles:List[str], visibility_timeout:int) -> List[str]:
+        # Returns the receipt handles whose visibility could not be changed.
+        pass
+
+    @abstractmethod
+    def send_message(self, body:str, group_id:Optional[str]=None) -> str:
+        pass
+
+    @abstractmethod
+    def get_approximate_depth(self) -> int:
+        pass
@@ -0,0 +1,33 @@
+import os
+from typing import Dict, Callable
+
+from infra.env import env_int, env_str
+from services.queues.queue import MessageQueue
+
+_memory_queue = None
+
+def _make_sqs_queue() -> MessageQueue:
+    from services.queues.sqs import SqsQueue
+    return SqsQueue(os.environ['SQS_QUEUE_URL'])
+
+def _make_memory_queue() -> MessageQueue:
+    # All consumers in the process must share the same in-memory queue.
+    global _memory_queue
+
+    if _memory_queue is None:
+        from services.queues.memory import InMemoryQueue
+        _memory_queue = InMemoryQueue(env_int('SQS_VISIBILITY_TIMEOUT', 60))
+
+    return _memory_queue
+
+def _make_sqlite_queue() -> MessageQueue:
+    from services.queues.sqlite import SqliteQueue
+    return SqliteQueue(env_str('R1X_QUEUE_SQLITE_PATH', './r1x-queue.db'), env_int('SQS_VISIBILITY_TIMEOUT', 60))
+
+queue_factory_by_backend: Dict[str, Callable[[], MessageQueue]] = {'sqs': _make_sqs_queue, 'memory': _make_memory_queue, 'sqlite': _make_sqlite_queue}
+
+def get_queue_backend() -> str:
+    return env_str('R1X_QUEUE_BACKEND', 'sqs')
+
+def make_queue() -> MessageQueue:
+    return queue_factory_by_backend[get_queue_backend()]()
@@ -0,0 +1,132 @@
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Dict
+
+from services.queues.queue import MessageQueue
+
+# Durable local queue backed by a SQLite file, with SQS-like visibility timeouts and redelivery.
+# Several processes may share the same file; SQLite's write lock serializes receives.
+class SqliteQueue(MessageQueue):
+    def __init__(self, path:str, visibility_timeout:int=30, poll_interval:float=0.2):
+        super().__init__()
+        self.path = path
+        self.visibility_timeout = visibility_timeout
+        self.poll_interval = poll_interval
+
+        # sqlite3 connections can't be shared across threads; keep one per thread.
+        self._local = threading.local()
+
+        with self._connect() as conn:
+            conn.execute('''CREATE TABLE IF NOT EXISTS queue_messages (
+                id TEXT PRIMARY KEY,
+                seq INTEGER NOT NULL,
+                body TEXT NOT NULL,
+                group_id TEXT,
+                sent_at REAL NOT NULL,
+                visible_at REAL NOT NULL,
+                receive_count INTEGER NOT NULL DEFAULT 0,
+                receipt_handle TEXT
+            )''')
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_queue_messages_visible_at ON queue_messages (visible_at, seq)')
+            conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS ix_queue_messages_receipt_handle ON queue_messages (receipt_handle)')
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+
+        return conn
+
+    def receive_messages(self, max_messages, wait_time_seconds):
+        deadline = time.time() + wait_time_seconds
+
+        while True:
+            messages = self._receive_once(max_messages)
+
+            if messages or time.time() >= deadline:
+                return messages
+
+            time.sleep(self.poll_interval)
+
+    def _receive_once(self, max_messages):
+        conn = self._connect()
+        now = time.time()
+
+        conn.execute('BEGIN IMMEDIATE')
+
+        try:
+            rows = conn.execute('SELECT id FROM queue_messages WHERE visible_at <= ? ORDER BY seq LIMIT ?', (now, max_messages)).fetchall()
+
+            messages = []
+
+            for (message_id,) in rows:
+                handle = str(uuid.uuid4())
+                row = conn.execute('''UPDATE queue_messages
+                                      SET receipt_handle = ?, visible_at = ?, receive_count = receive_count + 1
+                                      WHERE id = ?
+                                      RETURNING id, body, group_id, sent_at, receive_count''',
+                                   (handle, now + self.visibility_timeout, message_id)).fetchone()
+                messages.append(self._to_message(row, handle))
+
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+        return messages
+
+    def delete_messages(self, receipt_handles):
+        conn = self._connect()
+        failed = []
+
+        for handle in receipt_handles:
+            cursor = conn.execute('DELETE FROM queue_messages WHERE receipt_handle = ?', (handle,))
+            if cursor.rowcount == 0:
+                failed.append(handle)
+
+        return failed
+
+    def change_visibility(self, receipt_handles, visibility_timeout):
+        conn = self._connect()
+        failed = []
+
+        for handle in receipt_handles:
+            cursor = conn.execute('UPDATE queue_messages SET visible_at = ? WHERE receipt_handle = ?', (time.time() + visibility_timeout, handle))
+            if cursor.rowcount == 0:
+                failed.append(handle)
+
+        return failed
+
+    def send_message(self, body, group_id=None):
+        conn = self._connect()
+        message_id = str(uuid.uuid4())
+        now = time.time()
+
+        conn.execute('''INSERT INTO queue_messages (id, seq, body, group_id, sent_at, visible_at)
+                        VALUES (?, (SELECT COALESCE(MAX(seq), 0) + 1 FROM queue_messages), ?, ?, ?, 0)''',
+                     (message_id, body, group_id, now))
+
+        return message_id
+
+    def get_approximate_depth(self):
+        conn = self._connect()
+        (depth,) = conn.execute('SELECT COUNT(*) FROM queue_messages WHERE visible_at <= ?', (time.time(),)).fetchone()
+        return depth
+
+    def _to_message(self, row, handle) -> Dict:
+        message_id, body, group_id, sent_at, receive_count = row
+
+        attributes = {
+            'SentTimestamp': str(int(sent_at * 1000)),
+            'ApproximateReceiveCount': str(receive_count)
+        }
+
+        if group_id:
+            attributes['MessageGroupId'] = group_id
+
+        return { 'MessageId' : message_id, 'ReceiptHandle' : handle, 'Body' : body, 'Attributes' : attributes }
@@ -0,0 +1,61 @@
+import os
+import uuid
+from typing import Dict, List
+
+import boto3
+
+from services.queues.queue import MessageQueue
+
+# SQS allows up to 10 entries per batch call.
+SQS_MAX_BATCH_SIZE = 10
+
+# System attributes requested on receive; MessageGroupId is only present on FIFO queues.
+SQS_ATTRIBUTE_NAMES = ['MessageGroupId', 'SentTimestamp', 'ApproximateReceiveCount']
+
+class SqsQueue(MessageQueue):
+    def __init__(self, queue_url:str):
+        super().__init__()
+        self.queue_url = queue_url
+        self.client = boto3.client('sqs', region_name=os.environ.get('SQS_REGION', 'eu-central-1'))
+
+    def receive_messages(self, max_messages, wait_time_seconds):
+        response = self.client.receive_message(
+            QueueUrl=self.queue_url,
+            MaxNumberOfMessages=min(max_messages, SQS_MAX_BATCH_SIZE),
+            WaitTimeSeconds=wait_time_seconds,
+            AttributeNames=SQS_ATTRIBUTE_NAMES
+        )
+
+        return response.get('Messages', [])
+
+    def delete_messages(self, receipt_handles):
+        return self._batch_call(self.client.delete_message_batch, receipt_handles, {})
+
+    def change_visibility(self, receipt_handles, visibility_timeout):
+        return self._batch_call(self.client.change_message_visibility_batch, receipt_handles, { 'VisibilityTimeout' : visibility_timeout })
+
+    def send_message(self, body, group_id=None):
+        args = { 'QueueUrl' : self.queue_url, 'MessageBody' : body }
+
+        if group_id:
+            args['MessageGroupId'] = group_id
+            args['MessageDeduplicationId'] = str(uuid.uuid4())
+
+        return self.client.send_message(**args)['MessageId']
+
+    def get_approximate_depth(self):
+        response = self.client.get_queue_attributes(QueueUrl=self.queue_url, AttributeNames=['ApproximateNumberOfMessages'])
+        return int(response['Attributes']['ApproximateNumberOfMessages'])
+
+    def _batch_call(self, fn, receipt_handles:List[str], extra_entry_args:Dict) -> List[str]:
+        failed = []
+
+        for i in range(0, len(receipt_handles), SQS_MAX_BATCH_SIZE):
+            chunk = receipt_handles[i:i + SQS_MAX_BATCH_SIZE]
+            entries = [dict({ 'Id' : str(j), 'ReceiptHandle' : handle }, **extra_entry_args) for j, handle in enumerate(chunk)]
+
+            response = fn(QueueUrl=self.queue_url, Entries=entries)
+
+            failed += [chunk[int(failure['Id'])] for failure in response.get('Failed', [])]
+
+        return failed
@@ -3,45 +3,71 @@ import datetime
 import time
 import traceback
 from typing import Tuple
-from infra import logger, utils 
+
+from sqlalchemy import delete, select
+
+from infra import logger, metrics, utils 
 from infra.context import Context
 utils.load_env()
 import db_models
 from services.messengers import messenger_factory
 
 def invoke_alert_tool(ctx:Context, alert_args:Tuple[int, str], parsed_message):
-    messenger_chat_id = f"{parsed_message.source}:{parsed_message.chatId}"
-    timestamp = int(parsed_message.messageTimestamp.timestamp())
-    ref_id = parsed_message.messageId
-    
     with db_models.Session() as session:
-        now = datetime.datetime.now()
-        delta_ts, topic = alert_args
-        timer_extra_data = {"topic":topic, "ref_id":ref_id}
-        trigger_ts = datetime.datetime.fromtimestamp(timestamp+ int(delta_ts))
-        timer = db_models.Timer(
-            chat_id=messenger_chat_id,
-            trigger_timestamp=trigger_ts, 
-            data=timer_extra_data,
-            created_at=now,
-            updated_at=now
-        )
+        timer = _make_timer(alert_args, parsed_message)
 
         session.add(timer)
         session.commit()
         session.refresh(timer)
 
-        session.close()
+    return timer
+
+async def invoke_alert_tool_async(ctx:Context, alert_args:Tuple[int, str], parsed_message):
+    async with db_models.async_session() as session:
+        timer = _make_timer(alert_args, parsed_message)
+
+        session.add(timer)
+        await session.commit()
+        await session.refresh(timer)
 
     return timer
 
+def _make_timer(alert_args:Tuple[int, str], parsed_message):
+    messenger_chat_id = f"{parsed_message.source}:{parsed_message.chatId}"
+    timestamp = int(parsed_message.messageTimestamp.timestamp())
+    ref_id = parsed_message.messageId
+
+    now = datetime.datetime.now()
+    delta_ts, topic = alert_args
+    timer_extra_data = {"topic":topic, "ref_id":ref_id}
+    trigger_ts = datetime.datetime.fromtimestamp(timestamp+ int(delta_ts))
+
+    return db_models.Timer(
+        chat_id=messenger_chat_id,
+        trigger_timestamp=trigger_ts, 
+        data=timer_extra_data,
+        created_at=now,
+        updated_at=now
+    )
+
+def get_due_alerts(ctx:Context, now:datetime.datetime):
+    with db_models.Session() as session:
+        return session.scalars(_due_alerts_statement(now)).all()
+
+async def get_due_alerts_async(ctx:Context, now:datetime.datetime):
+    async with db_models.async_session() as session:
+        return (await session.scalars(_due_alerts_statement(now))).all()
+
+def _due_alerts_statement(now:datetime.datetime):
+    return select(db_models.Timer).where(db_models.Timer.trigger_timestamp <= now)
+
 def alert_users():
     ctx = Context()
     while True:
         try:
+            loop_start = time.time()
             now = datetime.datetime.utcnow()
-            with db_models.Session() as session:
-                alerts = session.query(db_models.Timer).filter(db_models.Timer.trigger_timestamp <= now).all()
+            alerts = get_due_alerts(ctx, now)
             if alerts:
                 ctx.log(f"[TIMER] found {len(alerts)} alerts")                
                 
@@ -56,9 +82,12 @@ def alert_users():
                             "body": f"You asked me to remind you about {topic}" if topic else "You asked me to remind you",
                             "quote_id":quote_id
                         })
+                        metrics.counter('timer_alerts_sent').inc()
                     except:
+                        metrics.counter('timer_alerts_failed').inc()
                         ctx.log(f"[TIMER] failed to send alert {alert.id} to chat id:{alert.chat_id} ")
                 delete_alerts(ctx, now)                        
+            metrics.histogram('timer_loop_seconds').observe(time.time() - loop_start)
             time.sleep(5)
 
         except Exception as e:
@@ -66,6 +95,15 @@ def alert_users():
 
 def delete_alerts(ctx:Context, now:datetime.datetime) -> None:
     with db_models.Session() as session:
-        session.query(db_models.Timer).filter(db_models.Timer.trigger_timestamp <= now).delete()
+        session.execute(_delete_alerts_statement(now))
         ctx.log("[TIMER] alerts deleted")
-        session.commit()   
\ No newline at end of file
+        session.commit()
+
+async def delete_alerts_async(ctx:Context, now:datetime.datetime) -> None:
+    async with db_models.async_session() as session:
+        await session.execute(_delete_alerts_statement(now))
+        ctx.log("[TIMER] alerts deleted")
+        await session.commit()
+
+def _delete_alerts_statement(now:datetime.datetime):
+    return delete(db_models.Timer).where(db_models.Timer.trigger_timestamp <= now)
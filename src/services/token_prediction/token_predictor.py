@@ -2,6 +2,8 @@ import json
 import os
 import tiktoken
 
+from infra.executors import run_cpu_bound, run_cpu_bound_async
+
 # global variable to hold the encode objects between invocations
 encoder = tiktoken.get_encoding("cl100k_base")
 
@@ -18,10 +20,23 @@ def _num_tokens_from_messages(messages):
     num_tokens += 1
     return num_tokens
 
-def _get_message_tokens(message):
+# Roles are a handful of short strings; no need to encode them for every message.
+_role_tokens = {}
+
+def _get_role_tokens(role):
+    if role not in _role_tokens:
+        _role_tokens[role] = len(encoder.encode(role))
+
+    return _role_tokens[role]
+
+def _get_message_tokens(message, content_tokens=None):
     if len(message) == 0:
         raise ValueError(f"message is malformed. It's {message} but doesn't have any keys")
 
+    # Content token counts are stored with each message, so that history trimming doesn't re-encode it every turn.
+    if content_tokens is not None and message.keys() == {"role", "content"}:
+        return 4 + _get_role_tokens(message["role"]) + content_tokens
+
     num_tokens = 0
     num_tokens += 4
     for key, value in message.items():
@@ -31,7 +46,7 @@ def _get_message_tokens(message):
 
     return num_tokens
 
-def _get_message_index_upto_max_tokens(system_message, chat_messages, soft_token_limit, hard_token_limit):
+def _get_message_index_upto_max_tokens(system_message, chat_messages, soft_token_limit, hard_token_limit, content_tokens=None):
     num_tokens = 0
     num_tokens += 2
     num_tokens += 1
@@ -52,7 +67,7 @@ def _get_message_index_upto_max_tokens(system_message, chat_messages, soft_token
     for start_index in range(len(chat_messages), 0, -1):
         message = chat_messages[start_index - 1]
 
-        num_tokens += _get_message_tokens(message)
+        num_tokens += _get_message_tokens(message, content_tokens[start_index - 1] if content_tokens else None)
 
         if num_tokens <= soft_token_limit:
             num_messages += 1
@@ -66,10 +81,24 @@ def _get_message_index_upto_max_tokens(system_message, chat_messages, soft_token
 
     return [include_system_message, len(chat_messages) - num_messages]
 
-def get_messages_upto_max_tokens(ctx, system_message, chat_messages, soft_token_limit, hard_token_limit):
+def count_message_tokens(messages):
+    return run_cpu_bound(_num_tokens_from_messages, messages)
+
+def count_text_tokens(text):
+    return len(run_cpu_bound(encoder.encode, text))
+
+async def count_text_tokens_async(text):
+    return len(await run_cpu_bound_async(encoder.encode, text))
+
+# content_tokens, if provided, holds the precomputed token count of each chat message's content (None where unknown).
+def get_messages_upto_max_tokens(ctx, system_message, chat_messages, soft_token_limit, hard_token_limit, content_tokens=None):
     ctx.log(f"getMessagesUptoMaxTokens: chatMessages.length={len(chat_messages)}, softTokenLimit={soft_token_limit}, hardTokenLimit={hard_token_limit}")
 
-    include_system_message, start_index = _get_message_index_upto_max_tokens(system_message, chat_messages, soft_token_limit, hard_token_limit)
+    # With all counts known, trimming is plain arithmetic and not worth a trip to the CPU pool.
+    if content_tokens and None not in content_tokens:
+        include_system_message, start_index = _get_message_index_upto_max_tokens(system_message, chat_messages, soft_token_limit, hard_token_limit, content_tokens)
+    else:
+        include_system_message, start_index = run_cpu_bound(_get_message_index_upto_max_tokens, system_message, chat_messages, soft_token_limit, hard_token_limit, content_tokens)
 
     result = [system_message] if include_system_message else []
 
@@ -0,0 +1,124 @@
+import select
+import threading
+import time
+import traceback
+from typing import Any, Dict
+
+import db_models
+from infra import logger
+from infra.cache import TTLCache
+from infra.env import env_int
+
+# Settings change rarely, but are looked up for every incoming message, including for disabled users.
+# Entries are invalidated explicitly through Postgres NOTIFY (see tools/user_settings.py), and expire regardless.
+USER_SETTINGS_CACHE_SIZE = env_int('USER_SETTINGS_CACHE_SIZE', 10000)
+USER_SETTINGS_CACHE_TTL = env_int('USER_SETTINGS_CACHE_TTL', 60)
+
+# Users without settings, or not enabled, only ever get a canned reply; cache them longer.
+USER_SETTINGS_NEGATIVE_CACHE_TTL = env_int('USER_SETTINGS_NEGATIVE_CACHE_TTL', 300)
+
+# Postgres channel used to broadcast settings changes; payload is the user id.
+INVALIDATION_CHANNEL = 'user_settings_changed'
+
+settings_cache = TTLCache('user_settings', USER_SETTINGS_CACHE_SIZE, USER_SETTINGS_CACHE_TTL)
+
+_listener_started = False
+_listener_lock = threading.Lock()
+
+def get_user_settings(parsed_message) -> Dict[str, Any]:
+    user_id = f"{parsed_message.source}:{parsed_message.chatId}"
+
+    _ensure_invalidation_listener()
+
+    found, settings = settings_cache.get(user_id)
+    if found:
+        return dict(settings)
+
+    settings = _load_user_settings(user_id)
+    _cache_user_settings(user_id, settings)
+
+    return dict(settings)
+
+async def get_user_settings_async(parsed_message) -> Dict[str, Any]:
+    user_id = f"{parsed_message.source}:{parsed_message.chatId}"
+
+    _ensure_invalidation_listener()
+
+    found, settings = settings_cache.get(user_id)
+    if found:
+        return dict(settings)
+
+    async with db_models.async_session() as session:
+        settings = await session.get(db_models.CurrentUserSettings, user_id)
+
+    settings = getattr(settings, 'settings', {})
+    _cache_user_settings(user_id, settings)
+
+    return dict(settings)
+
+def _cache_user_settings(user_id, settings) -> None:
+    ttl = USER_SETTINGS_CACHE_TTL if settings.get('enabled', False) else USER_SETTINGS_NEGATIVE_CACHE_TTL
+    settings_cache.set(user_id, settings, ttl)
+
+def _load_user_settings(user_id) -> Dict[str, Any]:
+    # Primary key lookup; the history in user_settings is never read here.
+    with db_models.Session() as session:
+        settings = session.get(db_models.CurrentUserSettings, user_id)
+
+    return getattr(settings, 'settings', {})
+
+def invalidate_user_settings(user_id:str) -> None:
+    settings_cache.invalidate(user_id)
+
+def _ensure_invalidation_listener():
+    global _listener_started
+
+    if _listener_started:
+        return
+
+    with _listener_lock:
+        if _listener_started:
+            return
+
+        _listener_started = True
+
+    # LISTEN/NOTIFY is Postgres-only; other databases rely on expiry alone.
+    if db_models.get_engine().dialect.name != 'postgresql':
+        return
+
+    threading.Thread(target=_listen_for_invalidations, name='user-settings-listener', daemon=True).start()
+
+def _listen_for_invalidations():
+    while True:
+        dbapi_connection = None
+
+        try:
+            # Detached, so that the long-lived listening connection doesn't occupy a pool slot.
+            connection = db_models.get_engine().raw_connection()
+            connection.detach()
+
+            dbapi_connection = connection.driver_connection
+            dbapi_connection.autocommit = True
+            dbapi_connection.cursor().execute(f'LISTEN {INVALIDATION_CHANNEL}')
+
+            # Anything may have changed while not listening.
+            settings_cache.clear()
+
+            while True:
+                if select.select([dbapi_connection], [], [], 60) == ([], [], []):
+                    continue
+
+                dbapi_connection.poll()
+
+                while dbapi_connection.notifies:
+                    notify = dbapi_connection.notifies.pop(0)
+                    logger.logger.info(f'[user-settings] invalidating cached settings for {notify.payload}')
+                    invalidate_user_settings(notify.payload)
+        except Exception as e:
+            logger.logger.error(f'Exception occurred; {e}; stack trace: ', traceback.format_exc())
+            settings_cache.clear()
+
+            if dbapi_connection is not None:
+                dbapi_connection.close()
+
+        time.sleep(5)
@@ -0,0 +1,257 @@
+import atexit
+import collections
+import datetime
+import os
+import queue
+import signal
+import threading
+import time
+import traceback
+from typing import Any, Dict, List, Optional
+
+from infra import logger, metrics
+from infra.context import Context
+from infra.env import env_bool, env_int
+from services import message_db
+from services.history_cache import HistoryMessage, history_cache
+
+# Optional background writer for bot replies: once a reply was sent, storing it (and its stats event) doesn't need
+# to hold up the worker. Rows are written in multi-row batches, when WRITE_BEHIND_BATCH_SIZE rows are queued or
+# WRITE_BEHIND_FLUSH_MS after the first one, and on shutdown. Until written, history reads include them.
+#
+# Only history reads of this process see unwritten replies, so the writer is only used when this process is the only
+# consumer (see HISTORY_CACHE_EXCLUSIVE); otherwise, the next turn of a chat may be handled elsewhere, without them.
+WRITE_BEHIND_ENABLED = env_bool('R1X_WRITE_BEHIND')
+WRITE_BEHIND_BATCH_SIZE = env_int('WRITE_BEHIND_BATCH_SIZE', 50)
+WRITE_BEHIND_FLUSH_MS = env_int('WRITE_BEHIND_FLUSH_MS', 200)
+WRITE_BEHIND_QUEUE_SIZE = env_int('WRITE_BEHIND_QUEUE_SIZE', 1000)
+
+# How long shutdown waits for queued rows to be written.
+SHUTDOWN_TIMEOUT = 10
+
+_STOP = object()
+
+class PendingMessage:
+    def __init__(self, attributes):
+        # Stored with the time it was accepted rather than written, so that it keeps its place in the chat's history.
+        created_at = datetime.datetime.now()
+
+        self.attributes = dict(attributes, createdAt=created_at)
+        self.key = (attributes['chatId'], attributes['messageId'])
+        self.id = None          # type: Optional[int]
+        self.history_message = HistoryMessage(None, attributes['source'], attributes['chatId'], attributes['messageId'],
+                                              datetime.datetime.fromtimestamp(attributes['messageTimestamp'], tz=datetime.timezone.utc),
+                                              created_at, attributes['isSentByMe'], attributes['body'], None)
+
+class WriteBehindWriter:
+    def __init__(self, batch_size: int, flush_interval: float, queue_size: int):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._stopped = threading.Event()
+
+        self._lock = threading.Lock()
+        self._pending = collections.defaultdict(list)     # chat_id -> [PendingMessage]
+
+        self._ctx = Context()
+
+        self._queue_depth = metrics.gauge('write_behind_queue_depth')
+        self._batch_size_histogram = metrics.histogram('write_behind_batch_size', (1, 2, 5, 10, 20, 50, 100))
+        self._flush_seconds = metrics.histogram('write_behind_flush_seconds')
+        self._overflows = metrics.counter('write_behind_overflows')
+        self._failures = metrics.counter('write_behind_failures')
+
+        self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+        self._thread.start()
+
+    def store_message(self, ctx: Context, attributes) -> Any:
+        pending_message = PendingMessage(attributes)
+
+        with self._lock:
+            self._pending[attributes['chatId']].append(pending_message)
+
+        try:
+            self._queue.put_nowait(('message', pending_message))
+        except queue.Full:
+            # Writes can't keep up; store inline rather than grow without bound.
+            self._overflows.inc()
+            self._remove_pending([pending_message])
+
+            return message_db.insert_message(ctx, attributes)
+
+        self._queue_depth.set(self._queue.qsize())
+
+        return pending_message
+
+    def store_event(self, event_type: str, message, body: Dict[str, Any]) -> None:
+        # message is either a stored message, or a PendingMessage returned by store_message.
+        try:
+            self._queue.put_nowait(('event', (event_type, message, body)))
+        except queue.Full:
+            self._overflows.inc()
+
+    def pending_history(self, chat_id: str) -> List[HistoryMessage]:
+        with self._lock:
+            return [pending_message.history_message for pending_message in self._pending.get(chat_id, [])]
+
+    def close(self) -> None:
+        if self._stopped.is_set():
+            return
+
+        self._queue.put(_STOP)
+        self._stopped.wait(SHUTDOWN_TIMEOUT)
+
+    def _run(self):
+        stopping = False
+
+        while not stopping:
+            batch = [self._queue.get()]
+            deadline = time.time() + self.flush_interval
+
+            # Shutdown doesn't wait for the flush interval.
+            while len(batch) < self.batch_size and batch[-1] is not _STOP:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            if _STOP in batch:
+                # Everything queued before shutdown is written; nothing can be queued after it.
+                batch.remove(_STOP)
+                batch.extend(self._drain())
+                stopping = True
+
+            self._queue_depth.set(self._queue.qsize())
+
+            try:
+                self._flush(batch)
+            except Exception as e:
+                logger.logger.error(f'Exception occurred; {e}; stack trace: ', traceback.format_exc())
+
+        self._stopped.set()
+
+    def _drain(self):
+        items = []
+
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                return items
+
+            if item is not _STOP:
+                items.append(item)
+
+    def _flush(self, batch):
+        messages = [item for kind, item in batch if kind == 'message']
+        events = []
+
+        for kind, item in batch:
+            if kind != 'event':
+                continue
+
+            event_type, message, body = item
+            if isinstance(message, PendingMessage):
+                events.append({'type': event_type, 'ref_id': message.id, 'key': message.key, 'body': body})
+            else:
+                events.append({'type': event_type, 'ref_id': message.id, 'body': body})
+
+        if not messages and not events:
+            return
+
+        self._batch_size_histogram.observe(len(batch))
+        start = time.time()
+
+        try:
+            stored = message_db.insert_messages(self._ctx, [message.attributes for message in messages], events)
+        except Exception as e:
+            self._failures.inc()
+            logger.logger.error(f'Exception occurred; {e}; stack trace: ', traceback.format_exc())
+
+            # Retry one by one, so that a single bad row doesn't lose the whole batch; events are dropped.
+            for message in messages:
+                try:
+                    message.id = message_db.insert_message(self._ctx, message.attributes).id
+                except Exception as e:
+                    logger.logger.error(f'Exception occurred; {e}; stack trace: ', traceback.format_exc())
+
+            self._remove_pending(messages)
+            return
+
+        for message in messages:
+            stored_message = stored.get(message.key)
+            if stored_message is not None:
+                message.id = stored_message.id
+
+        self._remove_pending(messages)
+        self._flush_seconds.observe(time.time() - start)
+
+    def _remove_pending(self, messages: List[PendingMessage]) -> None:
+        with self._lock:
+            for message in messages:
+                chat_pending = self._pending.get(message.attributes['chatId'])
+                if chat_pending is None:
+                    continue
+
+                if message in chat_pending:
+                    chat_pending.remove(message)
+
+                if not chat_pending:
+                    del self._pending[message.attributes['chatId']]
+
+writer = None       # type: Optional[WriteBehindWriter]
+
+def start() -> None:
+    # Called once per process by the consumer entry point, from the main thread.
+    global writer
+
+    if not WRITE_BEHIND_ENABLED or writer is not None:
+        return
+
+    if not history_cache.exclusive:
+        logger.logger.info('[write-behind] not the only consumer; replies are written inline.')
+        return
+
+    writer = WriteBehindWriter(WRITE_BEHIND_BATCH_SIZE, WRITE_BEHIND_FLUSH_MS / 1000, WRITE_BEHIND_QUEUE_SIZE)
+    message_db.register_pending_source(writer.pending_history)
+
+    atexit.register(shutdown)
+    _flush_on_sigterm()
+
+def store_reply(ctx: Context, attributes):
+    # Returns the stored message, or a PendingMessage when written in the background.
+    if writer is None:
+        return message_db.insert_message(ctx, attributes)
+
+    return writer.store_message(ctx, attributes)
+
+def store_event(event_type: str, message, body: Dict[str, Any]) -> None:
+    # Events are only recorded by the background writer, where they don't add latency.
+    if writer is None or message is None:
+        return
+
+    writer.store_event(event_type, message, body)
+
+def shutdown() -> None:
+    if writer is not None:
+        writer.close()
+
+def _flush_on_sigterm():
+    previous_handler = signal.getsignal(signal.SIGTERM)
+    if previous_handler is None:
+        previous_handler = signal.SIG_DFL
+
+    def handle_sigterm(signum, frame):
+        logger.logger.info('[write-behind] flushing pending writes before exiting...')
+        shutdown()
+
+        # Continue with the previous behavior, which is normally to exit.
+        signal.signal(signal.SIGTERM, previous_handler)
+        os.kill(os.getpid(), signum)
+
+    signal.signal(signal.SIGTERM, handle_sigterm)
@@ -0,0 +1,123 @@
+import asyncio
+import datetime
+import time
+import unittest
+
+from test import testenv     # paths and settings; must be imported first
+
+from box import Box
+
+import db_models
+from infra.context import Context
+from services import message_db, timers, user_settings
+
+def make_message(message_id, chat_id='tg-async', is_sent_by_me=False, body='hello there', timestamp=None):
+    return Box({
+        'source': 'tg',
+        'messageTimestamp': timestamp or time.time(),
+        'chatType': 'private',
+        'chatId': chat_id,
+        'senderId': 'bot' if is_sent_by_me else 'user',
+        'isSentByMe': is_sent_by_me,
+        'isForwarded': False,
+        'messageId': str(message_id),
+        'replyToMessageId': None,
+        'kind': 'text',
+        'body': body,
+        'rawSource': None
+    })
+
+def run(coroutine_fn):
+    # Async engine connections belong to the event loop that opened them; each test runs in its own loop.
+    async def run_and_dispose():
+        try:
+            return await coroutine_fn()
+        finally:
+            await db_models.get_async_engine().dispose()
+
+    return asyncio.run(run_and_dispose())
+
+class AsyncMessageDbTest(unittest.TestCase):
+    def test_insert_message_async_stores_token_count(self):
+        ctx = Context()
+
+        async def scenario():
+            message = await message_db.insert_message_async(ctx, make_message(1, chat_id='tg-insert'))
+            duplicate = await message_db.insert_message_async(ctx, make_message(1, chat_id='tg-insert'))
+
+            return message, duplicate
+
+        message, duplicate = run(scenario)
+
+        self.assertIsNotNone(message.id)
+        self.assertGreater(message.tokenCount, 0)
+        self.assertEqual(duplicate.id, message.id)
+
+    def test_history_matches_sync_history(self):
+        ctx = Context()
+        now = time.time()
+
+        async def scenario():
+            for i in range(3):
+                await message_db.insert_message_async(ctx, make_message(i, chat_id='tg-history', is_sent_by_me=(i == 1), timestamp=now + i))
+
+            query = Box({'chatId': 'tg-history', 'messageTimestamp': datetime.datetime.fromtimestamp(now + 10, tz=datetime.timezone.utc)})
+            return await message_db.get_message_history_async(ctx, query), query
+
+        history, query = run(scenario)
+
+        self.assertEqual([m.messageId for m in history], ['0', '1', '2'])
+        self.assertEqual(history, message_db.get_message_history(ctx, query))
+
+    def test_newer_incoming_messages_skip_own_messages(self):
+        ctx = Context()
+
+        async def scenario():
+            first = await message_db.insert_message_async(ctx, make_message(1, chat_id='tg-newer'))
+            await message_db.insert_message_async(ctx, make_message(2, chat_id='tg-newer', is_sent_by_me=True))
+            await message_db.insert_message_async(ctx, make_message(3, chat_id='tg-newer'))
+
+            return await message_db.get_newer_incoming_messages_async(ctx, first)
+
+        newer_messages = run(scenario)
+
+        self.assertEqual([m.messageId for m in newer_messages], ['3'])
+
+class AsyncTimersTest(unittest.TestCase):
+    def test_due_alerts_are_returned_and_deleted(self):
+        ctx = Context()
+        parsed_message = Box({'source': 'tg', 'chatId': 'tg-timers', 'messageId': '1', 'messageTimestamp': datetime.datetime.now()})
+
+        async def scenario():
+            await timers.invoke_alert_tool_async(ctx, (0, 'stretch'), parsed_message)
+
+            now = datetime.datetime.now() + datetime.timedelta(seconds=1)
+            due = await timers.get_due_alerts_async(ctx, now)
+            await timers.delete_alerts_async(ctx, now)
+
+            return due, await timers.get_due_alerts_async(ctx, now)
+
+        due, remaining = run(scenario)
+
+        self.assertIn('stretch', [alert.data['topic'] for alert in due])
+        self.assertEqual(remaining, [])
+
+class AsyncUserSettingsTest(unittest.TestCase):
+    def test_settings_are_loaded_by_user_id(self):
+        now = datetime.datetime.now(datetime.timezone.utc)
+
+        with db_models.Session() as session:
+            history = db_models.UserSettings(user_id='tg:async-user', settings={'enabled': True}, version=1, createdAt=now, updatedAt=now)
+            session.add(history)
+            session.flush()
+
+            session.add(db_models.CurrentUserSettings(user_id='tg:async-user', settings={'enabled': True}, version=1,
+                                                      user_settings_id=history.id, updatedAt=now))
+            session.commit()
+
+        settings = run(lambda: user_settings.get_user_settings_async(Box({'source': 'tg', 'chatId': 'async-user'})))
+
+        self.assertEqual(settings, {'enabled': True})
+
+if __name__ == '__main__':
+    unittest.main()
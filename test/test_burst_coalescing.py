@@ -0,0 +1,58 @@
+import json
+import time
+import unittest
+from unittest import mock
+
+from test import testenv     # paths and settings; must be imported first
+
+from box import Box
+
+import message_handler
+from infra.context import Context
+from services.messengers.tg import TELEGRAM_SENDER_ID, TelegramMessenger
+
+def make_tg_event(message_id, chat_type='private', sender_id=42, **content):
+    return json.dumps({'source': 'tg', 'event': {'message': dict({
+        'message_id': message_id,
+        'date': int(time.time()),
+        'chat': {'id': 1, 'type': chat_type},
+        'from': {'id': sender_id}
+    }, **content)}})
+
+def make_stored_message(chat_type='private'):
+    return Box({'chatType': chat_type, 'chatId': '1', 'messageId': '1'})
+
+class BurstCoalescingTest(unittest.TestCase):
+    def is_superseded(self, queued_events, chat_type='private'):
+        ctx = Context()
+        ctx.user_settings = {'coalesce_window_ms': 1}
+        ctx.queued_in_chat = lambda: queued_events
+
+        with mock.patch.object(message_handler, 'get_newer_incoming_messages', return_value=[]):
+            return message_handler.is_superseded_by_burst(ctx, TelegramMessenger('1'), make_stored_message(chat_type), time.time() - 1)
+
+    def test_not_superseded_without_later_messages(self):
+        self.assertFalse(self.is_superseded([]))
+
+    def test_superseded_by_a_queued_text(self):
+        self.assertTrue(self.is_superseded([make_tg_event(2, text='and another thing')]))
+
+    def test_superseded_by_a_queued_voice_message(self):
+        self.assertTrue(self.is_superseded([make_tg_event(2, voice={'file_id': 'f', 'file_unique_id': 'u'})]))
+
+    def test_not_superseded_by_messages_that_get_no_reply(self):
+        queued_events = [
+            make_tg_event(2, sticker={'file_id': 'f'}),
+            make_tg_event(3, text='sent by the bot', sender_id=int(TELEGRAM_SENDER_ID)),
+            make_tg_event(4, voice={'file_id': 'f', 'file_unique_id': 'u'}, forward_from={'id': 7}),
+            'not json'
+        ]
+
+        self.assertFalse(self.is_superseded(queued_events))
+
+    def test_group_messages_only_count_if_addressed_to_the_bot(self):
+        self.assertFalse(self.is_superseded([make_tg_event(2, chat_type='group', text='hello all')], chat_type='group'))
+        self.assertTrue(self.is_superseded([make_tg_event(2, chat_type='group', text='@r1x_test_bot hello')], chat_type='group'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+import threading
+import time
+import unittest
+
+from test import testenv     # paths and settings; must be imported first
+
+from infra.dispatcher import ChatDispatcher
+
+class ChatDispatcherTest(unittest.TestCase):
+    def test_items_of_a_key_run_in_submission_order(self):
+        dispatcher = ChatDispatcher(8, name='test-order')
+        lock = threading.Lock()
+        executed = {'a': [], 'b': [], 'c': []}
+
+        def work(key, i):
+            # Varying durations, so that a missing ordering guarantee would show.
+            time.sleep(0.001 * ((i * 7) % 3))
+
+            with lock:
+                executed[key].append(i)
+
+        futures = [dispatcher.submit(key, work, key, i) for i in range(30) for key in executed]
+
+        for future in futures:
+            future.result(timeout=10)
+
+        for key in executed:
+            self.assertEqual(executed[key], list(range(30)))
+
+    def test_items_of_a_key_never_overlap(self):
+        dispatcher = ChatDispatcher(8, name='test-overlap')
+        running = {'count': 0, 'max': 0}
+        lock = threading.Lock()
+
+        def work():
+            with lock:
+                running['count'] += 1
+                running['max'] = max(running['max'], running['count'])
+
+            time.sleep(0.005)
+
+            with lock:
+                running['count'] -= 1
+
+        futures = [dispatcher.submit('chat', work) for _ in range(10)]
+
+        for future in futures:
+            future.result(timeout=10)
+
+        self.assertEqual(running['max'], 1)
+
+    def test_different_keys_run_in_parallel(self):
+        dispatcher = ChatDispatcher(2, name='test-parallel')
+        barrier = threading.Barrier(2, timeout=5)
+
+        # Each item waits for the other; this only completes if both run at the same time.
+        futures = [dispatcher.submit(key, barrier.wait) for key in ('a', 'b')]
+
+        for future in futures:
+            future.result(timeout=10)
+
+    def test_queued_behind_counts_waiting_items(self):
+        dispatcher = ChatDispatcher(1, name='test-queued')
+        release = threading.Event()
+
+        first = dispatcher.submit('chat', release.wait, 5)
+        later = [dispatcher.submit('chat', lambda: None) for _ in range(3)]
+
+        self.assertEqual(dispatcher.queued_behind('chat'), 3)
+        self.assertEqual(dispatcher.queued_behind('other'), 0)
+
+        release.set()
+
+        for future in [first] + later:
+            future.result(timeout=10)
+
+        self.assertEqual(dispatcher.queued_behind('chat'), 0)
+
+    def test_queued_args_lists_waiting_items_in_order(self):
+        dispatcher = ChatDispatcher(1, name='test-queued-args')
+        release = threading.Event()
+
+        first = dispatcher.submit('chat', release.wait, 5)
+        later = [dispatcher.submit('chat', lambda i: i, i) for i in range(3)]
+
+        self.assertEqual(dispatcher.queued_args('chat'), [(0,), (1,), (2,)])
+        self.assertEqual(dispatcher.queued_args('other'), [])
+
+        release.set()
+
+        for future in [first] + later:
+            future.result(timeout=10)
+
+    def test_failure_does_not_block_later_items_of_the_key(self):
+        dispatcher = ChatDispatcher(2, name='test-failure')
+
+        def fail():
+            raise ValueError('boom')
+
+        failed = dispatcher.submit('chat', fail)
+        succeeded = dispatcher.submit('chat', lambda: 'ok')
+
+        with self.assertRaises(ValueError):
+            failed.result(timeout=10)
+
+        self.assertEqual(succeeded.result(timeout=10), 'ok')
+
+    def test_scaling_down_keeps_processing(self):
+        dispatcher = ChatDispatcher(4, name='test-scale')
+        dispatcher.set_num_workers(1)
+
+        futures = [dispatcher.submit(f'chat-{i}', lambda i=i: i) for i in range(10)]
+
+        self.assertEqual([future.result(timeout=10) for future in futures], list(range(10)))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+import datetime
+import time
+import unittest
+from unittest import mock
+
+from test import testenv     # paths and settings; must be imported first
+
+from services.history_cache import HistoryCache, HistoryMessage
+
+BASE_TIME = datetime.datetime(2026, 1, 1, tzinfo=datetime.timezone.utc)
+
+def make_message(i, chat_id='chat', body='hello'):
+    timestamp = BASE_TIME + datetime.timedelta(seconds=i)
+    return HistoryMessage(i, 'tg', chat_id, str(i), timestamp, timestamp, i % 2 == 1, body, 1)
+
+def make_cache(turns=5, max_chats=10, max_bytes=1024 * 1024, idle_seconds=300, exclusive=True):
+    return HistoryCache('test', turns, max_chats, max_bytes, idle_seconds, exclusive)
+
+def latest(i):
+    return BASE_TIME + datetime.timedelta(seconds=i)
+
+class HistoryCacheTest(unittest.TestCase):
+    def test_miss_until_stored(self):
+        cache = make_cache()
+
+        self.assertIsNone(cache.get('chat', latest(10), 3))
+
+        cache.store('chat', [make_message(i) for i in range(3)], cache.begin_load())
+
+        self.assertEqual([m.id for m in cache.get('chat', latest(10), 3)], [0, 1, 2])
+
+    def test_appended_messages_are_served(self):
+        cache = make_cache(turns=5)
+        cache.store('chat', [make_message(i) for i in range(5)], cache.begin_load())
+
+        cache.append('chat', make_message(5))
+        cache.append('chat', make_message(6))
+
+        self.assertEqual([m.id for m in cache.get('chat', latest(10), 5)], [2, 3, 4, 5, 6])
+
+        # Older turns were dropped from the ring buffer, so longer histories need the database.
+        self.assertIsNone(cache.get('chat', latest(10), 6))
+
+    def test_complete_history_is_served_even_if_short(self):
+        cache = make_cache(turns=5)
+        cache.store('chat', [make_message(i) for i in range(2)], cache.begin_load())
+
+        self.assertEqual([m.id for m in cache.get('chat', latest(10), 5)], [0, 1])
+
+    def test_history_is_cut_at_the_message_time(self):
+        cache = make_cache(turns=5)
+        cache.store('chat', [make_message(i) for i in range(4)], cache.begin_load())
+
+        self.assertEqual([m.id for m in cache.get('chat', latest(1), 5)], [0, 1])
+
+    def test_out_of_order_appends_are_sorted(self):
+        cache = make_cache(turns=5)
+        cache.store('chat', [make_message(0)], cache.begin_load())
+
+        cache.append('chat', make_message(2))
+        cache.append('chat', make_message(1))
+
+        self.assertEqual([m.id for m in cache.get('chat', latest(10), 5)], [0, 1, 2])
+
+    def test_load_racing_a_write_is_not_cached(self):
+        cache = make_cache()
+
+        load_sequence = cache.begin_load()
+        cache.append('chat', make_message(3))
+        cache.store('chat', [make_message(i) for i in range(3)], load_sequence)
+
+        self.assertIsNone(cache.get('chat', latest(10), 3))
+
+    def test_invalidate_drops_the_chat(self):
+        cache = make_cache()
+        cache.store('chat', [make_message(i) for i in range(3)], cache.begin_load())
+
+        cache.invalidate('chat')
+
+        self.assertIsNone(cache.get('chat', latest(10), 3))
+
+    def test_least_recently_used_chats_are_evicted(self):
+        cache = make_cache(max_chats=2)
+
+        for chat_id in ('a', 'b'):
+            cache.store(chat_id, [make_message(0, chat_id=chat_id)], cache.begin_load())
+
+        cache.get('a', latest(10), 1)
+        cache.store('c', [make_message(0, chat_id='c')], cache.begin_load())
+
+        self.assertIsNotNone(cache.get('a', latest(10), 1))
+        self.assertIsNone(cache.get('b', latest(10), 1))
+        self.assertIsNotNone(cache.get('c', latest(10), 1))
+
+    def test_memory_bound_evicts_chats(self):
+        cache = make_cache(max_bytes=3000)
+
+        for chat_id in ('a', 'b'):
+            cache.store(chat_id, [make_message(0, chat_id=chat_id, body='x' * 2000)], cache.begin_load())
+
+        self.assertIsNone(cache.get('a', latest(10), 1))
+        self.assertIsNotNone(cache.get('b', latest(10), 1))
+
+    def test_idle_chats_are_not_served(self):
+        cache = make_cache(idle_seconds=300)
+        cache.store('chat', [make_message(0)], cache.begin_load())
+
+        with mock.patch('time.time', return_value=time.time() + 301):
+            self.assertIsNone(cache.get('chat', latest(10), 1))
+
+    def test_shared_consumers_never_use_the_cache(self):
+        cache = make_cache(exclusive=False)
+        cache.store('chat', [make_message(i) for i in range(3)], cache.begin_load())
+
+        self.assertIsNone(cache.get('chat', latest(10), 3))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,178 @@
+import datetime
+import json
+import unittest
+from unittest import mock
+
+from test import testenv     # paths and settings; must be imported first
+
+from box import Box
+
+import db_models
+import message_handler
+from infra.context import Context
+from services import idempotency
+from services.idempotency import MessageInProgressError, ProcessingStateE
+
+def make_message(message_id, chat_id='chat'):
+    return Box({'source': 'tg', 'chatId': chat_id, 'messageId': str(message_id), 'isSentByMe': False})
+
+def set_updated_at(message, updated_at):
+    with db_models.Session() as session:
+        session.query(db_models.ProcessedMessage).filter(idempotency._filter(message)).update({'updated_at': updated_at})
+        session.commit()
+
+class ProcessingStateTest(unittest.TestCase):
+    def test_first_delivery_is_claimed(self):
+        ctx = Context()
+        message = make_message(1, chat_id='claim')
+
+        self.assertIsNone(idempotency.begin_processing(ctx, message))
+
+        with self.assertRaises(MessageInProgressError):
+            idempotency.begin_processing(ctx, message)
+
+    def test_done_messages_are_reported(self):
+        ctx = Context()
+        message = make_message(1, chat_id='done')
+
+        idempotency.begin_processing(ctx, message)
+        idempotency.record_reply(ctx, message, {'chat_id': 'done', 'kind': 'text', 'body': 'hi'})
+        idempotency.mark_done(ctx, message)
+
+        self.assertEqual(idempotency.begin_processing(ctx, message).state, ProcessingStateE.DONE)
+
+    def test_unconfirmed_replies_are_returned_for_resending(self):
+        ctx = Context()
+        message = make_message(1, chat_id='replied')
+
+        idempotency.begin_processing(ctx, message)
+        idempotency.record_reply(ctx, message, {'chat_id': 'replied', 'kind': 'text', 'body': 'hi'})
+
+        processing = idempotency.begin_processing(ctx, message)
+
+        self.assertEqual(processing.state, ProcessingStateE.REPLIED)
+        self.assertEqual(processing.reply['body'], 'hi')
+
+    def test_stale_claims_are_taken_over(self):
+        ctx = Context()
+        message = make_message(1, chat_id='takeover')
+
+        idempotency.begin_processing(ctx, message)
+
+        stale = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=idempotency.IN_PROGRESS_TIMEOUT_SECONDS + 1)
+        set_updated_at(message, stale)
+
+        self.assertEqual(idempotency.begin_processing(ctx, message).state, ProcessingStateE.PROCESSING)
+
+        # The new owner's claim is fresh again.
+        with self.assertRaises(MessageInProgressError):
+            idempotency.begin_processing(ctx, message)
+
+    def test_released_claims_are_retried(self):
+        ctx = Context()
+        message = make_message(1, chat_id='release')
+
+        idempotency.begin_processing(ctx, message)
+        idempotency.release(ctx, message)
+
+        self.assertIsNone(idempotency.begin_processing(ctx, message))
+
+    def test_release_keeps_recorded_replies(self):
+        ctx = Context()
+        message = make_message(1, chat_id='release-replied')
+
+        idempotency.begin_processing(ctx, message)
+        idempotency.record_reply(ctx, message, {'chat_id': 'release-replied', 'kind': 'text', 'body': 'hi'})
+        idempotency.release(ctx, message)
+
+        self.assertEqual(idempotency.begin_processing(ctx, message).state, ProcessingStateE.REPLIED)
+
+    def test_purge_only_removes_old_done_records(self):
+        ctx = Context()
+        old = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=idempotency.RETENTION_DAYS + 1)
+
+        done, processing = make_message(1, chat_id='purge'), make_message(2, chat_id='purge')
+
+        for message in (done, processing):
+            idempotency.begin_processing(ctx, message)
+
+        idempotency.mark_done(ctx, done)
+
+        for message in (done, processing):
+            set_updated_at(message, old)
+
+        idempotency.purge_processed_messages()
+
+        self.assertIsNone(idempotency.begin_processing(ctx, done))
+        self.assertEqual(idempotency.begin_processing(ctx, processing).state, ProcessingStateE.PROCESSING)
+
+class FakeMessenger:
+    def __init__(self, parsed_message):
+        self.parsed_message = parsed_message
+
+    def parse_message(self, event):
+        return self.parsed_message, None
+
+    def set_status_read(self, ctx, message_id):
+        pass
+
+class HandlerIdempotencyTest(unittest.TestCase):
+    def handle(self, message, handle_parsed_message):
+        event = json.dumps({'source': 'tg', 'event': {}})
+
+        with mock.patch('services.messengers.messenger_factory.make_messenger_from_event', return_value=FakeMessenger(message)), \
+             mock.patch.object(message_handler, 'get_user_settings', return_value={'enabled': True}), \
+             mock.patch.object(message_handler, 'handle_parsed_message', side_effect=handle_parsed_message), \
+             mock.patch.object(message_handler, 'send_and_store') as send_and_store:
+            message_handler.handle_incoming_message_core(Context(), event, {'working': True})
+
+        return send_and_store
+
+    def test_redelivery_after_a_failure_is_handled_again(self):
+        message = make_message(1, chat_id='handler-retry')
+        attempts = []
+
+        def fail_once(*args):
+            attempts.append(1)
+            if len(attempts) == 1:
+                raise ValueError('transient failure')
+
+        with self.assertRaises(ValueError):
+            self.handle(message, fail_once)
+
+        self.handle(message, fail_once)
+
+        self.assertEqual(len(attempts), 2)
+        self.assertEqual(idempotency.begin_processing(Context(), message).state, ProcessingStateE.DONE)
+
+    def test_redelivery_of_a_done_message_is_skipped(self):
+        message = make_message(1, chat_id='handler-done')
+        handle_parsed_message = mock.Mock()
+
+        self.handle(message, handle_parsed_message)
+        send_and_store = self.handle(message, handle_parsed_message)
+
+        self.assertEqual(handle_parsed_message.call_count, 1)
+        send_and_store.assert_not_called()
+
+    def test_unconfirmed_reply_is_resent_without_a_new_completion(self):
+        message = make_message(1, chat_id='handler-resend')
+        reply = {'chat_id': 'handler-resend', 'kind': 'text', 'body': 'hi'}
+
+        def reply_then_fail(ctx, *args):
+            idempotency.record_reply(ctx, message, reply)
+            raise ValueError('send failed')
+
+        with self.assertRaises(ValueError):
+            self.handle(message, reply_then_fail)
+
+        handle_parsed_message = mock.Mock()
+        send_and_store = self.handle(message, handle_parsed_message)
+
+        handle_parsed_message.assert_not_called()
+        send_and_store.assert_called_once()
+        self.assertEqual(send_and_store.call_args.args[2], reply)
+        self.assertEqual(idempotency.begin_processing(Context(), message).state, ProcessingStateE.DONE)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+import os
+import tempfile
+import time
+import unittest
+
+from test import testenv     # paths and settings; must be imported first
+
+from services.queues.memory import InMemoryQueue
+from services.queues.sqlite import SqliteQueue
+
+# Behaviour shared by the local queue backends; both mimic SQS visibility semantics.
+class QueueContractTest:
+    def make_queue(self, visibility_timeout):
+        raise NotImplementedError
+
+    def test_messages_are_received_in_send_order(self):
+        queue = self.make_queue(30)
+
+        for i in range(5):
+            queue.send_message(f'message {i}', group_id='chat')
+
+        messages = queue.receive_messages(3, 0) + queue.receive_messages(3, 0)
+
+        self.assertEqual([m['Body'] for m in messages], [f'message {i}' for i in range(5)])
+        self.assertEqual(messages[0]['Attributes']['MessageGroupId'], 'chat')
+        self.assertEqual(messages[0]['Attributes']['ApproximateReceiveCount'], '1')
+
+    def test_received_messages_are_hidden_until_the_timeout(self):
+        queue = self.make_queue(1)
+        queue.send_message('hello')
+
+        self.assertEqual(len(queue.receive_messages(10, 0)), 1)
+        self.assertEqual(queue.receive_messages(10, 0), [])
+        self.assertEqual(queue.get_approximate_depth(), 0)
+
+        time.sleep(1.1)
+
+        redelivered = queue.receive_messages(10, 0)
+
+        self.assertEqual([m['Body'] for m in redelivered], ['hello'])
+        self.assertEqual(redelivered[0]['Attributes']['ApproximateReceiveCount'], '2')
+
+    def test_deleted_messages_are_gone(self):
+        queue = self.make_queue(0)
+        queue.send_message('hello')
+
+        (message,) = queue.receive_messages(10, 0)
+
+        self.assertEqual(queue.delete_messages([message['ReceiptHandle']]), [])
+        self.assertEqual(queue.receive_messages(10, 0), [])
+        self.assertEqual(queue.delete_messages([message['ReceiptHandle']]), [message['ReceiptHandle']])
+
+    def test_only_the_latest_receipt_handle_is_valid(self):
+        queue = self.make_queue(0)
+        queue.send_message('hello')
+
+        (first,) = queue.receive_messages(10, 0)
+        (second,) = queue.receive_messages(10, 0)
+
+        self.assertEqual(queue.change_visibility([first['ReceiptHandle']], 30), [first['ReceiptHandle']])
+        self.assertEqual(queue.delete_messages([first['ReceiptHandle']]), [first['ReceiptHandle']])
+        self.assertEqual(queue.delete_messages([second['ReceiptHandle']]), [])
+
+    def test_change_visibility_extends_the_timeout(self):
+        queue = self.make_queue(1)
+        queue.send_message('hello')
+
+        (message,) = queue.receive_messages(10, 0)
+
+        self.assertEqual(queue.change_visibility([message['ReceiptHandle']], 30), [])
+
+        time.sleep(1.1)
+
+        self.assertEqual(queue.receive_messages(10, 0), [])
+
+    def test_receive_waits_for_new_messages(self):
+        queue = self.make_queue(30)
+
+        start = time.time()
+        self.assertEqual(queue.receive_messages(10, 0.3), [])
+        self.assertGreaterEqual(time.time() - start, 0.3)
+
+        queue.send_message('hello')
+
+        self.assertEqual(len(queue.receive_messages(10, 5)), 1)
+
+class InMemoryQueueTest(QueueContractTest, unittest.TestCase):
+    def make_queue(self, visibility_timeout):
+        return InMemoryQueue(visibility_timeout=visibility_timeout)
+
+class SqliteQueueTest(QueueContractTest, unittest.TestCase):
+    def make_queue(self, visibility_timeout):
+        path = os.path.join(tempfile.mkdtemp(), 'queue.db')
+        return SqliteQueue(path, visibility_timeout=visibility_timeout, poll_interval=0.05)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+import unittest
+
+from test import testenv     # paths and settings; must be imported first
+
+from box import Box
+
+from infra.context import Context
+from services.messengers import streaming_reply
+from services.messengers.messenger import split_text
+from services.messengers.streaming_reply import IN_PROGRESS_MARKER, StreamingReply
+from services.open_ai.query_openai import PartialAnswerExtractor
+
+def feed_incrementally(text, step=1):
+    # Feeds growing prefixes of text, as a streamed completion does; returns every non-empty partial answer.
+    extractor = PartialAnswerExtractor()
+    answers = []
+
+    for end in range(step, len(text) + step, step):
+        answer = extractor.feed(text[:end])
+        if answer:
+            answers.append(answer)
+
+    return answers
+
+class PartialAnswerExtractorTest(unittest.TestCase):
+    def assert_extracts(self, reply, expected):
+        for step in (1, 2, 3, 7):
+            answers = feed_incrementally(reply, step)
+
+            self.assertEqual(answers[-1], expected)
+
+            # Partial answers only grow; a split escape sequence never shows up half-decoded.
+            for earlier, later in zip(answers, answers[1:]):
+                self.assertTrue(later.startswith(earlier), (step, earlier, later))
+
+    def test_plain_answer(self):
+        self.assert_extracts('<yair1xigoresponse>{ "ANSWER" : "Hello there" }</yair1xigoresponse>', 'Hello there')
+
+    def test_single_quoted_answer(self):
+        self.assert_extracts("<yair1xigoresponse>{'ANSWER': 'It is \"fine\"'}</yair1xigoresponse>", 'It is "fine"')
+
+    def test_escape_sequences(self):
+        reply = r'<yair1xigoresponse>{ "ANSWER" : "Line 1\nLine 2\t\"quoted\" back\\slash caf\u00e9 \'x\'" }</yair1xigoresponse>'
+
+        self.assert_extracts(reply, 'Line 1\nLine 2\t"quoted" back\\slash café \'x\'')
+
+    def test_answer_ends_at_closing_quote(self):
+        extractor = PartialAnswerExtractor()
+
+        self.assertEqual(extractor.feed('<yair1xigoresponse>{ "ANSWER" : "Done" }'), 'Done')
+        self.assertEqual(extractor.feed('<yair1xigoresponse>{ "ANSWER" : "Done" } trailing "text"'), 'Done')
+
+    def test_no_answer_for_tool_replies(self):
+        reply = '<yair1xigoresponse>{ "TOOL" : "SEARCH", "TOOL_INPUT" : "weather" }</yair1xigoresponse>'
+
+        self.assertEqual(feed_incrementally(reply), [])
+
+class SplitTextTest(unittest.TestCase):
+    def test_short_text_is_kept_whole(self):
+        self.assertEqual(split_text('hello', 10), ['hello'])
+
+    def test_splits_at_line_breaks_then_spaces(self):
+        self.assertEqual(split_text('first line\nsecond line', 15), ['first line', 'second line'])
+        self.assertEqual(split_text('hello there friend', 12), ['hello there', 'friend'])
+
+    def test_long_words_are_cut(self):
+        self.assertEqual(split_text('a' * 25, 10), ['a' * 10, 'a' * 10, 'a' * 5])
+
+class FakeMessenger:
+    def __init__(self, max_message_length=None):
+        self.max_message_length = max_message_length
+        self.sent = []
+        self.edits = []
+
+    def send_message(self, ctx, attributes):
+        self.sent.append(attributes['body'])
+        return Box({'messageId': str(len(self.sent)), 'body': attributes['body']})
+
+    def edit_message(self, ctx, message_id, body):
+        if self.max_message_length is not None and len(body) > self.max_message_length:
+            return False
+
+        self.edits.append((message_id, body))
+        return True
+
+class StreamingReplyTest(unittest.TestCase):
+    def setUp(self):
+        self._edit_interval = streaming_reply.STREAMING_EDIT_INTERVAL_MS
+        streaming_reply.STREAMING_EDIT_INTERVAL_MS = 0
+
+    def tearDown(self):
+        streaming_reply.STREAMING_EDIT_INTERVAL_MS = self._edit_interval
+
+    def stream(self, messenger, text, step=5):
+        reply = StreamingReply(Context(), messenger, 'chat', 0)
+
+        for end in range(step, len(text) + step, step):
+            reply.update(text[:end])
+
+        return reply.finish(text)
+
+    def test_reply_is_sent_once_then_edited(self):
+        messenger = FakeMessenger()
+
+        message = self.stream(messenger, 'The quick brown fox jumps over the lazy dog')
+
+        self.assertEqual(len(messenger.sent), 1)
+        self.assertTrue(messenger.sent[0].endswith(IN_PROGRESS_MARKER))
+        self.assertEqual(messenger.edits[-1], ('1', 'The quick brown fox jumps over the lazy dog'))
+        self.assertEqual(message.body, 'The quick brown fox jumps over the lazy dog')
+
+    def test_overflow_is_sent_as_follow_up_messages(self):
+        messenger = FakeMessenger(max_message_length=20)
+        text = 'hello there friend, how are you doing today my dear'
+
+        message = self.stream(messenger, text)
+
+        self.assertEqual(messenger.edits[-1], ('1', 'hello there friend,'))
+        self.assertEqual(messenger.sent[1:], ['how are you doing', 'today my dear'])
+        self.assertTrue(all(len(body) <= 20 for body in messenger.sent))
+
+        # The whole reply is stored, under the first message.
+        self.assertEqual(message.messageId, '1')
+        self.assertEqual(message.body, text)
+
+if __name__ == '__main__':
+    unittest.main()
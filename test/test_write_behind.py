@@ -0,0 +1,71 @@
+import datetime
+import time
+import unittest
+
+from test import testenv     # paths and settings; must be imported first
+
+from box import Box
+
+from infra.context import Context
+from services import message_db, write_behind
+
+def make_message(message_id, chat_id, is_sent_by_me, timestamp):
+    return Box({
+        'source': 'tg',
+        'messageTimestamp': timestamp,
+        'chatType': 'private',
+        'chatId': chat_id,
+        'senderId': 'bot' if is_sent_by_me else 'user',
+        'isSentByMe': is_sent_by_me,
+        'isForwarded': False,
+        'messageId': str(message_id),
+        'replyToMessageId': None,
+        'kind': 'text',
+        'body': f'message {message_id}',
+        'rawSource': None
+    })
+
+def history_query(chat_id, timestamp):
+    return Box({'chatId': chat_id, 'messageTimestamp': datetime.datetime.fromtimestamp(timestamp, tz=datetime.timezone.utc)})
+
+class WriteBehindTest(unittest.TestCase):
+    def setUp(self):
+        # Flushes only on close, so that replies stay pending for the duration of the test.
+        self.writer = write_behind.WriteBehindWriter(batch_size=50, flush_interval=60, queue_size=100)
+        message_db.register_pending_source(self.writer.pending_history)
+        write_behind.writer = self.writer
+
+    def tearDown(self):
+        write_behind.writer = None
+        message_db._pending_sources.remove(self.writer.pending_history)
+        self.writer.close()
+
+    def test_pending_reply_keeps_its_place_in_history(self):
+        ctx = Context()
+        now = int(time.time())
+
+        message_db.insert_message(ctx, make_message(1, 'wb-order', False, now))
+        reply = write_behind.store_reply(ctx, make_message(2, 'wb-order', True, now))
+
+        # The user's next message arrives within the same second, and is stored before the reply is written.
+        message_db.insert_message(ctx, make_message(3, 'wb-order', False, now))
+
+        self.assertIsInstance(reply, write_behind.PendingMessage)
+        self.assertEqual([m.messageId for m in message_db.get_message_history(ctx, history_query('wb-order', now))], ['1', '2', '3'])
+
+        # Written later, the reply keeps the time it was accepted.
+        self.writer.close()
+
+        self.assertIsNotNone(reply.id)
+        self.assertEqual([m.messageId for m in message_db.get_message_history(ctx, history_query('wb-order', now))], ['1', '2', '3'])
+
+    def test_pending_reply_is_recognized_as_my_message(self):
+        ctx = Context()
+
+        write_behind.store_reply(ctx, make_message(2, 'wb-mine', True, int(time.time())))
+
+        self.assertTrue(message_db.is_my_message('wb-mine', 2))
+        self.assertFalse(message_db.is_my_message('wb-mine', 3))
+
+if __name__ == '__main__':
+    unittest.main()
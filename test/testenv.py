@@ -0,0 +1,26 @@
+import os
+import sys
+import tempfile
+
+# Common setup for tests; import it before any module under src.
+#
+# Tests run in a scratch directory (the logger writes to ./logs, and load_env() reads ./.env.<stage>), against a
+# scratch SQLite database, with placeholder credentials: nothing reaches external services.
+SRC_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+if SRC_DIR not in sys.path:
+    sys.path.insert(0, SRC_DIR)
+
+WORK_DIR = tempfile.mkdtemp(prefix='r1x-test-')
+os.makedirs(os.path.join(WORK_DIR, 'logs'))
+os.chdir(WORK_DIR)
+
+os.environ.update({
+    'R1X_STAGE': 'dev-local',
+    'DB_CONNECTION_STRING': f'sqlite:///{os.path.join(WORK_DIR, "r1x.db")}',
+    'DB_CREATE_ALL': '1',
+    'OPENAI_API_KEY': 'test',
+    'TELEGRAM_BOT_TOKEN': '1000:test',
+    'TELEGRAM_BOT_NAME': 'r1x_test_bot',
+    'SERPER_API_KEY': 'test',
+})
@@ -0,0 +1,71 @@
+#!/usr/bin/python3
+
+import argparse
+import json
+import os
+import zlib
+import psycopg2
+import psycopg2.extras
+from dotenv import load_dotenv
+from datetime import datetime, timedelta
+
+# Moves webhook payloads from Messages."rawSource" into message_raw_sources, compressed, in batches.
+# Payloads older than --retention-days are dropped instead of moved.
+
+def connect_to_db():
+    stage = os.environ['R1X_STAGE'] if 'R1X_STAGE' in os.environ else 'dev'
+    print('Connecting to %s environment...' % stage)
+    load_dotenv('.env.%s' % stage)
+    connection_string = os.getenv('DB_CONNECTION_STRING')
+    conn = psycopg2.connect(connection_string)
+    return conn
+
+def encode_raw_source(raw_source):
+    # Same encoding as services.message_db.encode_raw_source.
+    return zlib.compress(json.dumps(raw_source, separators=(',', ':')).encode('utf-8'))
+
+def backfill(batch_size, retention_days):
+    conn = connect_to_db()
+    cursor = conn.cursor()
+
+    cutoff = datetime.now() - timedelta(days=retention_days) if retention_days is not None else None
+
+    moved = 0
+    dropped = 0
+
+    # Each batch continues after the last id of the previous one, so it never rescans rows already handled.
+    last_id = 0
+
+    while True:
+        cursor.execute('SELECT id, "rawSource", "createdAt" FROM "Messages" WHERE "rawSource" IS NOT NULL AND id > %s ORDER BY id LIMIT %s', (last_id, batch_size))
+        rows = cursor.fetchall()
+
+        if not rows:
+            break
+
+        keep = [row for row in rows if cutoff is None or row[2].replace(tzinfo=None) >= cutoff]
+
+        psycopg2.extras.execute_values(
+            cursor,
+            'INSERT INTO message_raw_sources (message_id, data, created_at) VALUES %s ON CONFLICT (message_id) DO NOTHING',
+            [(id, psycopg2.Binary(encode_raw_source(raw_source)), created_at) for id, raw_source, created_at in keep]
+        )
+
+        cursor.execute('UPDATE "Messages" SET "rawSource" = NULL WHERE id = ANY(%s)', ([row[0] for row in rows],))
+        conn.commit()
+
+        last_id = rows[-1][0]
+        moved += len(keep)
+        dropped += len(rows) - len(keep)
+        print('Moved %d payloads, dropped %d expired payloads; last id=%d' % (moved, dropped, last_id))
+
+    cursor.close()
+    conn.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Move Messages.rawSource payloads into message_raw_sources.')
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--retention-days', type=int, default=None, help='drop payloads older than this instead of moving them')
+    args = parser.parse_args()
+
+    backfill(args.batch_size, args.retention_days)
@@ -0,0 +1,58 @@
+#!/usr/bin/python3
+
+import argparse
+import os
+import psycopg2
+import psycopg2.extras
+import tiktoken
+from dotenv import load_dotenv
+
+# Fills Messages."tokenCount" for rows stored before the column was introduced, in batches.
+# Counts must match services.token_prediction.token_predictor, which uses the same encoding.
+
+encoder = tiktoken.get_encoding("cl100k_base")
+
+def connect_to_db():
+    stage = os.environ['R1X_STAGE'] if 'R1X_STAGE' in os.environ else 'dev'
+    print('Connecting to %s environment...' % stage)
+    load_dotenv('.env.%s' % stage)
+    connection_string = os.getenv('DB_CONNECTION_STRING')
+    conn = psycopg2.connect(connection_string)
+    return conn
+
+def backfill(batch_size):
+    conn = connect_to_db()
+    cursor = conn.cursor()
+
+    updated = 0
+
+    # Each batch continues after the last id of the previous one, so it never rescans rows already handled.
+    last_id = 0
+
+    while True:
+        cursor.execute('SELECT id, body FROM "Messages" WHERE "tokenCount" IS NULL AND body IS NOT NULL AND id > %s ORDER BY id LIMIT %s', (last_id, batch_size))
+        rows = cursor.fetchall()
+
+        if not rows:
+            break
+
+        psycopg2.extras.execute_values(
+            cursor,
+            'UPDATE "Messages" SET "tokenCount" = counts.token_count FROM (VALUES %s) AS counts (id, token_count) WHERE "Messages".id = counts.id',
+            [(id, len(encoder.encode(body))) for id, body in rows]
+        )
+        conn.commit()
+
+        last_id = rows[-1][0]
+        updated += len(rows)
+        print('Updated %d messages; last id=%d' % (updated, last_id))
+
+    cursor.close()
+    conn.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Fill Messages.tokenCount for existing messages.')
+    parser.add_argument('--batch-size', type=int, default=1000)
+    args = parser.parse_args()
+
+    backfill(args.batch_size)
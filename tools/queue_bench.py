@@ -0,0 +1,68 @@
+#!/usr/bin/python3
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+from infra import utils
+from services.queues import queue_factory
+
+utils.load_env()
+
+from services.messengers.messenger_factory import get_messenger_chat_id_from_event
+
+# Feeds recorded events into the configured queue backend at a fixed rate, and reports queue depth.
+#
+# Typical offline run, using the same consumer code as production:
+#
+#   R1X_QUEUE_BACKEND=sqlite ./tools/queue_bench.py --events events.jsonl --count 1000 --rate 50
+#   R1X_QUEUE_BACKEND=sqlite R1X_STAGE=dev-local ./src/run.py
+#
+# The memory backend only lives inside a single process, so use sqlite (or sqs) here.
+# Each line in the events file is a queue message body, i.e. { "source" : "tg"|"wa", "event" : {...} }.
+
+def load_events(path):
+    with open(path, 'r') as file:
+        return [line.strip() for line in file if line.strip()]
+
+def enqueue(queue, events, count, rate):
+    interval = 1 / rate
+    next_send = time.time()
+
+    for i in range(count):
+        body = events[i % len(events)]
+        group_id = get_messenger_chat_id_from_event(json.loads(body))
+        queue.send_message(body, group_id)
+
+        next_send += interval
+        time.sleep(max(0, next_send - time.time()))
+
+        if i % rate == 0:
+            print(f'sent={i + 1} depth={queue.get_approximate_depth()}')
+
+def wait_for_drain(queue):
+    start = time.time()
+
+    while queue.get_approximate_depth() > 0:
+        print(f'depth={queue.get_approximate_depth()} elapsed={int(time.time() - start)}s')
+        time.sleep(1)
+
+    print(f'Queue drained after {time.time() - start:.1f}s.')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Feed recorded events into the R1X message queue at a fixed rate.')
+    parser.add_argument('--events', required=True, help='Path to a file with one message body per line.')
+    parser.add_argument('--count', type=int, default=100, help='Total number of messages to send.')
+    parser.add_argument('--rate', type=int, default=10, help='Messages per second.')
+    parser.add_argument('--wait', action='store_true', help='Wait until no visible messages remain.')
+
+    args = parser.parse_args()
+
+    queue = queue_factory.make_queue()
+    enqueue(queue, load_events(args.events), args.count, args.rate)
+
+    if args.wait:
+        wait_for_drain(queue)
@@ -0,0 +1,67 @@
+#!/usr/bin/python3
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+SRC_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+# Measures process startup: how long importing each module takes in a fresh interpreter, and, separately, how long
+# the first database query takes (engine creation, connecting and, with DB_CREATE_ALL=1, creating tables).
+#
+# Runs with the current environment, e.g.:
+#
+#   R1X_STAGE=dev-local ./tools/startup_bench.py --runs 10
+#   R1X_STAGE=dev-local ./tools/startup_bench.py --modules db_models services.timers
+
+DEFAULT_MODULES = ['db_models', 'services.timers', 'services.open_ai.query_openai', 'message_handler', 'run']
+
+IMPORT_SCRIPT = '''
+import sys, time
+sys.path.insert(0, {src_dir!r})
+start = time.perf_counter()
+import {module}
+print(time.perf_counter() - start)
+'''
+
+FIRST_QUERY_SCRIPT = '''
+import sys, time
+sys.path.insert(0, {src_dir!r})
+from infra import utils
+utils.load_env()
+import db_models
+from sqlalchemy import text
+start = time.perf_counter()
+with db_models.Session() as session:
+    session.execute(text('SELECT 1'))
+print(time.perf_counter() - start)
+'''
+
+def time_script(script):
+    # Each sample runs in a new interpreter, so that nothing is already imported or connected.
+    result = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True)
+
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip() or result.stdout.strip())
+
+    return float(result.stdout.strip().splitlines()[-1])
+
+def report(name, samples):
+    samples_ms = [sample * 1000 for sample in samples]
+    print(f'{name:<40} min={min(samples_ms):8.1f}ms  median={statistics.median(samples_ms):8.1f}ms  max={max(samples_ms):8.1f}ms')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure R1X process startup time.')
+    parser.add_argument('--modules', nargs='+', default=DEFAULT_MODULES, help='Modules to time, each imported in a fresh interpreter.')
+    parser.add_argument('--runs', type=int, default=5, help='Samples per measurement.')
+    parser.add_argument('--skip-db', action='store_true', help="Don't time the first database query.")
+
+    args = parser.parse_args()
+
+    for module in args.modules:
+        report(f'import {module}', [time_script(IMPORT_SCRIPT.format(src_dir=SRC_DIR, module=module)) for _ in range(args.runs)])
+
+    if not args.skip_db:
+        report('first query', [time_script(FIRST_QUERY_SCRIPT.format(src_dir=SRC_DIR)) for _ in range(args.runs)])
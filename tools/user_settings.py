@@ -15,11 +15,15 @@ def connect_to_db():
     conn = psycopg2.connect(connection_string)
     return conn
 
+def notify_settings_changed(cursor, user_id):
+    # Running bots drop their cached copy of this user's settings once the transaction commits.
+    cursor.execute("SELECT pg_notify('user_settings_changed', %s)", (user_id,))
+
 def get_settings(user_id):
     conn = connect_to_db()
     cursor = conn.cursor()
 
-    cursor.execute("SELECT * FROM user_settings WHERE user_id = %s ORDER BY id DESC", (user_id,))
+    cursor.execute("SELECT * FROM current_user_settings WHERE user_id = %s", (user_id,))
     row = cursor.fetchone()
 
     if row:
@@ -30,21 +34,39 @@ def get_settings(user_id):
     cursor.close()
     conn.close()
 
+def lock_current_settings(cursor, user_id):
+    # Locks the user's current settings until commit, so that concurrent changes apply one after the other.
+    cursor.execute("SELECT settings FROM current_user_settings WHERE user_id = %s FOR UPDATE", (user_id,))
+    row = cursor.fetchone()
+
+    return row[0] if row else None
+
+def write_settings(cursor, user_id, settings):
+    # Appends to the user_settings history, and points current_user_settings at the new row; callers commit both together.
+    now = datetime.now()
+
+    cursor.execute('INSERT INTO user_settings (user_id, settings, version, "createdAt", "updatedAt") VALUES (%s, %s, 1, %s, %s) RETURNING id',
+                   (user_id, json.dumps(settings), now, now))
+    user_settings_id = cursor.fetchone()[0]
+
+    cursor.execute('INSERT INTO current_user_settings (user_id, settings, version, user_settings_id, "updatedAt") VALUES (%s, %s, 1, %s, %s) '
+                   'ON CONFLICT (user_id) DO UPDATE SET settings = EXCLUDED.settings, version = EXCLUDED.version, '
+                   'user_settings_id = EXCLUDED.user_settings_id, "updatedAt" = EXCLUDED."updatedAt"',
+                   (user_id, json.dumps(settings), user_settings_id, now))
+
+    notify_settings_changed(cursor, user_id)
+
 def set_setting(user_id, key_value_pairs):
     conn = connect_to_db()
     cursor = conn.cursor()
 
-    cursor.execute("SELECT settings FROM user_settings WHERE user_id = %s", (user_id,))
-    row = cursor.fetchone()
-
-    settings = row[0] if row else {}
+    settings = lock_current_settings(cursor, user_id) or {}
 
     for pair in key_value_pairs:
         key, value = pair.split("=")
         settings[key] = value
 
-    cursor.execute('INSERT INTO user_settings (user_id, settings, version, "createdAt", "updatedAt") VALUES (%s, %s, 1, %s, %s)',
-                   (user_id, json.dumps(settings), datetime.now(), datetime.now()))
+    write_settings(cursor, user_id, settings)
 
     conn.commit()
     cursor.close()
@@ -54,14 +76,12 @@ def clear_setting(user_id, key):
     conn = connect_to_db()
     cursor = conn.cursor()
 
-    cursor.execute("SELECT settings FROM user_settings WHERE user_id = %s", (user_id,))
-    row = cursor.fetchone()
+    settings = lock_current_settings(cursor, user_id)
 
-    if row:
-        settings = row[0]
+    if settings is not None:
         if key in settings:
             del settings[key]
-            cursor.execute("UPDATE user_settings SET settings = %s WHERE user_id = %s", (json.dumps(settings), user_id))
+            write_settings(cursor, user_id, settings)
             conn.commit()
         else:
             print("Key not found in settings for user_id {}".format(user_id))